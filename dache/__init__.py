@@ -1,48 +1,108 @@
 import six
+import sys
 
 from six.moves.urllib.parse import urlparse
 
 from dache.backends.base import CacheKeyWarning  # noqa
+from dache.compressors import register_compressor  # noqa
+from dache.serializers import register_serializer  # noqa
 from dache.utils.module_loading import import_string
 
 
 __version__ = '0.0.4'
 
-__all__ = ('register_backend', 'Cache', 'CacheKeyWarning')
+__all__ = ('register_async_backend', 'register_backend', 'register_compressor',
+           'register_serializer', 'AsyncCache', 'Cache', 'CacheKeyWarning')
 
 
 _BACKENDS = {
     'file': 'dache.backends.filebased.FileBasedCache',
     'leveldb': 'dache.backends.leveldb.LevelDBCache',
     'locmem': 'dache.backends.locmem.LocMemCache',
+    'logfile': 'dache.backends.logfile.LogFileCache',
     'memcached': 'dache.backends.memcached.MemcachedCache',
     'pylibmc': 'dache.backends.memcached.PyLibMCCache',
     'redis': 'dache.backends.redis.RedisCache',
+    'shm': 'dache.backends.shm.SharedMemoryCache',
+    'sqlite': 'dache.backends.sqlite.SQLiteCache',
+    'tiered': 'dache.backends.tiered.TieredCache',
 }
 
 
+# Backends of other URL schemes are run in an executor by AsyncCache
+_ASYNC_BACKENDS = {
+    'memcached': 'dache.backends.async_memcached.AsyncMemcachedCache',
+    'redis': 'dache.backends.async_redis.AsyncRedisCache',
+}
+
+_PUBLIC_METHODS = ('add', 'get', 'get_or_set', 'set', 'delete', 'get_many',
+                   'has_key', 'incr', 'decr', 'set_many', 'delete_many',
+                   'clear', 'validate_key', 'incr_version', 'decr_version',
+                   'close', 'stats')
+
+
 def register_backend(url_scheme, backend_class):
     """Register a cache backend."""
     _BACKENDS[url_scheme] = backend_class
 
 
+def register_async_backend(url_scheme, backend_class):
+    """Register an asyncio cache backend."""
+    _ASYNC_BACKENDS[url_scheme] = backend_class
+
+
+def _create_backend(backends, url, options):
+    result = urlparse(url)
+    backend_class = backends[result.scheme]
+    if isinstance(backend_class, six.string_types):
+        backend_class = import_string(backend_class)
+    return backend_class(result, **options)
+
+
 class Cache(object):
 
     def __init__(self, url, **options):
-        # Create cache backend
-        result = urlparse(url)
-        backend_class = _BACKENDS[result.scheme]
-        if isinstance(backend_class, six.string_types):
-            backend_class = import_string(backend_class)
-
-        self._backend = backend_class(result, **options)
-
-        public_methods = ('add', 'get', 'set', 'delete', 'get_many', 'has_key',
-                          'incr', 'decr', 'set_many', 'delete_many', 'clear',
-                          'validate_key', 'incr_version', 'decr_version',
-                          'close')
-        for method in public_methods:
+        self._backend = _create_backend(_BACKENDS, url, options)
+
+        for method in _PUBLIC_METHODS:
             setattr(self, method, getattr(self._backend, method))
 
+    def __getattr__(self, name):
+        # Expose backend-specific attributes, e.g. LocMemCache.bytes_used
+        if name == '_backend':
+            raise AttributeError(name)
+        return getattr(self._backend, name)
+
+    def __contains__(self, item):
+        return item in self._backend
+
+
+class AsyncCache(object):
+    """A cache whose methods are coroutines, except validate_key() and
+    stats(). Requires Python 3.5+.
+
+    Redis and memcached are accessed natively with asyncio, other backends
+    run in the given executor, or the default one of the event loop.
+    """
+
+    def __init__(self, url, executor=None, **options):
+        if sys.version_info < (3, 5):
+            raise RuntimeError('AsyncCache requires Python 3.5+')
+
+        if urlparse(url).scheme in _ASYNC_BACKENDS:
+            self._backend = _create_backend(_ASYNC_BACKENDS, url, options)
+        else:
+            from dache.backends.async_base import ExecutorCache
+            self._backend = ExecutorCache(
+                _create_backend(_BACKENDS, url, options), executor)
+
+        for method in _PUBLIC_METHODS:
+            setattr(self, method, getattr(self._backend, method))
+
+    def __getattr__(self, name):
+        if name == '_backend':
+            raise AttributeError(name)
+        return getattr(self._backend, name)
+
     def __contains__(self, item):
         return item in self._backend
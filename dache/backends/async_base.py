@@ -0,0 +1,329 @@
+"""Base classes of the asyncio cache backends. Requires Python 3.5+."""
+
+import asyncio
+import functools
+import inspect
+import os
+import time
+import weakref
+
+from .base import DEFAULT_TIMEOUT, _LOCK_POLL_INTERVAL, _missing
+from dache.utils.stats import CacheStats, timer
+
+
+_current_task = getattr(asyncio, 'current_task', None)
+if _current_task is None:  # Python < 3.7
+    _current_task = asyncio.Task.current_task
+
+
+class _AsyncStats(CacheStats):
+    """Statistics of a cache whose methods are coroutines. The coroutines of
+    a thread interleave, so nested calls are told apart per task.
+    """
+
+    def __init__(self):
+        super(_AsyncStats, self).__init__()
+        self._tasks = weakref.WeakSet()
+
+    def _timed(self, operation, func, record, finish=None):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            task = _current_task()
+            if task is not None and task in self._tasks:
+                result = await func(*args, **kwargs)
+            else:
+                if task is not None:
+                    self._tasks.add(task)
+                start = timer()
+                try:
+                    result = await func(*args, **kwargs)
+                finally:
+                    if task is not None:
+                        self._tasks.discard(task)
+                self.record_latency(operation, timer() - start)
+                if record is not None:
+                    record(result, *args, **kwargs)
+            if finish is not None:
+                return finish(result, *args, **kwargs)
+            return result
+        return wrapper
+
+
+class AsyncBaseCache(object):
+    """Mixin making the methods of a cache backend coroutines. Its methods
+    are the counterparts of BaseCache's, which backends mixing it in override
+    with native implementations.
+    """
+
+    def __init__(self, *args, **options):
+        stats = options.pop('stats', False)
+        super(AsyncBaseCache, self).__init__(*args, **options)
+        if stats:
+            self._stats = _AsyncStats()
+            self._stats.instrument(self)
+
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if await self.has_key(key, version):  # noqa
+            return False
+        await self.set(key, value, timeout, version)
+        return True
+
+    async def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT,
+                         version=None, lock=False, lock_timeout=10):
+        """Like BaseCache.get_or_set(), default may also be a coroutine
+        function.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            value = await self.get(key, _missing, version=version)
+            if value is not _missing:
+                return value
+
+            # Futures belong to an event loop
+            flight_key = (loop, self.make_key(key, version=version))
+            with self._flights_lock:
+                flight = self._flights.get(flight_key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[flight_key] = asyncio.Future()
+            if leader:
+                break
+            try:
+                # A cancelled caller doesn't cancel the computation
+                failed, value = await asyncio.wait_for(
+                    asyncio.shield(flight), lock_timeout)
+            except asyncio.TimeoutError:
+                # The computation hangs, stop waiting for it
+                return await self._compute(key, default, timeout, version,
+                                           lock, lock_timeout)
+            if not failed:
+                return value
+            # The computation raised an exception, try again
+
+        failed, value = True, None
+        try:
+            value = await self._compute(key, default, timeout, version, lock,
+                                        lock_timeout)
+            failed = False
+        finally:
+            with self._flights_lock:
+                del self._flights[flight_key]
+            flight.set_result((failed, value))
+        return value
+
+    async def get_many(self, keys, version=None):
+        d = {}
+        for k in keys:
+            val = await self.get(k, version=version)
+            if val is not None:
+                d[k] = val
+        return d
+
+    async def has_key(self, key, version=None):
+        return await self.get(key, version=version) is not None
+
+    async def incr(self, key, delta=1, version=None):
+        value = await self.get(key, version=version)
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+        new_value = value + delta
+        await self.set(key, new_value, version=version)
+        return new_value
+
+    async def decr(self, key, delta=1, version=None):
+        return await self.incr(key, -delta, version=version)
+
+    def __contains__(self, key):
+        raise TypeError('Use "await cache.has_key(key)" instead of "in"')
+
+    async def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key, value in data.items():
+            await self.set(key, value, timeout=timeout, version=version)
+
+    async def delete_many(self, keys, version=None):
+        for key in keys:
+            await self.delete(key, version=version)
+
+    async def incr_version(self, key, delta=1, version=None):
+        if version is None:
+            version = self.version
+
+        value = await self.get(key, version=version)
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+
+        await self.set(key, value, version=version + delta)
+        await self.delete(key, version=version)
+        return version + delta
+
+    async def decr_version(self, key, delta=1, version=None):
+        return await self.incr_version(key, -delta, version)
+
+    async def close(self, **kwargs):
+        pass
+
+    async def _compute(self, key, default, timeout, version, lock,
+                       lock_timeout):
+        handle = None
+        if lock:
+            deadline = time.time() + lock_timeout
+            while True:
+                handle = await self._acquire_lock(key, version, lock_timeout)
+                if handle is not None or time.time() >= deadline:
+                    break
+                await asyncio.sleep(_LOCK_POLL_INTERVAL)
+                value = await self.get(key, _missing, version=version)
+                if value is not _missing:
+                    return value
+        try:
+            if handle is not None:
+                # The previous holder of the lock may have set the key
+                value = await self.get(key, _missing, version=version)
+                if value is not _missing:
+                    return value
+            value = default() if callable(default) else default
+            if inspect.isawaitable(value):
+                value = await value
+            await self.set(key, value, timeout, version)
+            return value
+        finally:
+            if handle is not None:
+                await self._release_lock(handle)
+
+    async def _acquire_lock(self, key, version, timeout):
+        lock_key = '%s.lock' % key
+        if await self.add(lock_key, 1, timeout, version):
+            return lock_key, version
+        return None
+
+    async def _release_lock(self, handle):
+        await self.delete(*handle)
+
+
+class _LoopConnections(object):
+    """Connections of a pool opened in one event loop."""
+
+    def __init__(self, max_connections):
+        self.idle = []
+        self.semaphore = None
+        if max_connections:
+            self.semaphore = asyncio.Semaphore(max_connections)
+
+
+class AsyncConnectionPool(object):
+    """Idle connections to a server, opened on demand. Streams are bound to
+    the event loop they were opened in, so connections are kept per loop, and
+    dropped after a fork. A connection has a close() method.
+    """
+
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections
+        self._loops = weakref.WeakKeyDictionary()
+        self._pid = os.getpid()
+
+    async def run(self, func):
+        """Return await func(connection), on an idle connection or a new one.
+        The connection is closed if func raises an exception, since the rest
+        of its replies can't be told apart anymore.
+        """
+        connections = self._get_loop_connections()
+        if connections.semaphore is not None:
+            await connections.semaphore.acquire()
+        try:
+            if connections.idle:
+                connection = connections.idle.pop()
+            else:
+                connection = await self.connect()
+            try:
+                result = await func(connection)
+            except BaseException:
+                connection.close()
+                raise
+            connections.idle.append(connection)
+            return result
+        finally:
+            if connections.semaphore is not None:
+                connections.semaphore.release()
+
+    async def connect(self):
+        """Open a connection."""
+        raise NotImplementedError(
+            'subclasses of AsyncConnectionPool must provide a connect() '
+            'method')
+
+    def disconnect(self):
+        """Close the idle connections of the running event loop."""
+        connections = self._get_loop_connections()
+        while connections.idle:
+            connections.idle.pop().close()
+
+    def _get_loop_connections(self):
+        if self._pid != os.getpid():
+            self._loops = weakref.WeakKeyDictionary()
+            self._pid = os.getpid()
+        loop = asyncio.get_event_loop()
+        connections = self._loops.get(loop)
+        if connections is None:
+            connections = _LoopConnections(self.max_connections)
+            self._loops[loop] = connections
+        return connections
+
+
+def _in_executor(name):
+    async def method(self, *args, **kwargs):
+        func = functools.partial(getattr(self._cache, name), *args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func)
+    method.__name__ = name
+    return method
+
+
+class ExecutorCache(object):
+    """Run the methods of a synchronous cache backend in an executor, the
+    default one of the event loop unless given.
+    """
+
+    def __init__(self, cache, executor=None):
+        self._cache = cache
+        self._executor = executor
+
+    add = _in_executor('add')
+    get = _in_executor('get')
+    set = _in_executor('set')
+    delete = _in_executor('delete')
+    get_many = _in_executor('get_many')
+    has_key = _in_executor('has_key')
+    incr = _in_executor('incr')
+    decr = _in_executor('decr')
+    set_many = _in_executor('set_many')
+    delete_many = _in_executor('delete_many')
+    clear = _in_executor('clear')
+    incr_version = _in_executor('incr_version')
+    decr_version = _in_executor('decr_version')
+    close = _in_executor('close')
+    _acquire_lock = _in_executor('_acquire_lock')
+    _release_lock = _in_executor('_release_lock')
+    _compute = AsyncBaseCache._compute
+
+    async def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT,
+                         version=None, lock=False, lock_timeout=10):
+        """Like AsyncBaseCache.get_or_set(). Other defaults than coroutines
+        are computed in the executor.
+        """
+        if inspect.iscoroutinefunction(default) or inspect.isawaitable(
+                default):
+            return await AsyncBaseCache.get_or_set(
+                self, key, default, timeout, version, lock, lock_timeout)
+        func = functools.partial(self._cache.get_or_set, key, default,
+                                 timeout, version, lock, lock_timeout)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func)
+
+    def __getattr__(self, name):
+        # validate_key(), make_key(), stats() and backend-specific attributes
+        if name == '_cache':
+            raise AttributeError(name)
+        return getattr(self._cache, name)
+
+    def __contains__(self, key):
+        raise TypeError('Use "await cache.has_key(key)" instead of "in"')
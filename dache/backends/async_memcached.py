@@ -0,0 +1,321 @@
+"""Memcached cache backend for asyncio, speaking the memcached text protocol
+over asyncio streams. Requires Python 3.5+.
+
+Keys are spread across servers and values are stored the way
+python-memcached does, so MemcachedCache and AsyncMemcachedCache instances
+of the same servers share their entries. Like python-memcached, failing
+servers are treated as cache misses.
+"""
+
+import asyncio
+import binascii
+import pickle
+import zlib
+
+from .async_base import AsyncBaseCache, AsyncConnectionPool
+from .base import DEFAULT_TIMEOUT, MEMCACHE_MAX_KEY_LENGTH
+from .memcached import BaseMemcachedCache
+from dache.utils.functional import cached_property
+
+
+DEFAULT_PORT = 11211
+
+# Flags python-memcached stores values with
+_FLAG_PICKLE = 1 << 0
+_FLAG_INTEGER = 1 << 1
+_FLAG_LONG = 1 << 2
+_FLAG_COMPRESSED = 1 << 3
+_FLAG_TEXT = 1 << 4
+
+
+def _server_hash(key):
+    """Hash of a key selecting its server, the one of python-memcached."""
+    return ((binascii.crc32(key) & 0xffffffff) >> 16) & 0x7fff or 1
+
+
+def _to_stored(value):
+    """Return the flags and bytes a value is stored as."""
+    if isinstance(value, bytes):
+        return 0, value
+    if isinstance(value, str):
+        return _FLAG_TEXT, value.encode('utf-8')
+    if isinstance(value, int):
+        return _FLAG_INTEGER, b'%d' % value
+    return _FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _from_stored(flags, data):
+    if flags & _FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+    if flags & _FLAG_TEXT:
+        return data.decode('utf-8')
+    if flags & (_FLAG_INTEGER | _FLAG_LONG):
+        return int(data)
+    if flags & _FLAG_PICKLE:
+        return pickle.loads(data)
+    return data
+
+
+def _encode_key(key):
+    key = key.encode('utf-8')
+    if len(key) > MEMCACHE_MAX_KEY_LENGTH:
+        raise ValueError('Key length is > %d' % MEMCACHE_MAX_KEY_LENGTH)
+    for char in key:
+        if char < 33 or char == 127:
+            raise ValueError('Control characters not allowed in key')
+    return key
+
+
+class _ServerError(Exception):
+    pass
+
+
+class _Connection(object):
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def request(self, data, num_replies=1):
+        """Send commands and return their reply lines."""
+        self.writer.write(data)
+        await self.writer.drain()
+        return [await self.readline() for _ in range(num_replies)]
+
+    async def get(self, keys):
+        """Return {key: (flags, data)} of the keys found."""
+        self.writer.write(b'get %s\r\n' % b' '.join(keys))
+        await self.writer.drain()
+        values = {}
+        while True:
+            line = await self.readline()
+            if line == b'END':
+                return values
+            if not line.startswith(b'VALUE '):
+                raise _ServerError(line)
+            key, flags, length = line.split()[1:4]
+            data = await self.reader.readexactly(int(length) + 2)
+            values[key] = (int(flags), data[:-2])
+
+    async def readline(self):
+        line = await self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise _ServerError('Connection closed by server')
+        return line[:-2]
+
+    def close(self):
+        self.writer.close()
+
+
+class _MemcachedConnectionPool(AsyncConnectionPool):
+
+    def __init__(self, server):
+        super(_MemcachedConnectionPool, self).__init__()
+        # host:port or unix:/path/to/socket
+        self.path = None
+        if server.startswith('unix:'):
+            self.path = server[5:]
+        else:
+            host, _, port = server.partition(':')
+            self.host = host or 'localhost'
+            self.port = int(port or DEFAULT_PORT)
+
+    async def connect(self):
+        if self.path is not None:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host,
+                                                           self.port)
+        return _Connection(reader, writer)
+
+    async def execute(self, func, failed=None):
+        """Return await func(connection), or failed if the server can't be
+        reached or replies with an error.
+        """
+        try:
+            return await self.run(func)
+        except (OSError, asyncio.IncompleteReadError, _ServerError):
+            return failed
+
+
+class _Client(object):
+    """A python-memcached-like client whose methods are coroutines."""
+
+    def __init__(self, servers):
+        self._pools = [_MemcachedConnectionPool(server) for server in servers]
+
+    async def get(self, key):
+        return (await self.get_multi([key])).get(key)
+
+    async def get_multi(self, keys):
+        keys = dict((_encode_key(key), key) for key in keys)
+        d = {}
+        for values in await asyncio.gather(*[
+                pool.execute(lambda c, keys=group: c.get(keys), {})
+                for pool, group in self._group_by_pool(keys)]):
+            for key, (flags, data) in values.items():
+                d[keys[key]] = _from_stored(flags, data)
+        return d
+
+    async def set(self, key, value, time=0):
+        return await self._store(b'set', key, value, time)
+
+    async def add(self, key, value, time=0):
+        return await self._store(b'add', key, value, time)
+
+    async def set_multi(self, mapping, time=0):
+        values = dict((_encode_key(key), value)
+                      for key, value in mapping.items())
+
+        def request(keys):
+            data = b''.join(self._store_command(b'set', key, values[key],
+                                                time)
+                            for key in keys)
+            return lambda c: c.request(data, len(keys))
+        await asyncio.gather(*[
+            pool.execute(request(group))
+            for pool, group in self._group_by_pool(values)])
+
+    async def delete(self, key):
+        key = _encode_key(key)
+        await self._get_pool(key).execute(
+            lambda c: c.request(b'delete %s\r\n' % key))
+
+    async def delete_multi(self, keys):
+        keys = [_encode_key(key) for key in keys]
+
+        def request(keys):
+            data = b''.join(b'delete %s\r\n' % key for key in keys)
+            return lambda c: c.request(data, len(keys))
+        await asyncio.gather(*[
+            pool.execute(request(group))
+            for pool, group in self._group_by_pool(keys)])
+
+    async def incr(self, key, delta=1):
+        return await self._incr(b'incr', key, delta)
+
+    async def decr(self, key, delta=1):
+        return await self._incr(b'decr', key, delta)
+
+    async def flush_all(self):
+        await asyncio.gather(*[
+            pool.execute(lambda c: c.request(b'flush_all\r\n'))
+            for pool in self._pools])
+
+    def disconnect_all(self):
+        for pool in self._pools:
+            pool.disconnect()
+
+    async def _store(self, command, key, value, time):
+        key = _encode_key(key)
+        data = self._store_command(command, key, value, time)
+        replies = await self._get_pool(key).execute(
+            lambda c: c.request(data), [])
+        return replies == [b'STORED']
+
+    def _store_command(self, command, key, value, time):
+        flags, data = _to_stored(value)
+        return b'%s %s %d %d %d\r\n%s\r\n' % (
+            command, key, flags, time, len(data), data)
+
+    async def _incr(self, command, key, delta):
+        """Return the new value, or None if the key wasn't found or isn't a
+        number.
+        """
+        key = _encode_key(key)
+        replies = await self._get_pool(key).execute(
+            lambda c: c.request(b'%s %s %d\r\n' % (command, key, delta)),
+            [])
+        if replies and replies[0].isdigit():
+            return int(replies[0])
+        return None
+
+    def _get_pool(self, key):
+        return self._pools[_server_hash(key) % len(self._pools)]
+
+    def _group_by_pool(self, keys):
+        """Group keys by server. Return a list of (pool, [key, ...])."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._get_pool(key), []).append(key)
+        return list(groups.items())
+
+
+class AsyncMemcachedCache(AsyncBaseCache, BaseMemcachedCache):
+
+    def __init__(self, url, **options):
+        super(AsyncMemcachedCache, self).__init__(url, None, ValueError,
+                                                  **options)
+
+    @cached_property
+    def _cache(self):
+        return _Client(self._servers)
+
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        value = self._encode(value)
+        added = await self._cache.add(key, value,
+                                      self.get_backend_timeout(timeout))
+        if added:
+            self._record_size('bytes_in', value)
+        return added
+
+    async def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        val = await self._cache.get(key)
+        if val is None:
+            return default
+        self._record_size('bytes_out', val)
+        return self._decode(val)
+
+    async def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        value = self._encode(value)
+        await self._cache.set(key, value, self.get_backend_timeout(timeout))
+        self._record_size('bytes_in', value)
+
+    async def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        await self._cache.delete(key)
+
+    async def get_many(self, keys, version=None):
+        new_keys = dict((self.make_key(key, version=version), key)
+                        for key in keys)
+        ret = await self._cache.get_multi(list(new_keys))
+        for v in ret.values():
+            self._record_size('bytes_out', v)
+        return dict((new_keys[k], self._decode(v)) for k, v in ret.items())
+
+    async def close(self, **kwargs):
+        self._cache.disconnect_all()
+
+    async def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        # memcached doesn't support a negative delta
+        if delta < 0:
+            val = await self._cache.decr(key, -delta)
+        else:
+            val = await self._cache.incr(key, delta)
+        if val is None:
+            raise ValueError("Key '%s' not found" % key)
+        return val
+
+    async def decr(self, key, delta=1, version=None):
+        return await self.incr(key, -delta, version=version)
+
+    async def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        safe_data = {}
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            safe_data[key] = self._encode(value)
+        await self._cache.set_multi(safe_data,
+                                    self.get_backend_timeout(timeout))
+        for value in safe_data.values():
+            self._record_size('bytes_in', value)
+
+    async def delete_many(self, keys, version=None):
+        await self._cache.delete_multi(
+            [self.make_key(key, version=version) for key in keys])
+
+    async def clear(self):
+        await self._cache.flush_all()
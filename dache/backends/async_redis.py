@@ -0,0 +1,373 @@
+"""Redis cache backend for asyncio, speaking the Redis protocol over asyncio
+streams. Requires Python 3.5+.
+
+URLs and options are the same as RedisCache's.
+"""
+
+import asyncio
+import hashlib
+import redis
+import socket
+import threading
+import uuid
+
+from .async_base import AsyncBaseCache, AsyncConnectionPool
+from .base import DEFAULT_TIMEOUT
+from .redis import RedisCache, _GLOB_SPECIAL, _pool_key
+
+
+def _pack(args):
+    """Encode a command in the Redis protocol."""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        elif isinstance(arg, float):
+            arg = repr(arg).encode('ascii')
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode('ascii')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+class _Connection(object):
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def execute(self, commands):
+        """Send commands at once and return their replies. Error replies are
+        returned as redis.ResponseError instances.
+        """
+        self.writer.write(b''.join(_pack(args) for args in commands))
+        await self.writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    def close(self):
+        self.writer.close()
+
+    async def _read_reply(self):
+        line = await self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise redis.ConnectionError('Connection closed by server.')
+        kind, line = line[:1], line[1:-2]
+        if kind == b'+':
+            return line
+        if kind == b'-':
+            return redis.ResponseError(line.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(line)
+        if kind == b'$':
+            length = int(line)
+            if length < 0:
+                return None
+            return (await self.reader.readexactly(length + 2))[:-2]
+        if kind == b'*':
+            length = int(line)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise redis.ConnectionError('Protocol error: %r' % (kind + line))
+
+
+class _RedisConnectionPool(AsyncConnectionPool):
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 unix_socket_path=None, max_connections=None,
+                 socket_timeout=None, socket_connect_timeout=None,
+                 socket_keepalive=False, socket_keepalive_options=None,
+                 retry_on_timeout=False):
+        super(_RedisConnectionPool, self).__init__(max_connections)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.unix_socket_path = unix_socket_path
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.socket_keepalive = socket_keepalive
+        self.socket_keepalive_options = socket_keepalive_options or {}
+        self.retry_on_timeout = retry_on_timeout
+
+    async def execute(self, commands):
+        """Run commands in a single round-trip and return their replies.
+        Raise the first error reply, if any.
+        """
+        async def execute(connection):
+            return await asyncio.wait_for(connection.execute(commands),
+                                          self.socket_timeout)
+        try:
+            replies = await self._run(execute)
+        except asyncio.TimeoutError:
+            if not self.retry_on_timeout:
+                raise redis.TimeoutError('Timeout reading from server')
+            replies = await self._run(execute)
+        for reply in replies:
+            if isinstance(reply, redis.ResponseError):
+                raise reply
+        return replies
+
+    async def connect(self):
+        if self.unix_socket_path is not None:
+            opening = asyncio.open_unix_connection(self.unix_socket_path)
+        else:
+            opening = asyncio.open_connection(self.host, self.port)
+        try:
+            reader, writer = await asyncio.wait_for(
+                opening, self.socket_connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise redis.ConnectionError('Error connecting to Redis: %s' % e)
+
+        sock = writer.get_extra_info('socket')
+        if (self.socket_keepalive and sock is not None and
+                self.unix_socket_path is None):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for option, value in self.socket_keepalive_options.items():
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+        connection = _Connection(reader, writer)
+        commands = []
+        if self.password:
+            commands.append(('AUTH', self.password))
+        if self.db:
+            commands.append(('SELECT', self.db))
+        if commands:
+            try:
+                replies = await asyncio.wait_for(
+                    connection.execute(commands), self.socket_timeout)
+            except BaseException:
+                connection.close()
+                raise
+            for reply in replies:
+                if isinstance(reply, redis.ResponseError):
+                    connection.close()
+                    raise reply
+        return connection
+
+    async def _run(self, func):
+        try:
+            return await self.run(func)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise redis.ConnectionError('Error communicating with Redis: %s'
+                                        % e)
+
+
+# Connection pools shared by all asyncio caches of this process, keyed by
+# their connection parameters
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(**params):
+    """Return the connection pool of the given parameters, creating it the
+    first time.
+    """
+    key = _pool_key(params)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = _RedisConnectionPool(**params)
+        return _pools[key]
+
+
+class _Script(object):
+    """A Lua script, run with EVALSHA, then EVAL once if the server doesn't
+    have it cached.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+
+    async def __call__(self, keys, args, client):
+        try:
+            return await client.execute_command('EVALSHA', self.sha,
+                                                len(keys), *(keys + args))
+        except redis.ResponseError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        return await client.execute_command('EVAL', self.script, len(keys),
+                                            *(keys + args))
+
+
+class _Client(object):
+
+    def __init__(self, connection_pool):
+        self.connection_pool = connection_pool
+
+    async def execute_command(self, *args):
+        return (await self.connection_pool.execute([args]))[0]
+
+    async def execute_many(self, commands):
+        return await self.connection_pool.execute(commands)
+
+    def register_script(self, script):
+        return _Script(script)
+
+
+def _set_args(redis_key, value, expiry, *flags):
+    args = ['SET', redis_key, value]
+    for name, seconds in expiry.items():
+        args.extend((name.upper(), seconds))
+    return args + list(flags)
+
+
+class AsyncRedisCache(AsyncBaseCache, RedisCache):
+
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._get_redis_key(key, version)
+        client = self._get_client(key)
+        expiry = self._get_expiry(timeout)
+        if expiry is None:
+            # Expires immediately, so it's only "added" if it was missing
+            return not await client.execute_command('EXISTS', key)
+
+        value = self._encode(value)
+        added = await client.execute_command(
+            *_set_args(key, value, expiry, 'NX'))
+        if added is not None:
+            self._record('bytes_in', len(value))
+        return added is not None
+
+    async def get(self, key, default=None, version=None):
+        key = self._get_redis_key(key, version)
+
+        value = await self._get_client(key).execute_command('GET', key)
+        if not value:
+            return default
+
+        self._record('bytes_out', len(value))
+        return self._decode(value)
+
+    async def get_many(self, keys, version=None):
+        keys = dict((self._get_redis_key(key, version), key) for key in keys)
+
+        async def mget(client, redis_keys):
+            values = await client.execute_command('MGET', *redis_keys)
+            return zip(redis_keys, values)
+
+        d = {}
+        for values in await asyncio.gather(*[
+                mget(client, redis_keys)
+                for client, redis_keys in self._group_by_client(keys)]):
+            for redis_key, value in values:
+                if not value:
+                    continue
+                self._record('bytes_out', len(value))
+                value = self._decode(value)
+                if value is not None:
+                    d[keys[redis_key]] = value
+        return d
+
+    async def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._get_redis_key(key, version)
+        await self._get_client(key).execute_command(
+            *self._set_command(key, value, timeout))
+
+    async def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        data = dict((self._get_redis_key(key, version), value)
+                    for key, value in data.items())
+        # A single round-trip per server
+        await asyncio.gather(*[
+            client.execute_many([
+                self._set_command(redis_key, data[redis_key], timeout)
+                for redis_key in redis_keys])
+            for client, redis_keys in self._group_by_client(data)])
+
+    async def delete(self, key, version=None):
+        key = self._get_redis_key(key, version)
+        await self._get_client(key).execute_command('DEL', key)
+
+    async def delete_many(self, keys, version=None):
+        redis_keys = [self._get_redis_key(key, version) for key in keys]
+        await asyncio.gather(*[
+            client.execute_command('DEL', *group)
+            for client, group in self._group_by_client(redis_keys)])
+
+    async def has_key(self, key, version=None):
+        key = self._get_redis_key(key, version)
+        return bool(await self._get_client(key).execute_command('EXISTS',
+                                                                key))
+
+    async def incr(self, key, delta=1, version=None):
+        redis_key = self._get_redis_key(key, version)
+        client = self._get_client(redis_key)
+        try:
+            value = await self._incr_script(keys=[redis_key], args=[delta],
+                                            client=client)
+        except redis.ResponseError:
+            # Not an integer stored as such, or delta isn't an integer
+            while True:
+                stored = await client.execute_command('GET', redis_key)
+                if not stored:
+                    break
+                value, args = self._replace_args(stored, delta)
+                if await self._replace_script(keys=[redis_key], args=args,
+                                              client=client):
+                    return value
+            value = None
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+        return value
+
+    async def clear(self):
+        clients = list(self._clients.values())
+        if self._clear_mode == 'prefix':
+            await asyncio.gather(*[self._clear_prefix(client)
+                                   for client in clients])
+        else:
+            await asyncio.gather(*[client.execute_command('FLUSHDB')
+                                   for client in clients])
+
+    async def close(self, **kwargs):
+        for client in self._clients.values():
+            client.connection_pool.disconnect()
+
+    async def _clear_prefix(self, client):
+        """Delete the keys of this cache in batches found with SCAN."""
+        pattern = '%s:*' % _GLOB_SPECIAL.sub(r'\\\1', self.key_prefix)
+        cursor = b'0'
+        while True:
+            cursor, redis_keys = await client.execute_command(
+                'SCAN', cursor, 'MATCH', pattern,
+                'COUNT', self._clear_batch_size)
+            if redis_keys:
+                await self._unlink(client, redis_keys)
+            if cursor == b'0':
+                break
+
+    async def _unlink(self, client, redis_keys):
+        """Delete keys, reclaiming their memory in the background."""
+        try:
+            await client.execute_command('UNLINK', *redis_keys)
+        except redis.ResponseError:
+            # UNLINK requires Redis 4.0
+            await client.execute_command('DEL', *redis_keys)
+
+    async def _acquire_lock(self, key, version, timeout):
+        redis_key = self._get_redis_key('%s.lock' % key, version)
+        client = self._get_client(redis_key)
+        token = uuid.uuid4().hex
+        if await client.execute_command(
+                *_set_args(redis_key, token,
+                           {'px': max(1, int(timeout * 1000))}, 'NX')):
+            return client, redis_key, token
+        return None
+
+    async def _release_lock(self, handle):
+        client, redis_key, token = handle
+        await self._unlock_script(keys=[redis_key], args=[token],
+                                  client=client)
+
+    def _create_client(self, params):
+        return _Client(_get_pool(**params))
+
+    def _set_command(self, redis_key, value, timeout):
+        """Return the command storing a value."""
+        value = self._encode(value)
+        self._record('bytes_in', len(value))
+        expiry = self._get_expiry(timeout)
+        if expiry is None:
+            # Expires immediately, which SET doesn't accept
+            return ['DEL', redis_key]
+        return _set_args(redis_key, value, expiry)
@@ -1,7 +1,12 @@
+import struct
+import threading
 import time
 import warnings
 
+from dache.compressors import compress, decompress, get_compressor
+from dache.serializers import get_serializer
 from dache.utils.module_loading import import_string
+from dache.utils.stats import CacheStats
 
 
 class InvalidCacheBackendError(Exception):
@@ -19,6 +24,57 @@ DEFAULT_TIMEOUT = object()
 # Memcached does not accept keys longer than this.
 MEMCACHE_MAX_KEY_LENGTH = 250
 
+# Marker for a key missing from the cache
+_missing = object()
+
+# Seconds between attempts to take the lock of a key in get_or_set()
+_LOCK_POLL_INTERVAL = 0.05
+
+# Values stored by the file-based and LevelDB backends start with a
+# fixed-size header holding a magic string and the expiry timestamp, infinity
+# meaning the entry never expires. Values without a valid header are treated
+# as expired.
+_HEADER = struct.Struct('!4s4xd')
+_MAGIC = b'DCH1'
+
+
+def _pack_header(expiry):
+    """Return the header of a value expiring at the given timestamp, or
+    never if it's None.
+    """
+    return _HEADER.pack(_MAGIC, float('inf') if expiry is None else expiry)
+
+
+def _unpack_expiry(data):
+    """Return the expiry timestamp of a value given at least its header, or
+    None if the header isn't valid.
+    """
+    if len(data) >= _HEADER.size:
+        magic, expiry = _HEADER.unpack_from(data)
+        if magic == _MAGIC:
+            return expiry
+    return None
+
+
+class _EntryCount(object):
+    """Approximate number of entries of a cache, shared by the caches of
+    this process using the same storage.
+    """
+
+    def __init__(self):
+        self.count = None
+        self.counted_at = 0
+
+
+class _Flight(object):
+    """A computation of the value of a key by get_or_set(), which the other
+    callers of the same key wait for.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.failed = False
+        self.value = None
+
 
 def default_key_func(key, key_prefix, version):
     """Default function to generate keys.
@@ -45,8 +101,14 @@ def get_key_func(key_func):
 
 class BaseCache(object):
 
+    # Whether the backend can store values without a serializer, which is
+    # requested with serializer=None
+    serializer_optional = False
+
     def __init__(self, key_prefix='', timeout=None, version=1, key_func=None,
-                 max_entries=300, cull_frequency=3):
+                 max_entries=300, cull_frequency=3, stats=False,
+                 serializer='pickle', compressor=None, compress_level=None,
+                 compress_min_size=1024):
         self.default_timeout = 300
         if timeout is not None:
             self.default_timeout = timeout
@@ -56,6 +118,26 @@ class BaseCache(object):
         self.key_func = get_key_func(key_func)
         self._max_entries = max_entries
         self._cull_frequency = cull_frequency
+        self._serializer = get_serializer(serializer)
+        if self._serializer is None and not self.serializer_optional:
+            raise ValueError('%s requires a serializer' %
+                             self.__class__.__name__)
+
+        # Serialized values shorter than compress_min_size are stored
+        # uncompressed, since compressing them costs more than it saves
+        self._compressor = get_compressor(compressor, compress_level)
+        self._compress_min_size = compress_min_size
+
+        # Statistics are opt-in; when enabled the public methods of this
+        # instance are wrapped to record hits, misses and latencies
+        self._stats = None
+        if stats:
+            self._stats = CacheStats()
+            self._stats.instrument(self)
+
+        # Computations of get_or_set() in progress, keyed by cache key
+        self._flights = {}
+        self._flights_lock = threading.Lock()
 
     def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
         """Return the timeout value usable by this backend based upon the
@@ -101,6 +183,50 @@ class BaseCache(object):
         raise NotImplementedError(
             'subclasses of BaseCache must provide a get() method')
 
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None,
+                   lock=False, lock_timeout=10):
+        """Fetch a given key from the cache. If the key does not exist, set it
+        to default, or to the result of calling default if it's callable, and
+        return that value.
+
+        Concurrent callers for the same key wait for a single computation.
+        With lock=True, so do the callers of other processes, through a lock
+        held for at most lock_timeout seconds. Callers waiting for longer
+        than lock_timeout compute the value themselves.
+        """
+        while True:
+            value = self.get(key, _missing, version=version)
+            if value is not _missing:
+                return value
+
+            flight_key = self.make_key(key, version=version)
+            with self._flights_lock:
+                flight = self._flights.get(flight_key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[flight_key] = _Flight()
+            if leader:
+                break
+            if not flight.done.wait(lock_timeout):
+                # The computation hangs, stop waiting for it
+                return self._compute(key, default, timeout, version, lock,
+                                     lock_timeout)
+            if not flight.failed:
+                return flight.value
+            # The computation raised an exception, try again
+
+        try:
+            flight.value = self._compute(key, default, timeout, version, lock,
+                                         lock_timeout)
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[flight_key]
+            flight.done.set()
+        return flight.value
+
     def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         """Set a value in the cache. If timeout is given, that timeout will be
         used for the key; otherwise the default cache timeout will be used.
@@ -220,3 +346,84 @@ class BaseCache(object):
     def close(self, **kwargs):
         """Close the cache connection."""
         pass
+
+    def stats(self, reset=False):
+        """Return a dict of the statistics recorded so far: hits, misses,
+        sets, deletes, evictions, expirations, bytes_in (written to the cache)
+        and bytes_out (read from the cache), plus a 'latency' dict mapping
+        every operation to its call count, total seconds and histogram.
+
+        Return None if the cache was not created with stats=True. If reset is
+        True, the statistics start over afterwards.
+        """
+        if self._stats is None:
+            return None
+        result = self._stats.as_dict()
+        if reset:
+            self._stats.reset()
+        return result
+
+    def _compute(self, key, default, timeout, version, lock, lock_timeout):
+        """Set a missing key to default, or the result of calling it, and
+        return that value. With lock, wait for the lock of the key first,
+        unless another process sets the key meanwhile.
+        """
+        handle = None
+        if lock:
+            deadline = time.time() + lock_timeout
+            while True:
+                handle = self._acquire_lock(key, version, lock_timeout)
+                if handle is not None or time.time() >= deadline:
+                    break
+                time.sleep(_LOCK_POLL_INTERVAL)
+                value = self.get(key, _missing, version=version)
+                if value is not _missing:
+                    return value
+        try:
+            if handle is not None:
+                # The previous holder of the lock may have set the key
+                value = self.get(key, _missing, version=version)
+                if value is not _missing:
+                    return value
+            value = default() if callable(default) else default
+            self.set(key, value, timeout, version)
+            return value
+        finally:
+            if handle is not None:
+                self._release_lock(handle)
+
+    def _acquire_lock(self, key, version, timeout):
+        """Take the lock of a key, expiring after timeout seconds, without
+        waiting. Return a handle for _release_lock(), or None if the lock is
+        held by someone else.
+
+        The lock is an entry added next to the key, which relies on add()
+        being atomic.
+        """
+        lock_key = '%s.lock' % key
+        if self.add(lock_key, 1, timeout, version):
+            return lock_key, version
+        return None
+
+    def _release_lock(self, handle):
+        self.delete(*handle)
+
+    def _dumps(self, value):
+        """Serialize, then compress if enabled, a value before it's stored."""
+        data = self._serializer.dumps(value)
+        if self._compressor is not None:
+            data = compress(data, self._compressor, self._compress_min_size)
+        return data
+
+    def _loads(self, data):
+        """Decompress if enabled, then deserialize, bytes read from the
+        backend.
+        """
+        if self._compressor is not None:
+            data = decompress(data, self._compressor)
+        return self._serializer.loads(data)
+
+    def _record(self, name, delta=1):
+        """Add delta to a statistics counter, if statistics are enabled."""
+        if self._stats is not None:
+            self._stats.incr(name, delta)
@@ -5,53 +5,78 @@ import glob
 import hashlib
 import io
 import os
-import random
 import tempfile
 import time
-import zlib
 
-from six.moves import cPickle as pickle
-
-from .base import BaseCache, DEFAULT_TIMEOUT
+from .base import (BaseCache, DEFAULT_TIMEOUT, _EntryCount, _HEADER,
+                   _pack_header, _unpack_expiry)
+from dache.utils import locks
 from dache.utils.files import file_move_safe
 from dache.utils.encoding import force_bytes
 
 
+# Entry counts of cache directories, keyed by path, shared by all caches of
+# this process using the same directory
+_entry_counts = {}
+
+
 class FileBasedCache(BaseCache):
 
     cache_suffix = '.pickle'
+    lock_suffix = '.lock'
+
+    # Seconds after which the entry count is refreshed from the directory
+    # listing, to account for other processes writing to the same directory
+    count_refresh_interval = 60
 
-    def __init__(self, url, **options):
+    def __init__(self, url, directory_depth=0, **options):
+        options.setdefault('compressor', 'zlib')
         super(FileBasedCache, self).__init__(**options)
 
         self._dir = os.path.abspath(url.path)
         self._createdir()
+        self._entry_count = _entry_counts.setdefault(self._dir, _EntryCount())
+
+        # Number of fan-out directory levels, named after 2 hex characters
+        # of the key hash each. With a depth of 2, a key is stored in
+        # ab/cd/abcd<...>.pickle so no directory grows too large.
+        self._directory_depth = directory_depth
 
     def get(self, key, default=None, version=None):
         fname = self._key_to_file(key, version)
-        if os.path.exists(fname):
-            try:
-                with io.open(fname, 'rb') as f:
-                    if not self._is_expired(f):
-                        return pickle.loads(zlib.decompress(f.read()))
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    pass  # Cache file was removed after the exists check
-        return default
+        try:
+            with io.open(fname, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return default
+        if self._is_expired(fname, data):
+            return default
+        data = data[_HEADER.size:]
+        self._record('bytes_out', len(data))
+        return self._loads(data)
 
     def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         self._createdir()  # Cache dir can be deleted at any time.
         fname = self._key_to_file(key, version)
-        self._cull()  # make some room if necessary
+        is_new = not os.path.exists(fname)
+        if is_new:
+            self._cull()  # make some room if necessary
         fd, tmp_path = tempfile.mkstemp(dir=self._dir)
         renamed = False
         try:
             with io.open(fd, 'wb') as f:
                 expiry = self.get_backend_timeout(timeout)
-                f.write(pickle.dumps(expiry, -1))
-                f.write(zlib.compress(pickle.dumps(value), -1))
+                data = self._dumps(value)
+                f.write(_pack_header(expiry) + data)
+                self._record('bytes_in', len(data))
+            if self._directory_depth:
+                self._createdir(os.path.dirname(fname))
             file_move_safe(tmp_path, fname, allow_overwrite=True)
             renamed = True
+            if is_new and self._entry_count.count is not None:
+                self._entry_count.count += 1
         finally:
             if not renamed:
                 os.remove(tmp_path)
@@ -69,53 +94,133 @@ class FileBasedCache(BaseCache):
             # process) after the os.path.exists check.
             if e.errno != errno.ENOENT:
                 raise
+        else:
+            if self._entry_count.count:
+                self._entry_count.count -= 1
 
     def has_key(self, key, version=None):
         fname = self._key_to_file(key, version)
-        if os.path.exists(fname):
-            with io.open(fname, 'rb') as f:
-                return not self._is_expired(f)
-        return False
+        header = self._read_header(fname)
+        return header is not None and not self._is_expired(fname, header)
+
+    def _acquire_lock(self, key, version, timeout):
+        """Take an exclusive lock of a file next to the cache file of the
+        key. The lock goes away with the process holding it, so it doesn't
+        need to expire.
+        """
+        if not locks.LOCK_EX:
+            # File locking isn't supported on this platform
+            return super(FileBasedCache, self)._acquire_lock(key, version,
+                                                             timeout)
+        fname = self._key_to_file(key, version)
+        fname = fname[:-len(self.cache_suffix)] + self.lock_suffix
+        self._createdir(os.path.dirname(fname))
+        f = open(fname, 'ab')
+        try:
+            locked = locks.lock(f, locks.LOCK_EX | locks.LOCK_NB)
+            # The file may have been removed by the previous holder after
+            # it was opened here, then locked by someone else
+            locked = locked and os.path.samestat(os.fstat(f.fileno()),
+                                                 os.stat(fname))
+        except (IOError, OSError):
+            locked = False
+        if not locked:
+            f.close()
+            return None
+        return f, fname
+
+    def _release_lock(self, handle):
+        f, fname = handle
+        try:
+            # Removed while still locked, so that nobody locks it anymore
+            os.remove(fname)
+        except OSError:
+            pass
+        locks.unlock(f)
+        f.close()
 
     def _cull(self):
-        """Remove random cache entries if max_entries is reached at a ratio
-        of num_entries / cull_frequency. A value of 0 for CULL_FREQUENCY means
-        that the entire cache will be purged.
+        """Remove cache entries if max_entries is reached at a ratio of
+        num_entries / cull_frequency. Expired entries go first, then the least
+        recently used ones according to the file access and modification
+        times. A value of 0 for CULL_FREQUENCY means that the entire cache
+        will be purged.
+
+        The directory is only listed when the tracked entry count reaches
+        max_entries or hasn't been refreshed for count_refresh_interval.
         """
         if self._max_entries is None:
             # No limit on number of entries
             return
 
+        entry_count = self._entry_count
+        if (entry_count.count is not None and
+                entry_count.count < self._max_entries and
+                time.time() - entry_count.counted_at <
+                self.count_refresh_interval):
+            return  # return early without listing the directory
+
         filelist = self._list_cache_files()
         num_entries = len(filelist)
+        entry_count.count = num_entries
+        entry_count.counted_at = time.time()
         if num_entries < self._max_entries:
             return  # return early if no culling is required
         if self._cull_frequency == 0:
             return self.clear()  # Clear the cache when CULL_FREQUENCY = 0
-        # Delete a random selection of entries
-        filelist = random.sample(filelist,
-                                 int(num_entries / self._cull_frequency))
+        num_doomed = int(num_entries / self._cull_frequency)
+
+        # Delete expired entries, reading only their expiry header. The
+        # access time is taken first since reading the header updates it.
+        survivors = []
         for fname in filelist:
+            last_used = self._last_used(fname)
+            header = self._read_header(fname)
+            if header is None or self._is_expired(fname, header):
+                # Expired, or removed by another process meanwhile
+                num_doomed -= 1
+                continue
+            survivors.append((last_used, fname))
+        if num_doomed <= 0:
+            return
+
+        # Then the least recently used ones
+        survivors.sort()
+        for _, fname in survivors[:num_doomed]:
             self._delete(fname)
+        self._record('evictions', len(survivors[:num_doomed]))
 
-    def _createdir(self):
-        if not os.path.exists(self._dir):
+    def _last_used(self, fname):
+        """Approximate time a cache file was last read or written."""
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return 0
+        return max(st.st_atime, st.st_mtime)
+
+    def _createdir(self, path=None):
+        path = path or self._dir
+        if not os.path.exists(path):
             try:
-                os.makedirs(self._dir, 0o700)
+                os.makedirs(path, 0o700)
             except OSError as e:
                 if e.errno != errno.EEXIST:
                     raise EnvironmentError(
                         "Cache directory '%s' does not exist "
-                        "and could not be created'" % self._dir)
+                        "and could not be created'" % path)
 
     def _key_to_file(self, key, version=None):
         """Convert a key into a cache file path. Basically this is the root
-        cache path joined with the md5sum of the key and a suffix.
+        cache path joined with the fan-out directories and the md5sum of the
+        key and a suffix.
         """
         key = self.make_key(key, version=version)
         self.validate_key(key)
-        return os.path.join(self._dir, ''.join(
-            [hashlib.md5(force_bytes(key)).hexdigest(), self.cache_suffix]))
+        digest = hashlib.md5(force_bytes(key)).hexdigest()
+        parts = [digest[i * 2:i * 2 + 2]
+                 for i in range(self._directory_depth)]
+        parts.append(''.join([digest, self.cache_suffix]))
+        return os.path.join(self._dir, *parts)
 
     def clear(self):
         """Remove all the cache files."""
@@ -123,17 +228,38 @@ class FileBasedCache(BaseCache):
             return
         for fname in self._list_cache_files():
             self._delete(fname)
+        self._entry_count.count = 0
+        # Remove the fan-out directories left empty, deepest first
+        for depth in range(self._directory_depth, 0, -1):
+            for dirname in glob.glob(self._fanout_pattern(depth)):
+                try:
+                    os.rmdir(dirname)
+                except OSError:
+                    pass  # Not empty or already removed
+
+    def _read_header(self, fname):
+        """Read the header of a cache file with a single unbuffered read.
+        Return None if the file doesn't exist.
+        """
+        try:
+            with io.open(fname, 'rb', buffering=0) as f:
+                return f.read(_HEADER.size)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
 
-    def _is_expired(self, f):
-        """Take an open cache file and determines if it has expired, deletes
-        the file if it is has passed its expiry time.
+    def _is_expired(self, fname, data):
+        """Take the content of a cache file, or at least its header, and
+        determine if it has expired. Delete the file if it has passed its
+        expiry time. The file must be closed, as required on Windows.
         """
-        exp = pickle.load(f)
-        if exp is not None and exp < time.time():
-            f.close()  # On Windows a file has to be closed before deleting
-            self._delete(f.name)
-            return True
-        return False
+        expiry = _unpack_expiry(data)
+        if expiry is not None and expiry >= time.time():
+            return False
+        self._delete(fname)
+        self._record('expirations')
+        return True
 
     def _list_cache_files(self):
         """Get a list of paths to all the cache files. These are all the files
@@ -141,6 +267,14 @@ class FileBasedCache(BaseCache):
         """
         if not os.path.exists(self._dir):
             return []
+        if self._directory_depth:
+            return glob.glob(os.path.join(
+                self._fanout_pattern(self._directory_depth),
+                '*%s' % self.cache_suffix))
         filelist = [os.path.join(self._dir, fname) for fname
                     in glob.glob1(self._dir, '*%s' % self.cache_suffix)]
         return filelist
+
+    def _fanout_pattern(self, depth):
+        """Glob pattern matching the fan-out directories at a depth."""
+        return os.path.join(self._dir, *(['[0-9a-f][0-9a-f]'] * depth))
@@ -7,11 +7,11 @@ import leveldb
 import os
 import random
 import shutil
+import threading
 import time
 
-from six.moves import cPickle as pickle
-
-from .base import BaseCache, DEFAULT_TIMEOUT
+from .base import (BaseCache, DEFAULT_TIMEOUT, _HEADER, _pack_header,
+                   _unpack_expiry)
 from dache.utils.encoding import force_bytes
 
 
@@ -21,35 +21,45 @@ class LevelDBCache(BaseCache):
     # are LevelDB instances. LevelDB doesn't support multiprocessing and every
     # process can only have one connection at a time.
     _dbs = {}
+    # Opening a directory twice fails, so threads open it one at a time
+    _dbs_lock = threading.Lock()
+    # Only one process can open a directory, so this lock is enough to make
+    # add() atomic
+    _add_lock = threading.Lock()
 
     def __init__(self, url, **options):
         super(LevelDBCache, self).__init__(**options)
 
         self._dir = os.path.abspath(url.path)
 
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._add_lock:
+            return super(LevelDBCache, self).add(key, value, timeout, version)
+
     def get(self, key, default=None, version=None):
         key = self._make_and_validate_key(key, version)
         try:
-            wrapper = self._db.Get(key)
+            data = bytes(self._db.Get(key))
         except KeyError:
             return default
 
-        wrapper = pickle.loads(wrapper)
-        timeout = wrapper['timeout']
-        if timeout is not None and timeout < time.time():
-            self._db.Delete(key)
-            return default
+        expiry = _unpack_expiry(data)
+        if expiry is not None and expiry >= time.time():
+            data = data[_HEADER.size:]
+            self._record('bytes_out', len(data))
+            return self._loads(data)
 
-        return wrapper['value']
+        self._db.Delete(key)
+        self._record('expirations')
+        return default
 
     def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self._make_and_validate_key(key, version)
         self._cull()  # Make room if necessary
-        wrapper = {
-            'timeout': self.get_backend_timeout(timeout),
-            'value': value
-        }
-        self._db.Put(key, pickle.dumps(wrapper))
+        data = self._dumps(value)
+        self._db.Put(key, _pack_header(self.get_backend_timeout(timeout)) +
+                     data)
+        self._record('bytes_in', len(data))
 
     def delete(self, key, version=None):
         key = self._make_and_validate_key(key, version)
@@ -63,18 +73,20 @@ class LevelDBCache(BaseCache):
         # Remove the global reference to LevelDB instance so that it can be
         # re-created, otherwise the old keys will still be there even if files
         # no longer exist
-        self._dbs.pop(self._dir, None)
+        with self._dbs_lock:
+            self._dbs.pop(self._dir, None)
 
     @property
     def _db(self):
-        created = self._createdir()
-        if self._dir in self._dbs:
-            if created:
-                del self._dbs[self._dir]
+        with self._dbs_lock:
+            created = self._createdir()
+            if self._dir in self._dbs:
+                if created:
+                    del self._dbs[self._dir]
+                    self._dbs[self._dir] = leveldb.LevelDB(self._dir)
+            else:
                 self._dbs[self._dir] = leveldb.LevelDB(self._dir)
-        else:
-            self._dbs[self._dir] = leveldb.LevelDB(self._dir)
-        return self._dbs[self._dir]
+            return self._dbs[self._dir]
 
     def _make_and_validate_key(self, key, version):
         key = self.make_key(key, version=version)
@@ -98,6 +110,7 @@ class LevelDBCache(BaseCache):
         keys = random.sample(keys, int(num_entries / self._cull_frequency))
         for key in keys:
             self._db.Delete(key)
+        self._record('evictions', len(keys))
 
     def _createdir(self):
         if not os.path.exists(self._dir):
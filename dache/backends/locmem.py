@@ -1,134 +1,405 @@
 """Thread-safe in-memory cache backend."""
 
+import heapq
+import six
+import sys
+import threading
 import time
 
 from six.moves import cPickle as pickle
 
 from .base import BaseCache, DEFAULT_TIMEOUT
+from dache.utils.eviction import get_eviction_policy
+from dache.utils.heap import heapremove
 from dache.utils.synch import RWLock
 
 
 # Global in-memory store of cache data. Keyed by name, to provide
-# multiple named local memory caches.
-_caches = {}
-_expire_info = {}
-_locks = {}
+# multiple named local memory caches. Every cache is a list of stripes.
+_stripes = {}
+_sweepers = {}
+
+# Values of these exact types are immutable, so they are stored as they are
+# instead of being serialized. Bytes are left out because serialized values
+# are bytes too.
+_IMMUTABLE_TYPES = frozenset(six.integer_types + (
+    bool, float, complex, six.text_type, type(None)))
+
+# Marker for a key missing from the cache
+_missing = object()
+
+
+class _Stripe(object):
+    """A partition of a named cache. Every stripe has its own lock, so writers
+    to different stripes don't block each other.
+    """
+    def __init__(self, policy):
+        self.cache = {}
+        self.expire_info = {}
+        self.lock = RWLock()
+        self.policy = policy
+
+        # Min-heap of (expiry, key) used to find expired entries without
+        # scanning the whole cache. Entries may be stale if the key has been
+        # overwritten or deleted since; those are skipped when popped, or
+        # dropped a few at a time once they outnumber the live ones.
+        self.expiry_heap = []
+        self.compact_pos = 0
+
+        # Size of every stored value, and their total
+        self.sizes = {}
+        self.usage = 0
+
+
+def _sweep(cache, interval):
+    """Periodically reap expired entries of a cache, one bounded batch per
+    writer lock acquisition so readers never wait long.
+    """
+    while True:
+        time.sleep(interval)
+        for stripe in cache._stripes:
+            reaped = cache.reap_batch
+            while reaped == cache.reap_batch:
+                with stripe.lock.writer():
+                    reaped = cache._reap(stripe)
 
 
 class LocMemCache(BaseCache):
 
-    def __init__(self, url, **options):
+    # Maximum number of expiry index entries examined per reap
+    reap_batch = 16
+
+    serializer_optional = True
+
+    def __init__(self, url, eviction='lru', sweep_interval=None,
+                 max_bytes=None, store_references=False, shards=1,
+                 **options):
         super(LocMemCache, self).__init__(**options)
 
         # locmem://abcd:1234/efg -> abcd:1234/efg
         name = url.geturl()[len(url.scheme) + 3:]
 
-        self._cache = _caches.setdefault(name, {})
-        self._expire_info = _expire_info.setdefault(name, {})
-        self._lock = _locks.setdefault(name, RWLock())
+        # Store values by reference rather than serializing them, also
+        # enabled by serializer=None. Callers must not mutate values after
+        # setting them or after getting them, and all caches sharing a name
+        # must use the same mode.
+        self._store_references = store_references or self._serializer is None
+
+        # Stripes are shared by all caches with the same name, so the first
+        # one created decides the number of shards and the eviction policy
+        if name not in _stripes:
+            policy_class = get_eviction_policy(eviction)
+            _stripes.setdefault(name, [_Stripe(policy_class())
+                                       for _ in range(shards)])
+        self._stripes = _stripes[name]
+
+        # Limits are enforced per stripe
+        num_stripes = len(self._stripes)
+        self._max_bytes = max_bytes
+        self._stripe_max_entries = self._stripe_max_bytes = None
+        if self._max_entries is not None:
+            self._stripe_max_entries = -(-self._max_entries // num_stripes)
+        if max_bytes is not None:
+            self._stripe_max_bytes = max_bytes // num_stripes
+
+        # A background sweeper is optional, otherwise expired entries are
+        # reaped incrementally on writes
+        if sweep_interval is not None and name not in _sweepers:
+            sweeper = threading.Thread(target=_sweep,
+                                       args=(self, sweep_interval))
+            sweeper.daemon = True
+            sweeper.start()
+            _sweepers[name] = sweeper
 
     def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self.make_key(key, version=version)
         self.validate_key(key)
-        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
-        with self._lock.writer():
-            if self._has_expired(key):
-                self._set(key, pickled, timeout)
+        encoded = self._encode(value)
+        stripe = self._get_stripe(key)
+        with stripe.lock.writer():
+            if self._has_expired(stripe, key):
+                self._set(stripe, key, encoded, timeout)
                 return True
             return False
 
     def get(self, key, default=None, version=None):
         key = self.make_key(key, version=version)
         self.validate_key(key)
-        pickled = None
-        with self._lock.reader():
-            if not self._has_expired(key):
-                pickled = self._cache[key]
-        if pickled is not None:
+        stripe = self._get_stripe(key)
+        encoded = _missing
+        with stripe.lock.reader():
+            if not self._has_expired(stripe, key):
+                encoded = stripe.cache[key]
+                stripe.policy.access(key)
+            expired = key in stripe.expire_info
+        if encoded is not _missing:
+            self._record('bytes_out', self._sizeof(encoded))
             try:
-                return pickle.loads(pickled)
+                return self._decode(encoded)
             except pickle.PickleError:
                 return default
 
-        with self._lock.writer():
+        if expired:
+            self._expire_if_expired(stripe, key)
+        return default
+
+    def get_many(self, keys, version=None):
+        found = []
+        for stripe, pairs in self._group_by_stripe(keys, version):
+            expired = []
+            with stripe.lock.reader():
+                for key, cache_key in pairs:
+                    if self._has_expired(stripe, cache_key):
+                        if cache_key in stripe.expire_info:
+                            expired.append(cache_key)
+                    else:
+                        found.append((key, stripe.cache[cache_key]))
+                        stripe.policy.access(cache_key)
+            if expired:
+                with stripe.lock.writer():
+                    for cache_key in expired:
+                        # It may have been set again in the meantime
+                        if self._has_expired(stripe, cache_key):
+                            self._expire(stripe, cache_key)
+
+        # Deserialize outside of the locks
+        d = {}
+        for key, encoded in found:
+            self._record('bytes_out', self._sizeof(encoded))
             try:
-                del self._cache[key]
-                del self._expire_info[key]
-            except KeyError:
-                pass
-            return default
-
-    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
-        if (self._max_entries is not None and
-                len(self._cache) >= self._max_entries):
-            self._cull()
-        self._cache[key] = value
-        self._expire_info[key] = self.get_backend_timeout(timeout)
+                value = self._decode(encoded)
+            except pickle.PickleError:
+                continue
+            if value is not None:
+                d[key] = value
+        return d
+
+    @property
+    def bytes_used(self):
+        """Total size in bytes of the values stored in the cache."""
+        return sum(stripe.usage for stripe in self._stripes)
+
+    def _set(self, stripe, key, value, timeout=DEFAULT_TIMEOUT):
+        self._reap(stripe)
+        size = self._sizeof(value)
+        max_bytes = self._stripe_max_bytes
+        if max_bytes is not None and size > max_bytes:
+            # The value can never fit, don't leave a stale one behind either
+            self._delete(stripe, key)
+            return
+        if (self._stripe_max_entries is not None and
+                key not in stripe.cache and
+                len(stripe.cache) >= self._stripe_max_entries):
+            self._cull(stripe)
+        if max_bytes is not None:
+            while (stripe.usage + size - stripe.sizes.get(key, 0) >
+                    max_bytes):
+                self._delete(stripe, stripe.policy.pop())
+                self._record('evictions')
+        self._store(stripe, key, value)
+        self._record('bytes_in', size)
+        expiry = self.get_backend_timeout(timeout)
+        stripe.expire_info[key] = expiry
+        stripe.policy.add(key)
+        if expiry is not None:
+            heapq.heappush(stripe.expiry_heap, (expiry, key))
 
     def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self.make_key(key, version=version)
         self.validate_key(key)
-        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
-        with self._lock.writer():
-            self._set(key, pickled, timeout)
+        encoded = self._encode(value)
+        stripe = self._get_stripe(key)
+        with stripe.lock.writer():
+            self._set(stripe, key, encoded, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        encoded = dict((key, self._encode(value))
+                       for key, value in data.items())
+        for stripe, pairs in self._group_by_stripe(encoded, version):
+            with stripe.lock.writer():
+                for key, cache_key in pairs:
+                    self._set(stripe, cache_key, encoded[key], timeout)
+
+    def delete_many(self, keys, version=None):
+        for stripe, pairs in self._group_by_stripe(keys, version):
+            with stripe.lock.writer():
+                for _, cache_key in pairs:
+                    self._delete(stripe, cache_key)
 
     def incr(self, key, delta=1, version=None):
-        value = self.get(key, version=version)
-        if value is None:
-            raise ValueError("Key '%s' not found" % key)
-        new_value = value + delta
-        key = self.make_key(key, version=version)
-        pickled = pickle.dumps(new_value, pickle.HIGHEST_PROTOCOL)
-        with self._lock.writer():
-            self._cache[key] = pickled
+        cache_key = self.make_key(key, version=version)
+        self.validate_key(cache_key)
+        stripe = self._get_stripe(cache_key)
+        # Read and write under the same lock so concurrent increments don't
+        # get lost. The expiry of the key is left untouched.
+        with stripe.lock.writer():
+            value = None
+            if not self._has_expired(stripe, cache_key):
+                value = self._decode(stripe.cache[cache_key])
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = value + delta
+            self._store(stripe, cache_key, self._encode(new_value))
+            stripe.policy.access(cache_key)
         return new_value
 
     def has_key(self, key, version=None):
         key = self.make_key(key, version=version)
         self.validate_key(key)
-        with self._lock.reader():
-            if not self._has_expired(key):
+        stripe = self._get_stripe(key)
+        with stripe.lock.reader():
+            if not self._has_expired(stripe, key):
                 return True
+            expired = key in stripe.expire_info
 
-        with self._lock.writer():
-            try:
-                del self._cache[key]
-                del self._expire_info[key]
-            except KeyError:
-                pass
-            return False
+        if expired:
+            self._expire_if_expired(stripe, key)
+        return False
+
+    def _get_stripe(self, key):
+        stripes = self._stripes
+        if len(stripes) == 1:
+            return stripes[0]
+        return stripes[hash(key) % len(stripes)]
+
+    def _group_by_stripe(self, keys, version=None):
+        """Make and validate the cache key of every key, then group them by
+        stripe. Return a list of (stripe, [(key, cache_key), ...]).
+        """
+        groups = {}
+        for key in keys:
+            cache_key = self.make_key(key, version=version)
+            self.validate_key(cache_key)
+            stripe = self._get_stripe(cache_key)
+            groups.setdefault(stripe, []).append((key, cache_key))
+        return list(groups.items())
+
+    def _encode(self, value):
+        if self._store_references or type(value) in _IMMUTABLE_TYPES:
+            return value
+        return self._dumps(value)
+
+    def _decode(self, value):
+        if self._store_references or type(value) is not six.binary_type:
+            return value
+        return self._loads(value)
 
-    def _has_expired(self, key):
-        exp = self._expire_info.get(key, -1)
+    def _sizeof(self, value):
+        """Size of a stored value. Exact for serialized values, shallow for
+        values stored as they are.
+        """
+        if type(value) is six.binary_type:
+            return len(value)
+        return sys.getsizeof(value)
+
+    def _store(self, stripe, key, value):
+        size = self._sizeof(value)
+        stripe.usage += size - stripe.sizes.get(key, 0)
+        stripe.sizes[key] = size
+        stripe.cache[key] = value
+
+    def _has_expired(self, stripe, key):
+        exp = stripe.expire_info.get(key, -1)
         if exp is None or exp > time.time():
             return False
         return True
 
-    def _cull(self):
+    def _reap(self, stripe):
+        """Delete expired entries found on top of the expiry heap, examining
+        at most reap_batch heap entries. Return the number examined.
+        """
+        heap = stripe.expiry_heap
+        if len(heap) > 2 * len(stripe.cache) + self.reap_batch:
+            self._compact(stripe)
+
+        now = time.time()
+        examined = 0
+        while examined < self.reap_batch and heap and heap[0][0] <= now:
+            expiry, key = heapq.heappop(heap)
+            if stripe.expire_info.get(key, _missing) == expiry:
+                self._expire(stripe, key)
+            examined += 1
+        return examined
+
+    def _compact(self, stripe):
+        """Drop the stale entries among reap_batch entries of the expiry
+        heap, scanning it backwards from where the previous call stopped.
+        Called while stale entries outnumber live ones, it keeps the heap
+        within twice the size of the stripe.
+        """
+        heap = stripe.expiry_heap
+        pos = stripe.compact_pos
+        if not 0 < pos <= len(heap):
+            pos = len(heap)
+        for _ in range(self.reap_batch):
+            if pos == 0:
+                break
+            pos -= 1
+            expiry, key = heap[pos]
+            if stripe.expire_info.get(key, _missing) == expiry:
+                continue
+            heapremove(heap, pos)
+        stripe.compact_pos = pos
+
+    def _cull(self, stripe):
+        """Evict len(stripe) / cull_frequency entries, at least one, in the
+        order given by the eviction policy. A value of 0 for cull_frequency
+        means that the entire stripe will be purged.
+        """
         if self._cull_frequency == 0:
-            self.clear()
+            self._record('evictions', len(stripe.cache))
+            self._clear(stripe)
         else:
-            doomed = [k for (i, k) in enumerate(self._cache)
-                      if i % self._cull_frequency == 0]
-            for k in doomed:
-                self._delete(k)
+            doomed = max(1, len(stripe.cache) // self._cull_frequency)
+            for _ in range(doomed):
+                self._delete(stripe, stripe.policy.pop())
+            self._record('evictions', doomed)
 
-    def _delete(self, key):
+    def _delete(self, stripe, key):
         try:
-            del self._cache[key]
+            del stripe.cache[key]
         except KeyError:
             pass
         try:
-            del self._expire_info[key]
+            del stripe.expire_info[key]
         except KeyError:
             pass
+        stripe.policy.discard(key)
+        size = stripe.sizes.pop(key, None)
+        if size is not None:
+            stripe.usage -= size
+
+    def _expire(self, stripe, key):
+        """Delete a key known to be expired or missing."""
+        if key in stripe.cache:
+            self._record('expirations')
+            self._delete(stripe, key)
+
+    def _expire_if_expired(self, stripe, key):
+        """Take the writer lock to delete a key found expired under the
+        reader lock, unless it has been set again in the meantime.
+        """
+        with stripe.lock.writer():
+            if self._has_expired(stripe, key):
+                self._expire(stripe, key)
 
     def delete(self, key, version=None):
         key = self.make_key(key, version=version)
         self.validate_key(key)
-        with self._lock.writer():
-            self._delete(key)
+        stripe = self._get_stripe(key)
+        with stripe.lock.writer():
+            self._delete(stripe, key)
+
+    def _clear(self, stripe):
+        stripe.cache.clear()
+        stripe.expire_info.clear()
+        stripe.policy.clear()
+        del stripe.expiry_heap[:]
+        stripe.compact_pos = 0
+        stripe.sizes.clear()
+        stripe.usage = 0
 
     def clear(self):
-        self._cache.clear()
-        self._expire_info.clear()
+        for stripe in self._stripes:
+            with stripe.lock.writer():
+                self._clear(stripe)
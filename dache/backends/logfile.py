@@ -0,0 +1,548 @@
+"""Append-only log cache backend.
+
+Values are appended to segment files and located through an in-memory index,
+as in Bitcask: a write is a single append and a read a single positioned
+read. Records superseded by later writes, deletions or expiry are reclaimed
+by compacting segments in a background thread.
+
+The index lives in the memory of the process, so a directory must not be
+shared by several processes. Writes are not fsync'ed.
+"""
+
+import errno
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+
+from collections import namedtuple
+
+from .base import BaseCache, DEFAULT_TIMEOUT
+from dache.utils.encoding import force_bytes, force_text
+from dache.utils.eviction import get_eviction_policy
+from dache.utils.synch import RWLock
+
+
+# Every record is made of a header, the key and the value. The header holds a
+# CRC32 of the rest of the record, the expiry timestamp (infinity meaning the
+# entry never expires), the key length and the value length.
+_CRC = struct.Struct('!I')
+_BODY = struct.Struct('!dII')
+_HEADER_SIZE = _CRC.size + _BODY.size
+
+# Value length of a record deleting its key
+_TOMBSTONE = 0xFFFFFFFF
+
+_SEGMENT_SUFFIX = '.log'
+
+# Location of the latest record of a key
+_Entry = namedtuple('_Entry', 'segment offset size expiry')
+
+# Stores are shared by all caches of this process using the same directory
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+if hasattr(os, 'pread'):
+    def _pread(fd, size, offset):
+        return os.pread(fd, size, offset)
+else:
+    _seek_lock = threading.Lock()
+
+    def _pread(fd, size, offset):
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+
+
+def _pack(key, value, expiry):
+    """Build the record of a key, value being None for a tombstone."""
+    value_length = _TOMBSTONE
+    if value is None:
+        value = b''
+    else:
+        value_length = len(value)
+    body = _BODY.pack(expiry, len(key), value_length) + key + value
+    return _CRC.pack(zlib.crc32(body) & 0xffffffff) + body
+
+
+def _scan(data):
+    """Yield (offset, size, key, expiry, is_tombstone) for every record of a
+    segment, stopping at the first truncated or corrupted one.
+    """
+    offset = 0
+    while offset + _HEADER_SIZE <= len(data):
+        crc, = _CRC.unpack_from(data, offset)
+        expiry, key_length, value_length = _BODY.unpack_from(
+            data, offset + _CRC.size)
+        is_tombstone = value_length == _TOMBSTONE
+        size = _HEADER_SIZE + key_length + (0 if is_tombstone
+                                            else value_length)
+        end = offset + size
+        if (end > len(data) or
+                zlib.crc32(data[offset + _CRC.size:end]) & 0xffffffff != crc):
+            return
+        key_start = offset + _HEADER_SIZE
+        yield (offset, size, data[key_start:key_start + key_length], expiry,
+               is_tombstone)
+        offset = end
+
+
+def _value_of(record):
+    """Extract the value of a record read from a segment."""
+    key_length = _BODY.unpack_from(record, _CRC.size)[1]
+    return record[_HEADER_SIZE + key_length:]
+
+
+class _Segment(object):
+    """A numbered file records are appended to."""
+
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = os.path.join(directory,
+                                 '%08d%s' % (number, _SEGMENT_SUFFIX))
+        flags = (os.O_RDWR | os.O_CREAT | os.O_APPEND |
+                 getattr(os, 'O_BINARY', 0))
+        self.fd = os.open(self.path, flags, 0o600)
+        self.size = os.fstat(self.fd).st_size
+
+        # Bytes taken by records that are superseded, deleted or expired
+        self.dead = 0
+
+    def append(self, data):
+        offset = self.size
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+            self.size += written
+        return offset
+
+    def read(self, offset, size):
+        return _pread(self.fd, size, offset)
+
+    def truncate(self, size):
+        os.ftruncate(self.fd, size)
+        self.size = size
+
+    def remove(self):
+        os.close(self.fd)
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class _Store(object):
+    """Segments and index of a cache directory. Callers hold the lock."""
+
+    # Maximum number of records copied per writer lock acquisition while
+    # compacting, so readers never wait long
+    compaction_batch = 512
+
+    def __init__(self, directory, segment_size, compaction_ratio, policy):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compaction_ratio = compaction_ratio
+        self.policy = policy
+        self.lock = RWLock()
+        self.index = {}
+        self.segments = {}
+        self.next_number = 0
+        self.active = None
+        self.compactor = None
+        with self.lock.writer():
+            self.load()
+
+    def load(self):
+        """Rebuild the index by replaying the segments in order. A corrupted
+        tail, left by a crash during a write, is truncated.
+        """
+        self.createdir()
+        numbers = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(_SEGMENT_SUFFIX) and
+            name[:-len(_SEGMENT_SUFFIX)].isdigit())
+        for number in numbers:
+            segment = _Segment(self.directory, number)
+            self.segments[number] = segment
+            with io.open(segment.path, 'rb') as f:
+                data = f.read()
+            end = 0
+            for offset, size, key, expiry, is_tombstone in _scan(data):
+                end = offset + size
+                key = force_text(key)
+                self.discard(key)
+                if is_tombstone:
+                    segment.dead += size
+                else:
+                    self.index[key] = _Entry(number, offset, size, expiry)
+                    self.policy.add(key)
+            if end < segment.size:
+                segment.truncate(end)
+        self.next_number = numbers[-1] + 1 if numbers else 0
+        self.active = (self.segments[numbers[-1]] if numbers
+                       else self.new_segment())
+
+        now = time.time()
+        for key, entry in list(self.index.items()):
+            if entry.expiry <= now:
+                self.discard(key)
+
+    def createdir(self):
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise EnvironmentError(
+                        "Cache directory '%s' does not exist "
+                        "and could not be created'" % self.directory)
+
+    def new_segment(self):
+        self.createdir()  # Cache dir can be deleted at any time.
+        segment = _Segment(self.directory, self.next_number)
+        self.segments[segment.number] = segment
+        self.next_number += 1
+        return segment
+
+    def append(self, records):
+        """Append (key, value, expiry) records in a single write, value being
+        None for a tombstone. Return the entry of every record.
+        """
+        if self.active.size >= self.segment_size:
+            sealed, self.active = self.active, self.new_segment()
+            self.check_compaction(sealed)
+        segment = self.active
+        data = [_pack(force_bytes(key), value, expiry)
+                for key, value, expiry in records]
+        offset = segment.append(b''.join(data))
+        entries = []
+        for record in data:
+            entries.append(_Entry(segment.number, offset, len(record),
+                                  records[len(entries)][2]))
+            offset += len(record)
+        return entries
+
+    def put(self, key, entry):
+        """Point the index at the latest record of a key."""
+        old = self.index.get(key)
+        if old is not None:
+            self.kill(old)
+        self.index[key] = entry
+
+    def remove(self, keys):
+        """Delete keys, appending a tombstone for each so they stay deleted
+        when the index is rebuilt.
+        """
+        keys = [key for key in keys if key in self.index]
+        if not keys:
+            return
+        tombstones = self.append([(key, None, 0.0) for key in keys])
+        for key, tombstone in zip(keys, tombstones):
+            self.discard(key)
+            self.kill(tombstone)
+
+    def discard(self, key):
+        """Drop a key from the index. Its records stay on disk."""
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.kill(entry)
+            self.policy.discard(key)
+
+    def expire(self, key):
+        """Drop a key from the index if it has expired. The expiry is in its
+        record, so no tombstone is needed.
+        """
+        entry = self.index.get(key)
+        if entry is not None and entry.expiry <= time.time():
+            self.discard(key)
+            return True
+        return False
+
+    def kill(self, entry):
+        """Account for a record that is no longer needed."""
+        segment = self.segments.get(entry.segment)
+        if segment is not None:
+            segment.dead += entry.size
+            self.check_compaction(segment)
+
+    def clear(self):
+        for segment in self.segments.values():
+            segment.remove()
+        self.segments.clear()
+        self.index.clear()
+        self.policy.clear()
+        self.active = self.new_segment()
+
+    def check_compaction(self, segment):
+        """Start compacting in the background if a sealed segment is mostly
+        made of dead records.
+        """
+        if (self.compactor is None and segment is not self.active and
+                segment.dead > self.compaction_ratio * segment.size):
+            self.compactor = threading.Thread(target=self.compact)
+            self.compactor.daemon = True
+            self.compactor.start()
+
+    def compact(self):
+        """Rewrite the live records of sealed segments at the end of the log,
+        oldest segment first, then delete them.
+        """
+        try:
+            while True:
+                with self.lock.writer():
+                    candidates = [
+                        segment for number, segment
+                        in sorted(self.segments.items())
+                        if segment is not self.active and
+                        segment.dead > self.compaction_ratio * segment.size]
+                    if not candidates:
+                        self.compactor = None
+                        return
+                    segment = candidates[0]
+
+                # Sealed segments are never written to again, so they can be
+                # read without the lock
+                try:
+                    with io.open(segment.path, 'rb') as f:
+                        data = f.read()
+                except IOError:
+                    data = b''  # Cleared meanwhile
+                records = list(_scan(data))
+                for i in range(0, len(records), self.compaction_batch):
+                    with self.lock.writer():
+                        if self.segments.get(segment.number) is not segment:
+                            break
+                        self._copy_forward(
+                            segment, data,
+                            records[i:i + self.compaction_batch])
+
+                with self.lock.writer():
+                    if self.segments.get(segment.number) is segment:
+                        del self.segments[segment.number]
+                        segment.remove()
+        except Exception:
+            with self.lock.writer():
+                self.compactor = None
+            raise
+
+    def _copy_forward(self, segment, data, records):
+        # Tombstones are only needed while an older segment may still hold a
+        # record of their key
+        oldest = segment.number == min(self.segments)
+        now = time.time()
+        rewrites = []
+        for offset, size, key, expiry, is_tombstone in records:
+            key = force_text(key)
+            entry = self.index.get(key)
+            if (entry is not None and entry.segment == segment.number and
+                    entry.offset == offset):
+                if expiry > now:
+                    value = _value_of(data[offset:offset + size])
+                    rewrites.append((key, value, expiry))
+                    continue
+                self.discard(key)
+                entry = None
+            if entry is None and not oldest:
+                rewrites.append((key, None, 0.0))
+        if not rewrites:
+            return
+        for (key, value, _), entry in zip(rewrites, self.append(rewrites)):
+            if value is None:
+                self.kill(entry)
+            else:
+                self.put(key, entry)
+
+
+class LogFileCache(BaseCache):
+
+    def __init__(self, url, segment_size=16 * 1024 * 1024,
+                 compaction_ratio=0.5, eviction='lru', **options):
+        super(LogFileCache, self).__init__(**options)
+
+        # The first cache created for a directory decides the segment size,
+        # the compaction ratio and the eviction policy
+        directory = os.path.abspath(url.path)
+        with _stores_lock:
+            if directory not in _stores:
+                policy_class = get_eviction_policy(eviction)
+                _stores[directory] = _Store(directory, segment_size,
+                                            compaction_ratio, policy_class())
+        self._store = _stores[directory]
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data = self._dumps(value)
+        store = self._store
+        with store.lock.writer():
+            if key in store.index and not self._expire(store, key):
+                return False
+            self._set(store, [(key, data)], timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        result = self._read(self._store, [key])
+        if key not in result:
+            return default
+        return self._loads(result[key])
+
+    def get_many(self, keys, version=None):
+        cache_keys = {}
+        for key in keys:
+            cache_key = self.make_key(key, version=version)
+            self.validate_key(cache_key)
+            cache_keys[cache_key] = key
+
+        # Deserialize outside of the lock
+        d = {}
+        for cache_key, data in self._read(self._store, cache_keys).items():
+            value = self._loads(data)
+            if value is not None:
+                d[cache_keys[cache_key]] = value
+        return d
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data = self._dumps(value)
+        store = self._store
+        with store.lock.writer():
+            self._set(store, [(key, data)], timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        items = []
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            items.append((key, self._dumps(value)))
+        store = self._store
+        with store.lock.writer():
+            self._set(store, items, timeout)
+
+    def delete(self, key, version=None):
+        self.delete_many([key], version)
+
+    def delete_many(self, keys, version=None):
+        cache_keys = []
+        for key in keys:
+            cache_key = self.make_key(key, version=version)
+            self.validate_key(cache_key)
+            cache_keys.append(cache_key)
+        store = self._store
+        with store.lock.writer():
+            store.remove(cache_keys)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        store = self._store
+        with store.lock.reader():
+            entry = store.index.get(key)
+            if entry is None:
+                return False
+            if entry.expiry > time.time():
+                return True
+
+        with store.lock.writer():
+            self._expire(store, key)
+            return False
+
+    def incr(self, key, delta=1, version=None):
+        cache_key = self.make_key(key, version=version)
+        self.validate_key(cache_key)
+        store = self._store
+        # Read and write under the same lock so concurrent increments don't
+        # get lost. The expiry of the key is left untouched.
+        with store.lock.writer():
+            value = None
+            entry = store.index.get(cache_key)
+            if entry is not None and not self._expire(store, cache_key):
+                record = store.segments[entry.segment].read(entry.offset,
+                                                            entry.size)
+                value = self._loads(_value_of(record))
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = value + delta
+            data = self._dumps(new_value)
+            new_entry, = store.append([(cache_key, data, entry.expiry)])
+            store.put(cache_key, new_entry)
+            store.policy.access(cache_key)
+        return new_value
+
+    def clear(self):
+        store = self._store
+        with store.lock.writer():
+            store.clear()
+
+    def _read(self, store, keys):
+        """Read the values of keys, returning a dict of the found ones.
+        Expired keys are dropped from the index.
+        """
+        found = {}
+        expired = []
+        now = time.time()
+        with store.lock.reader():
+            for key in keys:
+                entry = store.index.get(key)
+                if entry is None:
+                    continue
+                if entry.expiry <= now:
+                    expired.append(key)
+                    continue
+                store.policy.access(key)
+                segment = store.segments[entry.segment]
+                found[key] = _value_of(segment.read(entry.offset,
+                                                    entry.size))
+        if expired:
+            with store.lock.writer():
+                for key in expired:
+                    self._expire(store, key)
+        for data in found.values():
+            self._record('bytes_out', len(data))
+        return found
+
+    def _set(self, store, items, timeout):
+        """Append (key, data) items with a single write."""
+        expiry = self.get_backend_timeout(timeout)
+        if expiry is None:
+            expiry = float('inf')
+        if self._max_entries is not None:
+            new = len([key for key, _ in items if key not in store.index])
+            while new and len(store.index) + new > self._max_entries:
+                if not self._cull(store):
+                    break
+        entries = store.append([(key, data, expiry) for key, data in items])
+        for (key, data), entry in zip(items, entries):
+            store.put(key, entry)
+            store.policy.add(key)
+            self._record('bytes_in', len(data))
+
+    def _expire(self, store, key):
+        """Drop a key from the index if it has expired, return True if so."""
+        if store.expire(key):
+            self._record('expirations')
+            return True
+        return False
+
+    def _cull(self, store):
+        """Evict len(index) / cull_frequency entries, at least one, in the
+        order given by the eviction policy. A value of 0 for cull_frequency
+        means that the entire cache will be purged. Return the number of
+        evicted entries.
+        """
+        if self._cull_frequency == 0:
+            doomed = len(store.index)
+            store.clear()
+        else:
+            doomed = min(len(store.index),
+                         max(1, len(store.index) // self._cull_frequency))
+            store.remove([store.policy.pop() for _ in range(doomed)])
+        self._record('evictions', doomed)
+        return doomed
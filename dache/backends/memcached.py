@@ -1,16 +1,21 @@
 """Memcached cache backend."""
 
+import six
 import time
 
 from six.moves import cPickle as pickle
 
 from .base import BaseCache, DEFAULT_TIMEOUT
+from dache.serializers import PickleSerializer
 from dache.utils.encoding import force_str
 from dache.utils.functional import cached_property
 
 
 class BaseMemcachedCache(BaseCache):
 
+    # Memcached clients pickle values themselves
+    serializer_optional = True
+
     def __init__(self, url, library, value_not_found_exception, **options):
         super(BaseMemcachedCache, self).__init__(**options)
         self._servers = url.netloc.split(',')
@@ -23,10 +28,19 @@ class BaseMemcachedCache(BaseCache):
 
         self._lib = library
 
+        # Memcached clients pickle values themselves, any other serializer or
+        # a compressor is applied here. Integers are left alone so that
+        # incr() and decr() keep working on the server.
+        self._serialize = self._serializer is not None and (
+            self._compressor is not None or
+            not isinstance(self._serializer, PickleSerializer))
+
         # HACK: Extract pylibmc client options. We don't want to pass these
         # app-level options to pylibmc.
         for key in ('key_prefix', 'timeout', 'version', 'key_func',
-                    'max_entries', 'cull_frequency'):
+                    'max_entries', 'cull_frequency', 'stats',
+                    'serializer', 'compressor', 'compress_level',
+                    'compress_min_size'):
             options.pop(key, None)
         self._pylibmc_options = options
 
@@ -70,18 +84,25 @@ class BaseMemcachedCache(BaseCache):
 
     def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self.make_key(key, version=version)
-        return self._cache.add(key, value, self.get_backend_timeout(timeout))
+        value = self._encode(value)
+        added = self._cache.add(key, value, self.get_backend_timeout(timeout))
+        if added:
+            self._record_size('bytes_in', value)
+        return added
 
     def get(self, key, default=None, version=None):
         key = self.make_key(key, version=version)
         val = self._cache.get(key)
         if val is None:
             return default
-        return val
+        self._record_size('bytes_out', val)
+        return self._decode(val)
 
     def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self.make_key(key, version=version)
+        value = self._encode(value)
         self._cache.set(key, value, self.get_backend_timeout(timeout))
+        self._record_size('bytes_in', value)
 
     def delete(self, key, version=None):
         key = self.make_key(key, version=version)
@@ -94,7 +115,8 @@ class BaseMemcachedCache(BaseCache):
             _ = {}
             m = dict(zip(new_keys, keys))
             for k, v in ret.items():
-                _[m[k]] = v
+                self._record_size('bytes_out', v)
+                _[m[k]] = self._decode(v)
             ret = _
         return ret
 
@@ -141,8 +163,10 @@ class BaseMemcachedCache(BaseCache):
         safe_data = {}
         for key, value in data.items():
             key = self.make_key(key, version=version)
-            safe_data[key] = value
+            safe_data[key] = self._encode(value)
         self._cache.set_multi(safe_data, self.get_backend_timeout(timeout))
+        for value in safe_data.values():
+            self._record_size('bytes_in', value)
 
     def delete_many(self, keys, version=None):
         l = lambda x: self.make_key(x, version=version)
@@ -151,6 +175,30 @@ class BaseMemcachedCache(BaseCache):
     def clear(self):
         self._cache.flush_all()
 
+    def _encode(self, value):
+        if self._serialize and not isinstance(value, six.integer_types):
+            return self._dumps(value)
+        return value
+
+    def _decode(self, value):
+        if self._serialize and isinstance(value, six.binary_type):
+            return self._loads(value)
+        return value
+
+    def _record_size(self, name, value):
+        """Record the size of an encoded value as the client stores it."""
+        if self._stats is None:
+            return
+        if isinstance(value, six.binary_type):
+            size = len(value)
+        elif isinstance(value, six.text_type):
+            size = len(value.encode('utf-8'))
+        elif isinstance(value, six.integer_types):
+            size = len(str(value))
+        else:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self._record(name, size)
+
 
 class MemcachedCache(BaseMemcachedCache):
     """An implementation of a cache binding using python-memcached."""
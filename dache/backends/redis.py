@@ -1,57 +1,442 @@
 from __future__ import absolute_import
 
+import atexit
+import os
+import re
 import redis
+import six
+import threading
+import uuid
 
-from six.moves import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+from six.moves.urllib.parse import parse_qs
 
 from .base import BaseCache, DEFAULT_TIMEOUT
+from dache.serializers import RawSerializer
+from dache.utils.hashring import HashRing
 
 
 DEFAULT_PORT = 6379
 
 
+def _to_bool(value):
+    if isinstance(value, six.string_types):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+# Connection pool options, accepted as cache options or URL query parameters,
+# and the conversion of their query parameter values
+_POOL_OPTIONS = {
+    'max_connections': int,
+    'retry_on_timeout': _to_bool,
+    'socket_connect_timeout': float,
+    'socket_keepalive': _to_bool,
+    'socket_timeout': float,
+    'unix_socket_path': str,
+}
+
+# Connection pools shared by all caches of this process, keyed by their
+# connection parameters
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_key(params):
+    """Return a hashable key of connection parameters."""
+    return tuple(sorted(
+        (name, tuple(sorted(value.items())) if isinstance(value, dict)
+         else value)
+        for name, value in params.items()))
+
+
+def _get_pool(**params):
+    """Return the connection pool of the given parameters, creating it the
+    first time.
+    """
+    key = _pool_key(params)
+    with _pools_lock:
+        if key not in _pools:
+            if 'unix_socket_path' in params:
+                params['path'] = params.pop('unix_socket_path')
+                params['connection_class'] = redis.UnixDomainSocketConnection
+            _pools[key] = redis.ConnectionPool(**params)
+        return _pools[key]
+
+
+def _parse_hosts(netloc):
+    """Return the (host, port) of every server of a URL location, such as
+    h1:6379,h2:6379 or :password@h1,[::1]:6380.
+    """
+    hosts = []
+    for location in netloc.rpartition('@')[2].split(','):
+        if location.startswith('['):
+            host, _, port = location[1:].partition(']')
+            port = port.lstrip(':')
+        else:
+            host, _, port = location.partition(':')
+        if host or port:
+            hosts.append((host or 'localhost', int(port or DEFAULT_PORT)))
+    return hosts or [('localhost', DEFAULT_PORT)]
+
+
+# Threads running the commands of a batch on several servers at once, shared
+# by all sharded caches of this process
+_FAN_OUT_THREADS = 16
+_fan_out_pool = None
+_fan_out_pid = None
+_fan_out_lock = threading.Lock()
+
+
+def _fan_out(func, items):
+    """Return [func(item) for item in items], running the calls in parallel
+    if there are several.
+    """
+    global _fan_out_pool, _fan_out_pid
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with _fan_out_lock:
+        # Threads don't survive a fork
+        if _fan_out_pid != os.getpid():
+            if _fan_out_pool is not None:
+                # The pool of the parent process, its threads are gone
+                _fan_out_pool.close()
+            _fan_out_pool = ThreadPool(_FAN_OUT_THREADS)
+            _fan_out_pid = os.getpid()
+    return _fan_out_pool.map(func, items)
+
+
+@atexit.register
+def _close_fan_out_pool():
+    global _fan_out_pool
+    with _fan_out_lock:
+        if _fan_out_pool is None:
+            return
+        _fan_out_pool.close()
+        if _fan_out_pid == os.getpid():
+            _fan_out_pool.join()
+        _fan_out_pool = None
+
+
+# Integers in this range are stored as decimal strings, which INCRBY and
+# DECRBY work on
+_MIN_INTEGER = -2 ** 63
+_MAX_INTEGER = 2 ** 63 - 1
+_INTEGER = re.compile(br'^-?[0-9]+\Z')
+
+# Characters of a key prefix to escape in a SCAN MATCH pattern
+_GLOB_SPECIAL = re.compile(r'([*?\[\]\\])')
+
+# INCRBY creates missing keys, this script doesn't
+_INCR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return false
+"""
+
+# Replaces a value only if it hasn't changed since it was read, keeping the
+# expiry of the key
+_REPLACE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+    redis.call('SET', KEYS[1], ARGV[2], 'PX', ttl)
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# Deletes a lock only if it's still held by the given owner
+_UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
 class RedisCache(BaseCache):
 
-    def __init__(self, url, **options):
+    def __init__(self, url, clear_mode='flushdb', clear_batch_size=1000,
+                 **options):
+        # redis://host:port/db?socket_timeout=1&max_connections=50, or
+        # redis://?unix_socket_path=/tmp/redis.sock&db=0
+        query = dict((name, values[-1])
+                     for name, values in parse_qs(url.query).items())
+        pool_params = {
+            'db': int(query.pop('db', None) or url.path[1:] or 0),
+            'password': url.password,
+        }
+        for name, value in query.items():
+            if name not in _POOL_OPTIONS:
+                raise ValueError('Unknown Redis URL parameter: %s' % name)
+            pool_params[name] = _POOL_OPTIONS[name](value)
+        for name in list(options):
+            if name in _POOL_OPTIONS or name == 'socket_keepalive_options':
+                pool_params[name] = options.pop(name)
+        # redis://h1:6379,h2:6379/0 shards keys across servers
+        hosts = [None]
+        if 'unix_socket_path' not in pool_params:
+            hosts = _parse_hosts(url.netloc)
+
         super(RedisCache, self).__init__(**options)
 
-        port = url.port or DEFAULT_PORT
-        db = int(url.path[1:] or 0)
-        self.redis = redis.StrictRedis(host=url.hostname, port=port, db=db,
-                                       password=url.password)
+        # clear() either runs FLUSHDB, or with clear_mode='prefix' only
+        # deletes the keys starting with key_prefix, so caches sharing a
+        # database don't wipe each other out
+        if clear_mode not in ('flushdb', 'prefix'):
+            raise ValueError("clear_mode must be 'flushdb' or 'prefix', not "
+                             "%r" % clear_mode)
+        self._clear_mode = clear_mode
+        self._clear_batch_size = clear_batch_size
+
+        # Caches connecting with the same parameters share warm connections
+        names = []
+        self._clients = {}
+        for host in hosts:
+            params = dict(pool_params)
+            name = None
+            if host is not None:
+                params['host'], params['port'] = host
+                name = '%s:%d' % host
+            names.append(name)
+            self._clients[name] = self._create_client(params)
+
+        # Client of the first server, the only one unless sharding
+        self.redis = self._clients[names[0]]
+        self._ring = None
+        if len(self._clients) > 1:
+            self._ring = HashRing(sorted(self._clients))
+        self._incr_script = self.redis.register_script(_INCR_SCRIPT)
+        self._replace_script = self.redis.register_script(_REPLACE_SCRIPT)
+        self._unlock_script = self.redis.register_script(_UNLOCK_SCRIPT)
+
+        # Raw bytes made of digits would be read back as integers
+        self._raw_integers = not isinstance(self._serializer, RawSerializer)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._get_redis_key(key, version)
+        client = self._get_client(key)
+        expiry = self._get_expiry(timeout)
+        if expiry is None:
+            # Expires immediately, so it's only "added" if it was missing
+            return not client.exists(key)
+
+        value = self._encode(value)
+        added = bool(client.set(key, value, nx=True, **expiry))
+        if added:
+            self._record('bytes_in', len(value))
+        return added
 
     def get(self, key, default=None, version=None):
         key = self._get_redis_key(key, version)
 
-        value = self.redis.get(key)
+        value = self._get_client(key).get(key)
         if not value:
             return default
 
-        value = pickle.loads(value)
+        self._record('bytes_out', len(value))
+        value = self._decode(value)
         return value
 
+    def get_many(self, keys, version=None):
+        keys = dict((self._get_redis_key(key, version), key) for key in keys)
+
+        def mget(group):
+            client, redis_keys = group
+            return list(zip(redis_keys, client.mget(redis_keys)))
+
+        d = {}
+        for values in _fan_out(mget, self._group_by_client(keys)):
+            for redis_key, value in values:
+                if not value:
+                    continue
+                self._record('bytes_out', len(value))
+                value = self._decode(value)
+                if value is not None:
+                    d[keys[redis_key]] = value
+        return d
+
     def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         key = self._get_redis_key(key, version)
+        self._set(self._get_client(key), key, value, timeout)
 
-        value = pickle.dumps(value)
-        if timeout == DEFAULT_TIMEOUT:
-            timeout = self.default_timeout
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        data = dict((self._get_redis_key(key, version), value)
+                    for key, value in data.items())
 
-        pipeline = self.redis.pipeline(transaction=True)
-        pipeline.set(key, value)
-        if timeout is not None:
-            pipeline.expire(key, int(timeout))
-        pipeline.execute()
+        # A single round-trip per server, without the cost of a MULTI/EXEC
+        # transaction
+        pipelines = []
+        for client, redis_keys in self._group_by_client(data):
+            pipeline = client.pipeline(transaction=False)
+            for redis_key in redis_keys:
+                self._set(pipeline, redis_key, data[redis_key], timeout)
+            pipelines.append(pipeline)
+        _fan_out(lambda pipeline: pipeline.execute(), pipelines)
 
     def delete(self, key, version=None):
         key = self._get_redis_key(key, version)
-        self.redis.delete(key)
+        self._get_client(key).delete(key)
+
+    def delete_many(self, keys, version=None):
+        redis_keys = [self._get_redis_key(key, version) for key in keys]
+        _fan_out(lambda group: group[0].delete(*group[1]),
+                 self._group_by_client(redis_keys))
+
+    def has_key(self, key, version=None):
+        key = self._get_redis_key(key, version)
+        return bool(self._get_client(key).exists(key))
+
+    def incr(self, key, delta=1, version=None):
+        """Atomically add delta to an integer with INCRBY, leaving the expiry
+        of the key untouched. Other values are read, then written back unless
+        they've changed in the meantime.
+        """
+        redis_key = self._get_redis_key(key, version)
+        client = self._get_client(redis_key)
+        try:
+            value = self._incr_script(keys=[redis_key], args=[delta],
+                                      client=client)
+        except redis.ResponseError:
+            # Not an integer stored as such, or delta isn't an integer
+            while True:
+                stored = client.get(redis_key)
+                if not stored:
+                    break
+                value, args = self._replace_args(stored, delta)
+                if self._replace_script(keys=[redis_key], args=args,
+                                        client=client):
+                    return value
+            value = None
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+        return value
 
     def clear(self):
-        self.redis.flushdb()
+        if self._clear_mode == 'prefix':
+            _fan_out(self._clear_prefix, list(self._clients.values()))
+        else:
+            _fan_out(lambda client: client.flushdb(),
+                     list(self._clients.values()))
+
+    def _clear_prefix(self, client):
+        """Delete the keys of this cache in batches found with SCAN, which
+        unlike KEYS doesn't block the server.
+        """
+        pattern = '%s:*' % _GLOB_SPECIAL.sub(r'\\\1', self.key_prefix)
+        batch = []
+        for redis_key in client.scan_iter(match=pattern,
+                                          count=self._clear_batch_size):
+            batch.append(redis_key)
+            if len(batch) >= self._clear_batch_size:
+                self._unlink(client, batch)
+                batch = []
+        if batch:
+            self._unlink(client, batch)
+
+    def _unlink(self, client, redis_keys):
+        """Delete keys, reclaiming their memory in the background."""
+        try:
+            client.execute_command('UNLINK', *redis_keys)
+        except redis.ResponseError:
+            # UNLINK requires Redis 4.0
+            client.delete(*redis_keys)
+
+    def _acquire_lock(self, key, version, timeout):
+        """Take the lock of a key with SET NX, storing a token so that a lock
+        which expired and was taken by someone else isn't released.
+        """
+        redis_key = self._get_redis_key('%s.lock' % key, version)
+        client = self._get_client(redis_key)
+        token = uuid.uuid4().hex
+        if client.set(redis_key, token, nx=True,
+                      px=max(1, int(timeout * 1000))):
+            return client, redis_key, token
+        return None
+
+    def _release_lock(self, handle):
+        client, redis_key, token = handle
+        self._unlock_script(keys=[redis_key], args=[token], client=client)
+
+    def _create_client(self, params):
+        """Return a client of the server of the given connection
+        parameters.
+        """
+        return redis.StrictRedis(connection_pool=_get_pool(**params))
+
+    def _get_client(self, redis_key):
+        """Return the client of the server a key is stored on."""
+        if self._ring is None:
+            return self.redis
+        return self._clients[self._ring.get_node(redis_key)]
+
+    def _group_by_client(self, redis_keys):
+        """Group keys by server. Return a list of (client, [key, ...])."""
+        if self._ring is None:
+            redis_keys = list(redis_keys)
+            return [(self.redis, redis_keys)] if redis_keys else []
+        groups = {}
+        for redis_key in redis_keys:
+            groups.setdefault(self._ring.get_node(redis_key),
+                              []).append(redis_key)
+        return [(self._clients[name], group)
+                for name, group in groups.items()]
+
+    def _set(self, client, redis_key, value, timeout):
+        """Run, or queue on a pipeline, the command storing a value."""
+        value = self._encode(value)
+        self._record('bytes_in', len(value))
+        expiry = self._get_expiry(timeout)
+        if expiry is None:
+            # Expires immediately, which SET doesn't accept
+            client.delete(redis_key)
+        else:
+            client.set(redis_key, value, **expiry)
+
+    def _get_expiry(self, timeout):
+        """Return the SET arguments of a timeout: EX for whole seconds, PX
+        for fractions of a second. Return None if the timeout has already
+        passed.
+        """
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return {}
+        milliseconds = int(timeout * 1000)
+        if milliseconds <= 0:
+            return None
+        if milliseconds % 1000:
+            return {'px': milliseconds}
+        return {'ex': milliseconds // 1000}
+
+    def _replace_args(self, stored, delta):
+        """Return the incremented value of a stored one, and the arguments
+        of the script replacing it.
+        """
+        self._record('bytes_out', len(stored))
+        value = self._decode(stored) + delta
+        encoded = self._encode(value)
+        self._record('bytes_in', len(encoded))
+        return value, [stored, encoded]
+
+    def _encode(self, value):
+        if (self._raw_integers and type(value) in six.integer_types and
+                _MIN_INTEGER <= value <= _MAX_INTEGER):
+            return str(value).encode('ascii')
+        return self._dumps(value)
+
+    def _decode(self, value):
+        if self._raw_integers and _INTEGER.match(value):
+            return int(value)
+        return self._loads(value)
 
     def _delete(self, redis_key):
-        self.redis.delete(redis_key)
+        self._get_client(redis_key).delete(redis_key)
 
     def _get_redis_key(self, key, version=None):
         key = self.make_key(key, version)
@@ -0,0 +1,638 @@
+"""Shared memory cache backend.
+
+Entries live in a memory-mapped file, in /dev/shm when available, so all the
+processes of a host, such as pre-forked workers, share one cache. The file
+holds a fixed-size hash table and a slab allocator: memory is split in pages,
+each carved in chunks of a single size class, and an entry is stored in the
+smallest chunk it fits in. When a class runs out of chunks, the least
+recently used of a sample of its chunks is evicted.
+
+Processes are synchronized with the file locks of dache.utils.locks.
+"""
+
+import bisect
+import contextlib
+import hashlib
+import heapq
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+
+from .base import BaseCache, DEFAULT_TIMEOUT
+from dache.utils import locks
+from dache.utils.encoding import force_bytes
+from dache.utils.synch import RWLock
+
+
+_MAGIC = b'DSM1'
+
+_U32 = struct.Struct('!I')
+
+# Header fields: magic, page size, file size, number of slots, number of
+# pages, pages in use, entries, deleted slots and the next page to steal
+_HEADER = struct.Struct('!4sIQIIIIII')
+_PAGES_USED = 24
+_COUNT = 28
+_DELETED = 32
+_STEAL_HAND = 36
+_HEADER_SIZE = 64
+
+# Every size class has a free list head and an eviction hand (page, chunk)
+_CLASS = struct.Struct('!QII')
+
+# Slot of the hash table: key hash and chunk offset
+_SLOT = struct.Struct('!QQ')
+_EMPTY = 0
+_DELETED_SLOT = 1
+
+# Chunk header: key hash (the next free chunk when free), expiry, last access
+# time, key length, value length and whether it's in use
+_CHUNK = struct.Struct('!QddIIB7x')
+_ACCESS = struct.Struct('!d')
+_ACCESS_OFFSET = 16
+
+# Ratio of chunk sizes of consecutive classes
+_GROWTH_FACTOR = 1.25
+_MIN_CHUNK_SIZE = 64
+
+# Tables are shared by all caches of this process using the same file
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _hash(key):
+    return struct.unpack('!Q', hashlib.md5(key).digest()[:8])[0]
+
+
+def _chunk_sizes(page_size):
+    sizes = []
+    size = _MIN_CHUNK_SIZE
+    while size < page_size:
+        sizes.append(size)
+        size = (int(size * _GROWTH_FACTOR) + 7) // 8 * 8
+    sizes.append(page_size)
+    return sizes
+
+
+class _SharedTable(object):
+    """Hash table and slab allocator in a memory-mapped file. Callers hold
+    the lock.
+    """
+
+    # Number of chunks examined to pick one to evict
+    eviction_samples = 8
+
+    def __init__(self, path, size, num_slots, page_size):
+        self.path = path
+        self._rwlock = RWLock()
+        self._mutex = threading.Lock()
+        self._readers = 0
+        self._open(size, num_slots, page_size)
+
+    def _open(self, size, num_slots, page_size):
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        locks.lock(self._fd, locks.LOCK_EX)
+        try:
+            header = os.read(self._fd, _HEADER.size)
+            if (len(header) == _HEADER.size and
+                    _HEADER.unpack(header)[0] == _MAGIC):
+                # Created by another process, its layout wins
+                _, page_size, size, num_slots = _HEADER.unpack(header)[:4]
+                self._map(size, num_slots, page_size)
+            else:
+                os.ftruncate(self._fd, size)
+                self._map(size, num_slots, page_size)
+                self.clear()
+                self.mm[:_HEADER.size] = _HEADER.pack(
+                    _MAGIC, page_size, size, num_slots, self.num_pages,
+                    0, 0, 0, 0)
+        finally:
+            locks.unlock(self._fd)
+
+    def _map(self, size, num_slots, page_size):
+        self.mm = mmap.mmap(self._fd, size)
+        self.size = size
+        self.num_slots = num_slots
+        self.page_size = page_size
+        self.chunk_sizes = _chunk_sizes(page_size)
+
+        self.classes_offset = _HEADER_SIZE
+        self.page_classes_offset = (self.classes_offset +
+                                    len(self.chunk_sizes) * _CLASS.size)
+        table_size = num_slots * _SLOT.size
+        self.num_pages = max(0, (size - self.page_classes_offset -
+                                 table_size - mmap.PAGESIZE) //
+                             (page_size + _U32.size))
+        self.slots_offset = (self.page_classes_offset +
+                             self.num_pages * _U32.size)
+        self.pages_offset = ((self.slots_offset + table_size +
+                              mmap.PAGESIZE - 1) //
+                             mmap.PAGESIZE * mmap.PAGESIZE)
+
+    def _check_pid(self):
+        # File locks are shared with the parent process after a fork, so a
+        # child opens the file again
+        if self._pid != os.getpid():
+            os.close(self._fd)
+            self._open(self.size, self.num_slots, self.page_size)
+
+    @contextlib.contextmanager
+    def reader(self):
+        with self._rwlock.reader():
+            with self._mutex:
+                self._check_pid()
+                if not self._readers:
+                    locks.lock(self._fd, locks.LOCK_SH)
+                self._readers += 1
+            try:
+                yield
+            finally:
+                with self._mutex:
+                    self._readers -= 1
+                    if not self._readers:
+                        locks.unlock(self._fd)
+
+    @contextlib.contextmanager
+    def writer(self):
+        with self._rwlock.writer():
+            self._check_pid()
+            locks.lock(self._fd, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(self._fd)
+
+    def _get_u32(self, offset):
+        return _U32.unpack_from(self.mm, offset)[0]
+
+    def _set_u32(self, offset, value):
+        _U32.pack_into(self.mm, offset, value)
+
+    @property
+    def count(self):
+        return self._get_u32(_COUNT)
+
+    def find(self, key, key_hash):
+        """Return (slot, chunk) of a key, chunk being None if it's missing,
+        in which case slot is where it can be inserted.
+        """
+        mm = self.mm
+        index = key_hash % self.num_slots
+        insert_at = None
+        for _ in range(self.num_slots):
+            slot_hash, chunk = _SLOT.unpack_from(
+                mm, self.slots_offset + index * _SLOT.size)
+            if chunk == _EMPTY:
+                return (index if insert_at is None else insert_at), None
+            if chunk == _DELETED_SLOT:
+                if insert_at is None:
+                    insert_at = index
+            elif slot_hash == key_hash and self._key_of(chunk) == key:
+                return index, chunk
+            index = (index + 1) % self.num_slots
+        return insert_at, None
+
+    def _key_of(self, chunk):
+        key_length = _CHUNK.unpack_from(self.mm, chunk)[3]
+        start = chunk + _CHUNK.size
+        return self.mm[start:start + key_length]
+
+    def get(self, key, key_hash, now):
+        """Return (value, expiry) of a key, value being None if it's missing
+        or expired.
+        """
+        _, chunk = self.find(key, key_hash)
+        if chunk is None:
+            return None, None
+        _, expiry, _, key_length, value_length, _ = _CHUNK.unpack_from(
+            self.mm, chunk)
+        if expiry <= now:
+            return None, expiry
+        _ACCESS.pack_into(self.mm, chunk + _ACCESS_OFFSET, now)
+        start = chunk + _CHUNK.size + key_length
+        return self.mm[start:start + value_length], expiry
+
+    def set(self, key, key_hash, value, expiry):
+        """Store a value, return the number of entries evicted to make room.
+        A value too large for any chunk isn't stored.
+        """
+        slot, chunk = self.find(key, key_hash)
+        if chunk is not None:
+            self._remove(slot, chunk)
+        evicted = 0
+        if self.count >= self.num_slots * 3 // 4:
+            evicted += self._evict_sample()
+        chunk, chunk_evicted = self._allocate(
+            _CHUNK.size + len(key) + len(value))
+        evicted += chunk_evicted
+        if chunk is None:
+            return evicted
+
+        _CHUNK.pack_into(self.mm, chunk, key_hash, expiry, time.time(),
+                         len(key), len(value), 1)
+        start = chunk + _CHUNK.size
+        self.mm[start:start + len(key) + len(value)] = key + value
+
+        # Evictions may have moved the insertion slot
+        slot, _ = self.find(key, key_hash)
+        slot_offset = self.slots_offset + slot * _SLOT.size
+        if _SLOT.unpack_from(self.mm, slot_offset)[1] == _DELETED_SLOT:
+            self._set_u32(_DELETED, self._get_u32(_DELETED) - 1)
+        _SLOT.pack_into(self.mm, slot_offset, key_hash, chunk)
+        self._set_u32(_COUNT, self.count + 1)
+        return evicted
+
+    def delete(self, key, key_hash, expired_only=False):
+        """Delete a key, or only if it has expired. Return True if deleted."""
+        slot, chunk = self.find(key, key_hash)
+        if chunk is None:
+            return False
+        if (expired_only and
+                _CHUNK.unpack_from(self.mm, chunk)[1] > time.time()):
+            return False
+        self._remove(slot, chunk)
+        return True
+
+    def cull(self, num):
+        """Evict the num least recently used entries."""
+        candidates = []
+        for slot in range(self.num_slots):
+            chunk = _SLOT.unpack_from(
+                self.mm, self.slots_offset + slot * _SLOT.size)[1]
+            if chunk > _DELETED_SLOT:
+                access = _ACCESS.unpack_from(self.mm,
+                                             chunk + _ACCESS_OFFSET)[0]
+                candidates.append((access, slot, chunk))
+        for _, slot, chunk in heapq.nsmallest(num, candidates):
+            self._remove(slot, chunk, rehash=False)
+        self._maybe_rehash()
+
+    def clear(self):
+        for offset in range(self.classes_offset, self.page_classes_offset,
+                            _CLASS.size):
+            _CLASS.pack_into(self.mm, offset, 0, 0, 0)
+        for offset in (_PAGES_USED, _COUNT, _DELETED, _STEAL_HAND):
+            self._set_u32(offset, 0)
+        table_end = self.slots_offset + self.num_slots * _SLOT.size
+        self.mm[self.slots_offset:table_end] = (
+            b'\0' * (table_end - self.slots_offset))
+
+    def _remove(self, slot, chunk, rehash=True):
+        _SLOT.pack_into(self.mm, self.slots_offset + slot * _SLOT.size,
+                        0, _DELETED_SLOT)
+        self._set_u32(_COUNT, self.count - 1)
+        self._set_u32(_DELETED, self._get_u32(_DELETED) + 1)
+        self._free(chunk)
+        if rehash:
+            self._maybe_rehash()
+
+    def _maybe_rehash(self):
+        """Rebuild the table once deleted slots make probing too long."""
+        if self._get_u32(_DELETED) <= self.num_slots // 4:
+            return
+        entries = []
+        for slot in range(self.num_slots):
+            offset = self.slots_offset + slot * _SLOT.size
+            key_hash, chunk = _SLOT.unpack_from(self.mm, offset)
+            if chunk > _DELETED_SLOT:
+                entries.append((key_hash, chunk))
+            _SLOT.pack_into(self.mm, offset, 0, _EMPTY)
+        for key_hash, chunk in entries:
+            index = key_hash % self.num_slots
+            while _SLOT.unpack_from(
+                    self.mm, self.slots_offset + index * _SLOT.size)[1]:
+                index = (index + 1) % self.num_slots
+            _SLOT.pack_into(self.mm, self.slots_offset + index * _SLOT.size,
+                            key_hash, chunk)
+        self._set_u32(_DELETED, 0)
+
+    def _unlink(self, chunk):
+        """Remove the entry stored in a chunk from the table, keeping the
+        chunk allocated.
+        """
+        key_hash = _CHUNK.unpack_from(self.mm, chunk)[0]
+        slot, found = self.find(self._key_of(chunk), key_hash)
+        if found != chunk:
+            return
+        _SLOT.pack_into(self.mm, self.slots_offset + slot * _SLOT.size,
+                        0, _DELETED_SLOT)
+        self._set_u32(_COUNT, self.count - 1)
+        self._set_u32(_DELETED, self._get_u32(_DELETED) + 1)
+
+    def _page_class(self, page):
+        return self._get_u32(self.page_classes_offset + page * _U32.size)
+
+    def _chunk_offset(self, page, index, cls):
+        return (self.pages_offset + page * self.page_size +
+                index * self.chunk_sizes[cls])
+
+    def _class_offset(self, cls):
+        return self.classes_offset + cls * _CLASS.size
+
+    def _free(self, chunk):
+        page = (chunk - self.pages_offset) // self.page_size
+        class_offset = self._class_offset(self._page_class(page))
+        free_head, hand_page, hand_chunk = _CLASS.unpack_from(
+            self.mm, class_offset)
+        _CHUNK.pack_into(self.mm, chunk, free_head, 0.0, 0.0, 0, 0, 0)
+        _CLASS.pack_into(self.mm, class_offset, chunk, hand_page, hand_chunk)
+
+    def _pop_free(self, cls):
+        class_offset = self._class_offset(cls)
+        free_head, hand_page, hand_chunk = _CLASS.unpack_from(
+            self.mm, class_offset)
+        if not free_head:
+            return None
+        next_free = _CHUNK.unpack_from(self.mm, free_head)[0]
+        _CLASS.pack_into(self.mm, class_offset, next_free, hand_page,
+                         hand_chunk)
+        return free_head
+
+    def _assign_page(self, page, cls):
+        """Carve a page into free chunks of a class."""
+        self._set_u32(self.page_classes_offset + page * _U32.size, cls)
+        per_page = self.page_size // self.chunk_sizes[cls]
+        for index in range(per_page - 1, -1, -1):
+            self._free(self._chunk_offset(page, index, cls))
+
+    def _allocate(self, size):
+        """Return (chunk, number of evicted entries), chunk being None if
+        size doesn't fit in a page.
+        """
+        if size > self.page_size or not self.num_pages:
+            return None, 0
+        cls = bisect.bisect_left(self.chunk_sizes, size)
+        chunk = self._pop_free(cls)
+        if chunk is not None:
+            return chunk, 0
+        pages_used = self._get_u32(_PAGES_USED)
+        if pages_used < self.num_pages:
+            self._set_u32(_PAGES_USED, pages_used + 1)
+            self._assign_page(pages_used, cls)
+            return self._pop_free(cls), 0
+        chunk = self._evict_from_class(cls)
+        if chunk is not None:
+            return chunk, 1
+        return self._steal_page(cls)
+
+    def _class_chunks(self, cls, page, start):
+        """Yield the (page, index) of every chunk of a class, starting at a
+        position and wrapping around once.
+        """
+        pages_used = self._get_u32(_PAGES_USED)
+        per_page = self.page_size // self.chunk_sizes[cls]
+        for i in range(pages_used + 1):
+            current = (page + i) % pages_used
+            if self._page_class(current) != cls:
+                continue
+            first = start if i == 0 else 0
+            last = start if i == pages_used else per_page
+            for index in range(first, last):
+                yield current, index
+
+    def _evict_from_class(self, cls):
+        """Evict the least recently used of a sample of chunks in use of a
+        class, expired ones first, and return the chunk. The sample starts
+        where the last one ended.
+        """
+        class_offset = self._class_offset(cls)
+        free_head, hand_page, hand_chunk = _CLASS.unpack_from(
+            self.mm, class_offset)
+        now = time.time()
+        victim = None
+        samples = 0
+        for page, index in self._class_chunks(cls, hand_page, hand_chunk):
+            chunk = self._chunk_offset(page, index, cls)
+            _, expiry, access, _, _, in_use = _CHUNK.unpack_from(
+                self.mm, chunk)
+            if not in_use:
+                continue
+            rank = access if expiry > now else -1
+            if victim is None or rank < victim[0]:
+                victim = (rank, chunk)
+            samples += 1
+            if samples == self.eviction_samples:
+                hand_page, hand_chunk = page, index + 1
+                break
+        _CLASS.pack_into(self.mm, class_offset, free_head, hand_page,
+                         hand_chunk)
+        if victim is None:
+            return None
+        self._unlink(victim[1])
+        return victim[1]
+
+    def _evict_sample(self):
+        """Evict the least recently used of a sample of entries, to keep the
+        table from filling up.
+        """
+        pages_used = self._get_u32(_PAGES_USED)
+        for i in range(pages_used):
+            page = (self._get_u32(_STEAL_HAND) + i) % pages_used
+            chunk = self._evict_from_class(self._page_class(page))
+            if chunk is not None:
+                self._free(chunk)
+                return 1
+        return 0
+
+    def _steal_page(self, cls):
+        """Evict all the entries of a page of another class and give the
+        page to cls. Return (chunk, number of evicted entries).
+        """
+        pages_used = self._get_u32(_PAGES_USED)
+        hand = self._get_u32(_STEAL_HAND)
+        for i in range(pages_used):
+            page = (hand + i) % pages_used
+            victim_cls = self._page_class(page)
+            if victim_cls != cls:
+                break
+        else:
+            return None, 0
+        self._set_u32(_STEAL_HAND, (page + 1) % pages_used)
+
+        evicted = 0
+        per_page = self.page_size // self.chunk_sizes[victim_cls]
+        start = self._chunk_offset(page, 0, victim_cls)
+        end = start + self.page_size
+        for index in range(per_page):
+            chunk = self._chunk_offset(page, index, victim_cls)
+            if _CHUNK.unpack_from(self.mm, chunk)[5]:
+                self._unlink(chunk)
+                evicted += 1
+
+        # Drop the free chunks of the page from the free list of its class
+        class_offset = self._class_offset(victim_cls)
+        free_head, hand_page, hand_chunk = _CLASS.unpack_from(
+            self.mm, class_offset)
+        kept = []
+        chunk = free_head
+        while chunk:
+            if not start <= chunk < end:
+                kept.append(chunk)
+            chunk = _CHUNK.unpack_from(self.mm, chunk)[0]
+        for chunk, next_free in zip(kept, kept[1:] + [0]):
+            _CHUNK.pack_into(self.mm, chunk, next_free, 0.0, 0.0, 0, 0, 0)
+        _CLASS.pack_into(self.mm, class_offset, kept[0] if kept else 0,
+                         hand_page, hand_chunk)
+
+        self._assign_page(page, cls)
+        return self._pop_free(cls), evicted
+
+
+class SharedMemoryCache(BaseCache):
+
+    def __init__(self, url, size=32 * 1024 * 1024, slots=None,
+                 page_size=1024 * 1024, directory=None, **options):
+        super(SharedMemoryCache, self).__init__(**options)
+
+        # shm://abcd -> /dev/shm/dache-abcd.shm
+        name = url.geturl()[len(url.scheme) + 3:]
+        if directory is None:
+            directory = '/dev/shm'
+            if not os.path.isdir(directory):
+                directory = tempfile.gettempdir()
+        path = os.path.join(directory,
+                            'dache-%s.shm' % re.sub(r'[^\w.-]', '_', name))
+
+        # The process creating the file decides its size, number of hash
+        # table slots and page size
+        with _tables_lock:
+            if path not in _tables:
+                _tables[path] = _SharedTable(path, size, slots or size // 512,
+                                             page_size)
+        self._table = _tables[path]
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._encode_key(key, version)
+        data = self._dumps(value)
+        with self._table.writer():
+            if self._table.get(key[0], key[1], time.time())[0] is not None:
+                return False
+            self._set(key, data, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self._encode_key(key, version)
+        data = self._read([key]).get(key)
+        if data is None:
+            return default
+        self._record('bytes_out', len(data))
+        return self._loads(data)
+
+    def get_many(self, keys, version=None):
+        encoded = dict((self._encode_key(key, version), key) for key in keys)
+
+        # Deserialize outside of the lock
+        d = {}
+        for key, data in self._read(encoded).items():
+            self._record('bytes_out', len(data))
+            value = self._loads(data)
+            if value is not None:
+                d[encoded[key]] = value
+        return d
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._encode_key(key, version)
+        data = self._dumps(value)
+        with self._table.writer():
+            self._set(key, data, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        items = [(self._encode_key(key, version), self._dumps(value))
+                 for key, value in data.items()]
+        with self._table.writer():
+            for key, value in items:
+                self._set(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self._encode_key(key, version)
+        with self._table.writer():
+            self._table.delete(*key)
+
+    def delete_many(self, keys, version=None):
+        keys = [self._encode_key(key, version) for key in keys]
+        with self._table.writer():
+            for key in keys:
+                self._table.delete(*key)
+
+    def has_key(self, key, version=None):
+        return bool(self._read([self._encode_key(key, version)]))
+
+    def incr(self, key, delta=1, version=None):
+        cache_key = self._encode_key(key, version)
+        # Read and write under the same lock so concurrent increments,
+        # from any process, don't get lost. The expiry is left untouched.
+        with self._table.writer():
+            data, expiry = self._table.get(cache_key[0], cache_key[1],
+                                           time.time())
+            value = None if data is None else self._loads(data)
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = value + delta
+            self._record('evictions', self._table.set(
+                cache_key[0], cache_key[1], self._dumps(new_value), expiry))
+        return new_value
+
+    def clear(self):
+        with self._table.writer():
+            self._table.clear()
+
+    def _encode_key(self, key, version):
+        """Make and validate the cache key, return it as (bytes, hash)."""
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        key = force_bytes(key)
+        return key, _hash(key)
+
+    def _read(self, keys):
+        """Read the values of encoded keys, returning a dict of the found
+        ones. Expired keys are deleted.
+        """
+        found = {}
+        expired = []
+        table = self._table
+        now = time.time()
+        with table.reader():
+            for key in keys:
+                data, expiry = table.get(key[0], key[1], now)
+                if data is not None:
+                    found[key] = data
+                elif expiry is not None:
+                    expired.append(key)
+        if expired:
+            with table.writer():
+                for key in expired:
+                    if table.delete(key[0], key[1], expired_only=True):
+                        self._record('expirations')
+        return found
+
+    def _set(self, key, data, timeout):
+        expiry = self.get_backend_timeout(timeout)
+        if expiry is None:
+            expiry = float('inf')
+        table = self._table
+        if (self._max_entries is not None and
+                table.count >= self._max_entries and
+                table.find(*key)[1] is None):
+            self._cull()
+        self._record('evictions', table.set(key[0], key[1], data, expiry))
+        self._record('bytes_in', len(data))
+
+    def _cull(self):
+        """Evict count / cull_frequency entries, at least one, least recently
+        used first. A value of 0 for cull_frequency means that the entire
+        cache will be purged.
+        """
+        table = self._table
+        if self._cull_frequency == 0:
+            doomed = table.count
+            table.clear()
+        else:
+            doomed = min(table.count,
+                         max(1, table.count // self._cull_frequency))
+            table.cull(doomed)
+        self._record('evictions', doomed)
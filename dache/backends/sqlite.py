@@ -0,0 +1,306 @@
+"""SQLite cache backend.
+
+The database runs in WAL mode so readers don't block the writer, and the
+expires column is indexed so expired entries and culling candidates are
+found without a full scan. Every thread keeps a connection per database.
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from .base import BaseCache, DEFAULT_TIMEOUT, _EntryCount
+from dache.utils.encoding import force_text
+
+
+# SQLite limits the number of host parameters of a statement, so batches
+# larger than this are split
+_MAX_VARIABLES = 900
+
+
+# Connections of the current thread, keyed by database path
+_local = threading.local()
+
+# Row counts of cache tables, keyed by (path, table), shared by all caches of
+# this process using the same table
+_entry_counts = {}
+_entry_counts_lock = threading.Lock()
+
+
+def _chunks(items, size=_MAX_VARIABLES):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class SQLiteCache(BaseCache):
+
+    # Seconds after which the row count is refreshed from the table, to
+    # account for other processes writing to the same database
+    count_refresh_interval = 60
+
+    def __init__(self, url, table='dache', busy_timeout=5, **options):
+        super(SQLiteCache, self).__init__(**options)
+
+        self._path = os.path.abspath(url.path)
+        self._table = table
+        self._busy_timeout = busy_timeout
+        with _entry_counts_lock:
+            self._entry_count = _entry_counts.setdefault(
+                (self._path, table), _EntryCount())
+
+        table = '"%s"' % table
+        self._select_sql = (
+            'SELECT value, expires FROM %s WHERE key = ?' % table)
+        self._select_many_sql = (
+            'SELECT key, value, expires FROM %s WHERE key IN (%%s)' % table)
+        self._exists_sql = (
+            'SELECT 1 FROM %s WHERE key = ? AND expires > ?' % table)
+        self._insert_sql = (
+            'INSERT OR IGNORE INTO %s (key, value, expires) VALUES (?, ?, ?)'
+            % table)
+        self._replace_sql = (
+            'INSERT OR REPLACE INTO %s (key, value, expires) '
+            'VALUES (?, ?, ?)' % table)
+        self._update_sql = 'UPDATE %s SET value = ? WHERE key = ?' % table
+        self._delete_sql = 'DELETE FROM %s WHERE key = ?' % table
+        self._delete_many_sql = 'DELETE FROM %s WHERE key IN (%%s)' % table
+        self._delete_expired_sql = (
+            'DELETE FROM %s WHERE key = ? AND expires <= ?' % table)
+        self._count_sql = 'SELECT COUNT(*) FROM %s' % table
+        self._cull_sql = (
+            'DELETE FROM %s WHERE key IN '
+            '(SELECT key FROM %s ORDER BY expires LIMIT ?)' % (table, table))
+        self._clear_sql = 'DELETE FROM %s' % table
+
+        self._create_table()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._make_and_validate_key(key, version)
+        data = self._dumps(value)
+        with self._transaction() as conn:
+            expired = conn.execute(self._delete_expired_sql,
+                                   (key, time.time())).rowcount
+            self._cull(conn)
+            added = conn.execute(self._insert_sql, (
+                key, sqlite3.Binary(data), self._get_expiry(timeout)
+            )).rowcount
+        self._record('expirations', expired)
+        self._record('bytes_in', added * len(data))
+        self._added(added - expired)
+        return added == 1
+
+    def get(self, key, default=None, version=None):
+        key = self._make_and_validate_key(key, version)
+        row = self._connect().execute(self._select_sql, (key,)).fetchone()
+        if row is None:
+            return default
+        data, expires = row
+        if expires <= time.time():
+            self._delete_expired([key])
+            return default
+        self._record('bytes_out', len(data))
+        return self._loads(bytes(data))
+
+    def get_many(self, keys, version=None):
+        cache_keys = {}
+        for key in keys:
+            cache_key = self._make_and_validate_key(key, version)
+            cache_keys[cache_key] = key
+
+        conn = self._connect()
+        now = time.time()
+        d = {}
+        expired = []
+        for chunk in _chunks(list(cache_keys)):
+            sql = self._select_many_sql % ', '.join('?' * len(chunk))
+            for cache_key, data, expires in conn.execute(sql, chunk):
+                if expires <= now:
+                    expired.append(cache_key)
+                    continue
+                self._record('bytes_out', len(data))
+                value = self._loads(bytes(data))
+                if value is not None:
+                    d[cache_keys[cache_key]] = value
+        if expired:
+            self._delete_expired(expired)
+        return d
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._set_many({key: value}, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._set_many(data, timeout, version)
+
+    def delete(self, key, version=None):
+        key = self._make_and_validate_key(key, version)
+        with self._transaction() as conn:
+            deleted = conn.execute(self._delete_sql, (key,)).rowcount
+        self._added(-deleted)
+
+    def delete_many(self, keys, version=None):
+        cache_keys = []
+        for key in keys:
+            cache_key = self._make_and_validate_key(key, version)
+            cache_keys.append(cache_key)
+        deleted = 0
+        with self._transaction() as conn:
+            for chunk in _chunks(cache_keys):
+                sql = self._delete_many_sql % ', '.join('?' * len(chunk))
+                deleted += conn.execute(sql, chunk).rowcount
+        self._added(-deleted)
+
+    def has_key(self, key, version=None):
+        key = self._make_and_validate_key(key, version)
+        row = self._connect().execute(self._exists_sql,
+                                      (key, time.time())).fetchone()
+        return row is not None
+
+    def incr(self, key, delta=1, version=None):
+        cache_key = self._make_and_validate_key(key, version)
+        # The transaction takes the write lock before reading, so concurrent
+        # increments, from any process, don't get lost. The expiry of the key
+        # is left untouched.
+        with self._transaction() as conn:
+            row = conn.execute(self._select_sql, (cache_key,)).fetchone()
+            value = None
+            if row is not None and row[1] > time.time():
+                value = self._loads(bytes(row[0]))
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = value + delta
+            data = self._dumps(new_value)
+            conn.execute(self._update_sql, (sqlite3.Binary(data), cache_key))
+        self._record('bytes_in', len(data))
+        return new_value
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute(self._clear_sql)
+        self._entry_count.count = 0
+
+    def close(self, **kwargs):
+        """Close the connection of the current thread."""
+        connections = getattr(_local, 'connections', {})
+        conn = connections.pop(self._path, None)
+        if conn is not None:
+            conn.close()
+
+    def _connect(self):
+        """Return the connection of the current thread to the database."""
+        if getattr(_local, 'pid', None) != os.getpid():
+            # Connections must not be used across a fork
+            _local.connections = {}
+            _local.pid = os.getpid()
+        connections = _local.connections
+        conn = connections.get(self._path)
+        if conn is None:
+            directory = os.path.dirname(self._path)
+            if not os.path.exists(directory):
+                os.makedirs(directory, 0o700)
+            # Transactions are started explicitly
+            conn = sqlite3.connect(self._path, timeout=self._busy_timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            connections[self._path] = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run statements in a write transaction. The write lock is taken
+        upfront so that reads within the transaction can't become stale.
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _make_and_validate_key(self, key, version):
+        # sqlite3 rejects byte strings as TEXT on Python 2
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return force_text(key)
+
+    def _create_table(self):
+        table = '"%s"' % self._table
+        index = '"%s_expires"' % self._table
+        with self._transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+                'value BLOB NOT NULL, expires REAL NOT NULL)' % table)
+            conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s (expires)' %
+                         (index, table))
+
+    def _get_expiry(self, timeout):
+        expiry = self.get_backend_timeout(timeout)
+        return float('inf') if expiry is None else expiry
+
+    def _set_many(self, data, timeout, version):
+        expiry = self._get_expiry(timeout)
+        rows = []
+        for key, value in data.items():
+            key = self._make_and_validate_key(key, version)
+            rows.append((key, sqlite3.Binary(self._dumps(value)), expiry))
+        with self._transaction() as conn:
+            self._cull(conn, len(rows))
+            conn.executemany(self._replace_sql, rows)
+        self._record('bytes_in', sum(len(row[1]) for row in rows))
+        self._added(len(rows))
+
+    def _delete_expired(self, keys):
+        now = time.time()
+        expired = 0
+        with self._transaction() as conn:
+            for key in keys:
+                expired += conn.execute(self._delete_expired_sql,
+                                        (key, now)).rowcount
+        self._record('expirations', expired)
+        self._added(-expired)
+
+    def _added(self, delta):
+        """Track the rows added to, or removed from, the table. Overwritten
+        keys are counted as added, which only makes the next cull check count
+        the rows for real.
+        """
+        entry_count = self._entry_count
+        if entry_count.count is not None:
+            entry_count.count = max(0, entry_count.count + delta)
+
+    def _cull(self, conn, num_new=1):
+        """Remove entries, expired first then the ones expiring soonest, if
+        max_entries would be exceeded, at a ratio of num_entries /
+        cull_frequency and at least one. A value of 0 for cull_frequency
+        means that the entire cache will be purged.
+
+        The table is only counted when the tracked row count would reach
+        max_entries or hasn't been refreshed for count_refresh_interval.
+        """
+        if self._max_entries is None:
+            return
+
+        entry_count = self._entry_count
+        if (entry_count.count is not None and
+                entry_count.count + num_new <= self._max_entries and
+                time.time() - entry_count.counted_at <
+                self.count_refresh_interval):
+            return
+
+        num_entries = conn.execute(self._count_sql).fetchone()[0]
+        entry_count.count = num_entries
+        entry_count.counted_at = time.time()
+        if num_entries + num_new <= self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            doomed = conn.execute(self._clear_sql).rowcount
+        else:
+            doomed = conn.execute(
+                self._cull_sql,
+                (max(1, num_entries // self._cull_frequency),)).rowcount
+        entry_count.count -= doomed
+        self._record('evictions', doomed)
@@ -0,0 +1,145 @@
+"""Two-tier cache backend: a small in-process LocMemCache in front of any
+other backend.
+
+tiered://NAME?backend=redis%3A%2F%2Flocalhost%3A6379%2F0, or
+Cache('tiered://NAME', backend='redis://localhost:6379/0').
+
+get() and get_many() are answered by the near cache when they can, misses are
+read from the backend and kept in the near cache for near_timeout seconds.
+Writes and deletes go to both tiers. Writes made by other processes are only
+seen once the near cache entry expires.
+"""
+
+import dache
+
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from .base import BaseCache, DEFAULT_TIMEOUT
+from .locmem import LocMemCache
+
+
+# Options shared by both tiers, so they make the same keys
+_KEY_OPTIONS = ('key_prefix', 'version', 'key_func')
+
+# Marker for a key missing from a tier
+_missing = object()
+
+
+class _NearCache(LocMemCache):
+
+    def validate_key(self, key):
+        # Keys are validated by the backend
+        pass
+
+
+class TieredCache(BaseCache):
+
+    def __init__(self, url, backend=None, near_timeout=1,
+                 near_max_entries=1000, near_options=None, stats=False,
+                 **options):
+        query = dict((name, values[-1])
+                     for name, values in parse_qs(url.query).items())
+        backend = backend or query.get('backend')
+        if not backend:
+            raise ValueError('TieredCache requires a backend URL')
+
+        key_options = dict((name, options[name]) for name in _KEY_OPTIONS
+                           if name in options)
+        super(TieredCache, self).__init__(
+            timeout=options.get('timeout'), stats=stats, **key_options)
+
+        # Other options are the backend's
+        self._far = dache.Cache(backend, **options)
+
+        # Near caches are shared by the tiered caches of the same name and
+        # backend, like LocMemCache stores are shared by name
+        name = url.netloc + url.path
+        near_options = dict(near_options or {}, **key_options)
+        near_options.setdefault('max_entries', near_max_entries)
+        self._near = _NearCache(
+            urlparse('locmem://tiered:%s:%s' % (name, backend)),
+            **near_options)
+        self._near_timeout = near_timeout
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self._far.add(key, value, timeout, version)
+        if added:
+            self._near.set(key, value, self._get_near_timeout(timeout),
+                           version)
+        else:
+            # The near cache may hold an older value
+            self._near.delete(key, version)
+        return added
+
+    def get(self, key, default=None, version=None):
+        value = self._near.get(key, _missing, version)
+        if value is _missing:
+            value = self._far.get(key, _missing, version)
+            if value is _missing:
+                return default
+            self._near.set(key, value, self._near_timeout, version)
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        d = self._near.get_many(keys, version)
+        missing = [key for key in keys if key not in d]
+        if missing:
+            found = self._far.get_many(missing, version)
+            if found:
+                self._near.set_many(found, self._near_timeout, version)
+            d.update(found)
+        return d
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._far.set(key, value, timeout, version)
+        self._near.set(key, value, self._get_near_timeout(timeout), version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._far.set_many(data, timeout, version)
+        self._near.set_many(data, self._get_near_timeout(timeout), version)
+
+    def delete(self, key, version=None):
+        self._far.delete(key, version)
+        self._near.delete(key, version)
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self._far.delete_many(keys, version)
+        self._near.delete_many(keys, version)
+
+    def has_key(self, key, version=None):
+        return self._far.has_key(key, version)  # noqa
+
+    def incr(self, key, delta=1, version=None):
+        value = self._far.incr(key, delta, version)
+        self._near.set(key, value, self._near_timeout, version)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version)
+
+    def clear(self):
+        self._far.clear()
+        self._near.clear()
+
+    def close(self, **kwargs):
+        self._far.close(**kwargs)
+        self._near.close(**kwargs)
+
+    def _acquire_lock(self, key, version, timeout):
+        # The lock of the backend is shared with other processes
+        return self._far._acquire_lock(key, version, timeout)
+
+    def _release_lock(self, handle):
+        self._far._release_lock(handle)
+
+    def _get_near_timeout(self, timeout):
+        """Return the near cache timeout of a value written with the given
+        timeout, which is capped at near_timeout.
+        """
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self._far.default_timeout
+        if timeout is None:
+            return self._near_timeout
+        return min(timeout, self._near_timeout)
@@ -0,0 +1,132 @@
+"""Compressors applied to serialized cache values.
+
+A compressor has ``compress(data)`` and ``decompress(data)`` methods working
+on bytes, and a unique ``id`` between 1 and 255. Compressed values are
+prefixed with a header byte holding that id, or 0 if the value was stored
+uncompressed, so reads detect how a value was written.
+"""
+
+import bz2
+import six
+import zlib
+try:
+    import lzma
+except ImportError:  # Python < 3.3
+    lzma = None
+
+from dache.utils.module_loading import import_string
+
+
+# Header of values stored uncompressed
+UNCOMPRESSED = 0
+
+
+class ZlibCompressor(object):
+
+    id = 1
+
+    def __init__(self, level=-1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class BZ2Compressor(object):
+
+    id = 2
+
+    def __init__(self, level=9):
+        self.level = level
+
+    def compress(self, data):
+        return bz2.compress(data, self.level)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+class LZMACompressor(object):
+    """Best ratio, slowest. Requires Python 3.3+."""
+
+    id = 3
+
+    def __init__(self, level=None):
+        if lzma is None:
+            raise ImportError('The lzma module is not available')
+        self.level = level
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+_COMPRESSORS = {
+    'bz2': 'dache.compressors.BZ2Compressor',
+    'lzma': 'dache.compressors.LZMACompressor',
+    'zlib': 'dache.compressors.ZlibCompressor',
+}
+
+# Header id -> compressor instance, filled lazily by decompress()
+_decompressors = {}
+
+
+def register_compressor(name, compressor_class):
+    """Register a compressor."""
+    _COMPRESSORS[name] = compressor_class
+
+
+def _get_compressor_class(compressor):
+    if isinstance(compressor, six.string_types):
+        compressor = _COMPRESSORS.get(compressor, compressor)
+        if isinstance(compressor, six.string_types):
+            compressor = import_string(compressor)
+    return compressor
+
+
+def get_compressor(compressor, level=None):
+    """Return a compressor instance given a registered name, a dotted path, a
+    class or an instance. If level is given, it's passed to the class. None
+    is passed through.
+    """
+    compressor = _get_compressor_class(compressor)
+    if isinstance(compressor, type):
+        compressor = compressor() if level is None else compressor(level)
+    return compressor
+
+
+def compress(data, compressor, min_size=0):
+    """Compress data if it's at least min_size bytes long and compression
+    makes it smaller, and prepend the header byte.
+    """
+    if len(data) >= min_size:
+        compressed = compressor.compress(data)
+        if len(compressed) < len(data):
+            return six.int2byte(compressor.id) + compressed
+    return six.int2byte(UNCOMPRESSED) + data
+
+
+def decompress(data, compressor=None):
+    """Decompress data written by compress(), whatever the compressor. The
+    given compressor is used if it wrote the data, so compressors that
+    aren't registered can read their own values.
+    """
+    header = six.indexbytes(data, 0)
+    if header == UNCOMPRESSED:
+        return data[1:]
+    if compressor is not None and compressor.id == header:
+        return compressor.decompress(data[1:])
+    if header not in _decompressors:
+        for compressor in list(_COMPRESSORS.values()):
+            compressor_class = _get_compressor_class(compressor)
+            if compressor_class.id == header:
+                _decompressors[header] = compressor_class()
+                break
+        else:
+            raise ValueError('Unknown compressor id: %d' % header)
+    return _decompressors[header].decompress(data[1:])
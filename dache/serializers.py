@@ -0,0 +1,84 @@
+"""Serializers turning cache values into bytes and back.
+
+A serializer is any object with ``dumps(value)`` returning bytes and
+``loads(data)`` returning the value.
+"""
+
+import json
+import marshal
+import six
+
+from six.moves import cPickle as pickle
+
+from dache.utils.module_loading import import_string
+
+
+class PickleSerializer(object):
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return pickle.dumps(value, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MarshalSerializer(object):
+    """Faster than pickle, but limited to builtin types."""
+
+    def dumps(self, value):
+        return marshal.dumps(value)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class JSONSerializer(object):
+    """Portable across languages. Tuples come back as lists."""
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class RawSerializer(object):
+    """Store bytes as they are."""
+
+    def dumps(self, value):
+        if not isinstance(value, six.binary_type):
+            raise TypeError('RawSerializer can only store bytes, not %s' %
+                            type(value).__name__)
+        return value
+
+    def loads(self, data):
+        return data
+
+
+_SERIALIZERS = {
+    'json': 'dache.serializers.JSONSerializer',
+    'marshal': 'dache.serializers.MarshalSerializer',
+    'pickle': 'dache.serializers.PickleSerializer',
+    'raw': 'dache.serializers.RawSerializer',
+}
+
+
+def register_serializer(name, serializer_class):
+    """Register a serializer."""
+    _SERIALIZERS[name] = serializer_class
+
+
+def get_serializer(serializer):
+    """Return a serializer instance given a registered name, a dotted path, a
+    class or an instance. None is passed through.
+    """
+    if isinstance(serializer, six.string_types):
+        serializer = _SERIALIZERS.get(serializer, serializer)
+        if isinstance(serializer, six.string_types):
+            serializer = import_string(serializer)
+    if isinstance(serializer, type):
+        serializer = serializer()
+    return serializer
@@ -0,0 +1,188 @@
+"""Eviction policies for in-memory caches.
+
+Every policy keeps track of the keys stored in a cache and decides which one
+should go first when the cache is full. All operations run in constant time:
+
+    - LRU: least recently used key is evicted first
+    - LFU: least frequently used key is evicted first (ties broken by age)
+    - FIFO: oldest inserted key is evicted first
+"""
+
+import six
+
+from collections import OrderedDict
+
+from dache.utils.module_loading import import_string
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+
+class BaseEvictionPolicy(object):
+    """Base class of eviction policies.
+
+    API:
+        add(key) -- a key has been stored (or overwritten)
+        access(key) -- a key has been read
+        discard(key) -- a key has been removed, failing silently
+        pop() -- remove and return the next key to evict, raise KeyError if
+                 there is none
+        clear() -- forget about all keys
+    """
+    def __init__(self):
+        # Readers of a cache may call access() concurrently, so every policy
+        # guards its own bookkeeping.
+        self._mutex = threading.Lock()
+
+    def add(self, key):
+        raise NotImplementedError(
+            'subclasses of BaseEvictionPolicy must provide an add() method')
+
+    def access(self, key):
+        raise NotImplementedError(
+            'subclasses of BaseEvictionPolicy must provide an access() method')
+
+    def discard(self, key):
+        raise NotImplementedError(
+            'subclasses of BaseEvictionPolicy must provide a discard() method')
+
+    def pop(self):
+        raise NotImplementedError(
+            'subclasses of BaseEvictionPolicy must provide a pop() method')
+
+    def clear(self):
+        raise NotImplementedError(
+            'subclasses of BaseEvictionPolicy must provide a clear() method')
+
+    def __len__(self):
+        raise NotImplementedError(
+            'subclasses of BaseEvictionPolicy must provide a __len__() method')
+
+
+class FIFOPolicy(BaseEvictionPolicy):
+
+    def __init__(self):
+        super(FIFOPolicy, self).__init__()
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        with self._mutex:
+            self._keys.setdefault(key, None)
+
+    def access(self, key):
+        pass
+
+    def discard(self, key):
+        with self._mutex:
+            self._keys.pop(key, None)
+
+    def pop(self):
+        with self._mutex:
+            if not self._keys:
+                raise KeyError('pop from an empty eviction policy')
+            return self._keys.popitem(last=False)[0]
+
+    def clear(self):
+        with self._mutex:
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class LRUPolicy(FIFOPolicy):
+
+    def add(self, key):
+        with self._mutex:
+            self._keys.pop(key, None)
+            self._keys[key] = None
+
+    def access(self, key):
+        with self._mutex:
+            # Move the key to the most recently used end
+            if self._keys.pop(key, -1) is None:
+                self._keys[key] = None
+
+
+class LFUPolicy(BaseEvictionPolicy):
+
+    def __init__(self):
+        super(LFUPolicy, self).__init__()
+        # key -> number of uses
+        self._counts = {}
+        # number of uses -> keys with that count, oldest first
+        self._buckets = {}
+        self._min_count = 0
+
+    def add(self, key):
+        if key in self._counts:
+            self.access(key)
+            return
+        with self._mutex:
+            self._counts[key] = 1
+            self._buckets.setdefault(1, OrderedDict())[key] = None
+            self._min_count = 1
+
+    def access(self, key):
+        with self._mutex:
+            count = self._counts.get(key)
+            if count is None:
+                return
+            self._remove_from_bucket(key, count)
+            if self._min_count == count and count not in self._buckets:
+                self._min_count = count + 1
+            self._counts[key] = count + 1
+            self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def discard(self, key):
+        with self._mutex:
+            count = self._counts.pop(key, None)
+            if count is not None:
+                self._remove_from_bucket(key, count)
+
+    def pop(self):
+        with self._mutex:
+            if not self._counts:
+                raise KeyError('pop from an empty eviction policy')
+            if self._min_count not in self._buckets:
+                # Only happens after the least used keys were discarded
+                self._min_count = min(self._buckets)
+            key = self._buckets[self._min_count].popitem(last=False)[0]
+            if not self._buckets[self._min_count]:
+                del self._buckets[self._min_count]
+            del self._counts[key]
+            return key
+
+    def clear(self):
+        with self._mutex:
+            self._counts.clear()
+            self._buckets.clear()
+            self._min_count = 0
+
+    def _remove_from_bucket(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+    def __len__(self):
+        return len(self._counts)
+
+
+EVICTION_POLICIES = {
+    'fifo': FIFOPolicy,
+    'lfu': LFUPolicy,
+    'lru': LRUPolicy,
+}
+
+
+def get_eviction_policy(eviction):
+    """Return an eviction policy class given its name (one of
+    ``EVICTION_POLICIES``), a dotted path or the class itself.
+    """
+    if isinstance(eviction, six.string_types):
+        if eviction.lower() in EVICTION_POLICIES:
+            return EVICTION_POLICIES[eviction.lower()]
+        return import_string(eviction)
+    return eviction
@@ -0,0 +1,32 @@
+"""Consistent hashing of keys to nodes."""
+
+import bisect
+import hashlib
+import struct
+
+from dache.utils.encoding import force_bytes
+
+
+_POINTS = struct.Struct('<4I')
+
+
+def _points(value):
+    return _POINTS.unpack(hashlib.md5(force_bytes(value)).digest())
+
+
+class HashRing(object):
+    """Map keys to nodes so that adding or removing a node only moves the
+    keys of that node. Every node is placed at many points of the ring,
+    virtual nodes, to even out the distribution, as in ketama.
+    """
+    def __init__(self, nodes, replicas=160):
+        self._ring = {}
+        for node in nodes:
+            for i in range(replicas // 4):
+                for point in _points('%s-%d' % (node, i)):
+                    self._ring[point] = node
+        self._points = sorted(self._ring)
+
+    def get_node(self, key):
+        index = bisect.bisect(self._points, _points(key)[0])
+        return self._ring[self._points[index % len(self._points)]]
@@ -0,0 +1,46 @@
+"""Heap operations missing from heapq, on heaps it maintains."""
+
+
+def heapremove(heap, pos):
+    """Remove the item at index pos of a heap in O(log n)."""
+    last = heap.pop()
+    if pos == len(heap):
+        return
+    heap[pos] = last
+    if pos and last < heap[(pos - 1) >> 1]:
+        _sift_up(heap, pos)
+    else:
+        _sift_down(heap, pos)
+
+
+def _sift_up(heap, pos):
+    """Move the item at pos towards the root while it's smaller than its
+    parent.
+    """
+    item = heap[pos]
+    while pos:
+        parent = (pos - 1) >> 1
+        if not item < heap[parent]:
+            break
+        heap[pos] = heap[parent]
+        pos = parent
+    heap[pos] = item
+
+
+def _sift_down(heap, pos):
+    """Move the item at pos towards the leaves while one of its children is
+    smaller.
+    """
+    end = len(heap)
+    item = heap[pos]
+    while True:
+        child = 2 * pos + 1
+        if child >= end:
+            break
+        if child + 1 < end and heap[child + 1] < heap[child]:
+            child += 1
+        if not heap[child] < item:
+            break
+        heap[pos] = heap[child]
+        pos = child
+    heap[pos] = item
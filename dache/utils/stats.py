@@ -0,0 +1,182 @@
+"""Cache statistics.
+
+Counters are kept per thread, so recording a call never takes a lock. They
+are only summed up when the statistics are read.
+"""
+
+import functools
+import time
+
+from collections import defaultdict
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Marker for a missing key, so that a cached value equal to the default is
+# still counted as a hit
+_missing = object()
+
+
+class _ThreadStats(object):
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        # operation -> [number of calls, total seconds, {bucket: calls}]
+        self.latencies = {}
+        # Depth of nested instrumented calls, e.g. BaseCache.get_many()
+        # calling get(), only the outermost one is recorded
+        self.depth = 0
+
+
+class CacheStats(object):
+    """Hit, miss, write, eviction, expiration and byte counters of a cache,
+    plus a latency histogram for every operation.
+
+    Latency buckets are powers of two in microseconds: a call falls in the
+    smallest bucket greater than or equal to its duration.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._threads = []
+        self._mutex = threading.Lock()
+
+    def _get_thread_stats(self):
+        try:
+            return self._local.stats
+        except AttributeError:
+            stats = self._local.stats = _ThreadStats()
+            with self._mutex:
+                self._threads.append(stats)
+            return stats
+
+    def incr(self, name, delta=1):
+        self._get_thread_stats().counters[name] += delta
+
+    def record_latency(self, operation, seconds):
+        latencies = self._get_thread_stats().latencies
+        if operation not in latencies:
+            latencies[operation] = [0, 0.0, defaultdict(int)]
+        latency = latencies[operation]
+        latency[0] += 1
+        latency[1] += seconds
+        latency[2][1 << int(seconds * 1000000).bit_length()] += 1
+
+    def as_dict(self):
+        counters = dict.fromkeys(('hits', 'misses', 'sets', 'deletes',
+                                  'evictions', 'expirations', 'bytes_in',
+                                  'bytes_out'), 0)
+        latencies = {}
+        with self._mutex:
+            threads = list(self._threads)
+        for stats in threads:
+            for name, value in list(stats.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for operation, latency in list(stats.latencies.items()):
+                total = latencies.setdefault(
+                    operation, {'count': 0, 'total': 0.0, 'histogram': {}})
+                total['count'] += latency[0]
+                total['total'] += latency[1]
+                for bucket, count in list(latency[2].items()):
+                    total['histogram'][bucket] = (
+                        total['histogram'].get(bucket, 0) + count)
+        counters['latency'] = latencies
+        return counters
+
+    def reset(self):
+        with self._mutex:
+            self._threads = []
+        self._local = threading.local()
+
+    def _timed(self, operation, func, record, finish=None):
+        """Wrap func so its latency is recorded, then call
+        record(result, *args, **kwargs) to update the counters. If given,
+        finish(result, *args, **kwargs) is returned instead of the result.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = self._get_thread_stats()
+            if stats.depth:
+                result = func(*args, **kwargs)
+            else:
+                stats.depth += 1
+                start = timer()
+                try:
+                    result = func(*args, **kwargs)
+                finally:
+                    stats.depth -= 1
+                self.record_latency(operation, timer() - start)
+                if record is not None:
+                    record(result, *args, **kwargs)
+            if finish is not None:
+                return finish(result, *args, **kwargs)
+            return result
+        return wrapper
+
+    def instrument(self, cache):
+        """Record every call to the public methods of a cache instance."""
+        get = cache.get
+
+        def get_or_missing(key, default=None, version=None):
+            return get(key, _missing, version)
+
+        def record_get(result, key, default=None, version=None):
+            self.incr('misses' if result is _missing else 'hits')
+
+        def finish_get(result, key, default=None, version=None):
+            return default if result is _missing else result
+
+        cache.get = functools.wraps(get)(
+            self._timed('get', get_or_missing, record_get, finish_get))
+
+        get_many = cache.get_many
+
+        def record_get_many(result, keys, version=None):
+            self.incr('hits', len(result))
+            self.incr('misses', len(keys) - len(result))
+
+        timed_get_many = self._timed('get_many', get_many, record_get_many)
+
+        def instrumented_get_many(keys, version=None):
+            # keys may be an iterator, it is needed twice
+            return timed_get_many(list(keys), version)
+        cache.get_many = functools.wraps(get_many)(instrumented_get_many)
+
+        delete_many = cache.delete_many
+
+        def record_delete_many(result, keys, version=None):
+            self.incr('deletes', len(keys))
+
+        timed_delete_many = self._timed('delete_many', delete_many,
+                                        record_delete_many)
+
+        def instrumented_delete_many(keys, version=None):
+            return timed_delete_many(list(keys), version)
+        cache.delete_many = functools.wraps(delete_many)(
+            instrumented_delete_many)
+
+        def record_add(result, *args, **kwargs):
+            if result:
+                self.incr('sets')
+
+        def record_set(result, *args, **kwargs):
+            self.incr('sets')
+
+        def record_set_many(result, data, *args, **kwargs):
+            self.incr('sets', len(data))
+
+        def record_delete(result, *args, **kwargs):
+            self.incr('deletes')
+
+        for operation, record in (('add', record_add),
+                                  ('set', record_set),
+                                  ('set_many', record_set_many),
+                                  ('delete', record_delete),
+                                  ('has_key', None),
+                                  ('incr', None),
+                                  ('decr', None)):
+            func = getattr(cache, operation)
+            setattr(cache, operation, self._timed(operation, func, record))
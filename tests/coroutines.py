@@ -0,0 +1,26 @@
+"""Coroutine functions of the asyncio tests, kept apart since Python 2
+can't parse them.
+"""
+
+import asyncio
+
+
+def returning(value, calls=None, delay=0):
+    """Return a coroutine function returning value after delay seconds, and
+    appending to calls if given.
+    """
+    async def coroutine_function():
+        if calls is not None:
+            calls.append(None)
+        await asyncio.sleep(delay)
+        return value
+    return coroutine_function
+
+
+
+def waiting(event, value):
+    """Return a coroutine function returning value once event is set."""
+    async def coroutine_function():
+        await event.wait()
+        return value
+    return coroutine_function
@@ -0,0 +1,73 @@
+import unittest
+
+import dache
+
+from dache.compressors import (BZ2Compressor, LZMACompressor, ZlibCompressor,
+                               compress, decompress, get_compressor, lzma)
+
+
+class CustomCompressor(ZlibCompressor):
+
+    id = 200
+
+
+class UnregisteredCompressor(ZlibCompressor):
+
+    id = 201
+
+
+class TestCompressors(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = b'compress me ' * 100
+        compressors = [ZlibCompressor(), BZ2Compressor(1)]
+        if lzma is not None:
+            compressors.append(LZMACompressor())
+        for compressor in compressors:
+            compressed = compress(data, compressor)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(decompress(compressed), data)
+
+    def test_min_size(self):
+        data = b'compress me ' * 100
+        stored = compress(data, ZlibCompressor(), min_size=len(data) + 1)
+        self.assertEqual(stored, b'\x00' + data)
+        self.assertEqual(decompress(stored), data)
+
+    def test_incompressible(self):
+        stored = compress(b'ab', ZlibCompressor())
+        self.assertEqual(stored, b'\x00ab')
+
+    def test_unknown_header(self):
+        self.assertRaises(ValueError, decompress, b'\xffdata')
+
+    def test_get_compressor(self):
+        self.assertIsNone(get_compressor(None))
+        self.assertEqual(get_compressor('zlib', 9).level, 9)
+        self.assertIsInstance(
+            get_compressor('dache.compressors.BZ2Compressor'), BZ2Compressor)
+        compressor = ZlibCompressor(1)
+        self.assertIs(get_compressor(compressor), compressor)
+
+    def test_register_compressor(self):
+        dache.register_compressor('custom', CustomCompressor)
+        cache = dache.Cache('locmem://compressors', compressor='custom',
+                            compress_min_size=0)
+        value = [b'value'] * 100
+        cache.set('key', value)
+        stored = cache._stripes[0].cache[cache.make_key('key')]
+        self.assertEqual(stored[:1], b'\xc8')
+        self.assertEqual(cache.get('key'), value)
+
+    def test_unregistered_compressor(self):
+        value = [b'value'] * 100
+        for compressor in ('tests.test_compressors.UnregisteredCompressor',
+                           UnregisteredCompressor, UnregisteredCompressor()):
+            cache = dache.Cache('locmem://unregistered',
+                                compressor=compressor, compress_min_size=0)
+            cache.set('key', value)
+            self.assertEqual(cache.get('key'), value)
+        data = compress(b'compress me ' * 100, UnregisteredCompressor())
+        self.assertRaises(ValueError, decompress, data)
+        self.assertEqual(decompress(data, UnregisteredCompressor()),
+                         b'compress me ' * 100)
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import heapq
 import os
 import shutil
 import six
+import struct
+import subprocess
+import sys
 import tempfile
+import threading
 import time
 import unittest
 import warnings
@@ -11,6 +16,7 @@ import warnings
 import dache
 
 from six.moves import cPickle as pickle
+from six.moves.urllib.parse import quote
 
 from dache import CacheKeyWarning
 
@@ -61,6 +67,71 @@ class TestLocMemCache(unittest.TestCase):
         self.assertFalse(result)
         self.assertEqual(self.cache.get("addkey1"), "value")
 
+    def test_get_or_set(self):
+        self.assertEqual(self.cache.get_or_set('key', 'value'), 'value')
+        self.assertEqual(self.cache.get_or_set('key', 'other'), 'value')
+        self.assertEqual(self.cache.get_or_set('callable', lambda: [1, 2]),
+                         [1, 2])
+        self.assertEqual(self.cache.get('callable'), [1, 2])
+
+    def _concurrent_get_or_set(self, caches, **kwargs):
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(None)
+            time.sleep(0.2)
+            return 'value'
+
+        def get_or_set(cache):
+            results.append(cache.get_or_set('flight', compute, **kwargs))
+        threads = [threading.Thread(target=get_or_set, args=(cache,))
+                   for cache in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * len(caches))
+
+    def test_get_or_set_single_flight(self):
+        self._concurrent_get_or_set([self.cache] * 8)
+
+    def test_get_or_set_lock(self):
+        # Caches created separately only share the lock, like processes
+        caches = [dache.Cache(self.CACHE_URL) for _ in range(4)]
+        self._concurrent_get_or_set(caches, lock=True)
+        # The lock was released
+        self.cache.delete('flight')
+        self.assertEqual(self.cache.get_or_set('flight', 'again', lock=True,
+                                               lock_timeout=0.1), 'again')
+
+    def test_get_or_set_hung_leader(self):
+        release = threading.Event()
+
+        def hang():
+            release.wait()
+            return 'leader'
+        leader = threading.Thread(target=self.cache.get_or_set,
+                                  args=('flight', hang))
+        leader.start()
+        time.sleep(0.05)
+        try:
+            self.assertEqual(self.cache.get_or_set('flight', 'follower',
+                                                   lock_timeout=0.1),
+                             'follower')
+        finally:
+            release.set()
+            leader.join()
+
+    def test_get_or_set_error(self):
+        def fail():
+            raise ZeroDivisionError()
+        with self.assertRaises(ZeroDivisionError):
+            self.cache.get_or_set('key', fail)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.get_or_set('key', 'value'), 'value')
+
     def test_prefix(self):
         # Test for same cache key conflicts between shared backend
         self.cache.set('somekey', 'value')
@@ -680,6 +751,391 @@ class TestLocMemCache(unittest.TestCase):
         with self.assertRaises(pickle.PickleError):
             self.cache.set('unpickable', Unpickable())
 
+    def test_serializers(self):
+        stuff = {'string': 'this is a string', 'list': [1, 2, 3]}
+        for serializer in ('json', 'marshal', 'pickle'):
+            cache = dache.Cache(self.CACHE_URL, serializer=serializer)
+            cache.set('stuff', stuff)
+            self.assertEqual(cache.get('stuff'), stuff)
+            cache.set_many({'stuff1': stuff, 'stuff2': stuff})
+            self.assertEqual(cache.get_many(['stuff1', 'stuff2']),
+                             {'stuff1': stuff, 'stuff2': stuff})
+            cache.set('answer', 41)
+            self.assertEqual(cache.incr('answer'), 42)
+
+        cache = dache.Cache(self.CACHE_URL, serializer='raw')
+        cache.set('raw', b'bytes')
+        self.assertEqual(cache.get('raw'), b'bytes')
+
+    def test_compression(self):
+        stuff = {'string': 'this is a string ' * 100, 'list': [1, 2, 3]}
+        for compressor in ('zlib', 'bz2'):
+            cache = dache.Cache(self.CACHE_URL, compressor=compressor,
+                                compress_level=1, compress_min_size=64)
+            cache.set('stuff', stuff)
+            self.assertEqual(cache.get('stuff'), stuff)
+            cache.set('small', [1])
+            self.assertEqual(cache.get('small'), [1])
+            cache.set_many({'stuff1': stuff, 'stuff2': stuff})
+            self.assertEqual(cache.get_many(['stuff1', 'stuff2']),
+                             {'stuff1': stuff, 'stuff2': stuff})
+            cache.set('answer', 41)
+            self.assertEqual(cache.incr('answer'), 42)
+
+    def test_stats(self):
+        self.assertIsNone(self.cache.stats())
+
+        cache = dache.Cache(self.CACHE_URL, stats=True)
+        cache.set('key1', 'spam')
+        cache.set_many({'key2': 'eggs', 'key3': 'ham'})
+        self.assertEqual(cache.get('key1', 'default'), 'spam')
+        self.assertEqual(cache.get('missing', 'default'), 'default')
+        cache.get_many(iter(['key2', 'key3', 'missing']))
+        cache.delete('key1')
+        cache.delete_many(['key2', 'key3'])
+
+        stats = cache.stats(reset=True)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['sets'], 3)
+        self.assertEqual(stats['deletes'], 3)
+        self.assertEqual(stats['latency']['get']['count'], 2)
+        self.assertEqual(
+            sum(stats['latency']['get']['histogram'].values()), 2)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+
+class TestLocMemCacheEviction(unittest.TestCase):
+
+    def _make_cache(self, name, eviction):
+        cache = dache.Cache('locmem://%s' % name, max_entries=3,
+                            cull_frequency=3, eviction=eviction)
+        cache.clear()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        return cache
+
+    def test_lru(self):
+        cache = self._make_cache('eviction-lru', 'lru')
+        cache.get('a')
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get_many(['a', 'c', 'd']),
+                         {'a': 1, 'c': 3, 'd': 4})
+
+    def test_lfu(self):
+        cache = self._make_cache('eviction-lfu', 'lfu')
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get_many(['a', 'b', 'd']),
+                         {'a': 1, 'b': 2, 'd': 4})
+
+    def test_fifo(self):
+        cache = self._make_cache('eviction-fifo', 'fifo')
+        cache.get('a')
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_many(['b', 'c', 'd']),
+                         {'b': 2, 'c': 3, 'd': 4})
+
+    def test_overwrite_does_not_cull(self):
+        cache = self._make_cache('eviction-overwrite', 'lru')
+        cache.set('a', 10)
+        self.assertEqual(cache.get_many(['a', 'b', 'c']),
+                         {'a': 10, 'b': 2, 'c': 3})
+
+
+class TestLocMemCacheCull(unittest.TestCase):
+
+    def test_small_max_entries(self):
+        cache = dache.Cache('locmem://cull-small', max_entries=2,
+                            cull_frequency=3)
+        for i in range(10):
+            cache.set('key%d' % i, i)
+        self.assertLessEqual(len(cache._stripes[0].cache), 2)
+
+    def test_sharded(self):
+        cache = dache.Cache('locmem://cull-sharded', max_entries=10,
+                            shards=8)
+        for i in range(100):
+            cache.set('key%d' % i, i)
+        for stripe in cache._stripes:
+            self.assertLessEqual(len(stripe.cache), 2)
+
+
+class TestLocMemCacheExpiry(unittest.TestCase):
+
+    def test_reap_on_write(self):
+        cache = dache.Cache('locmem://expiry-reap')
+        cache.set('short', 'value', 0)
+        cache.set('long', 'value')
+        stored = cache._stripes[0].cache
+        self.assertNotIn(cache.make_key('short'), stored)
+        self.assertIn(cache.make_key('long'), stored)
+
+    def test_reap_is_bounded(self):
+        cache = dache.Cache('locmem://expiry-bounded', max_entries=None)
+        cache.set_many(dict(('key%d' % i, i) for i in range(40)), 0.2)
+        time.sleep(0.3)
+        cache.set('trigger', 'value')
+        self.assertEqual(len(cache._stripes[0].cache),
+                         40 - cache.reap_batch + 1)
+
+    def test_overwritten_key_is_not_reaped(self):
+        cache = dache.Cache('locmem://expiry-overwrite')
+        cache.set('key', 'old', 0)
+        cache.set('key', 'new')
+        cache.set('trigger', 'value')
+        self.assertEqual(cache.get('key'), 'new')
+
+    def test_stale_entries_are_compacted(self):
+        cache = dache.Cache('locmem://expiry-compact')
+        stripe = cache._stripes[0]
+        for i in range(1000):
+            cache.set('key%d' % (i % 10), i, 100 + i)
+        self.assertLessEqual(len(stripe.expiry_heap),
+                             2 * len(stripe.cache) + 2 * cache.reap_batch)
+        heap = list(stripe.expiry_heap)
+        heapq.heapify(heap)
+        self.assertEqual(heap, stripe.expiry_heap)
+        self.assertEqual(cache.get('key9'), 999)
+
+    def test_miss_takes_no_writer_lock(self):
+        cache = dache.Cache('locmem://expiry-miss')
+        lock = cache._stripes[0].lock
+        writer_enters = lock.writer_enters
+        writes = []
+
+        def counting_writer_enters():
+            writes.append(None)
+            writer_enters()
+        lock.writer_enters = counting_writer_enters
+        for i in range(10):
+            cache.get('missing%d' % i)
+            cache.has_key('missing%d' % i)  # noqa
+        cache.get_many(['missing%d' % i for i in range(10)])
+        self.assertEqual(writes, [])
+
+        # Expired keys are still deleted
+        cache.set('expired', 'value', 0)
+        del writes[:]
+        self.assertIsNone(cache.get('expired'))
+        self.assertEqual(len(writes), 1)
+        self.assertNotIn(cache.make_key('expired'), cache._stripes[0].cache)
+
+    def test_sweeper(self):
+        cache = dache.Cache('locmem://expiry-sweeper', sweep_interval=0.01)
+        cache.set('key', 'value', 0)
+        time.sleep(0.1)
+        self.assertNotIn(cache.make_key('key'), cache._stripes[0].cache)
+
+
+class TestLocMemCacheMaxBytes(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = dache.Cache('locmem://max-bytes', max_entries=None,
+                                 max_bytes=1000)
+        self.cache.clear()
+        # cPickle on Python 2 memoizes strings with other references, so the
+        # value is pickled the way the cache pickles it
+        value = b'x' * 200
+        self.size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def test_bytes_used(self):
+        self.assertEqual(self.cache.bytes_used, 0)
+        self.cache.set('a', b'x' * 200)
+        self.assertEqual(self.cache.bytes_used, self.size)
+        self.cache.set('a', b'x' * 200)
+        self.assertEqual(self.cache.bytes_used, self.size)
+        self.cache.delete('a')
+        self.assertEqual(self.cache.bytes_used, 0)
+
+    def test_evict_until_fits(self):
+        for key in 'abcd':
+            self.cache.set(key, b'x' * 200)
+        self.cache.get('a')
+        self.cache.set('e', b'x' * 400)
+        self.assertLessEqual(self.cache.bytes_used, 1000)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), b'x' * 200)
+        self.assertEqual(self.cache.get('e'), b'x' * 400)
+
+    def test_too_large(self):
+        self.cache.set('a', 'small')
+        self.cache.set('a', b'x' * 2000)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.bytes_used, 0)
+
+
+class TestLocMemCacheReferences(unittest.TestCase):
+
+    def test_store_references(self):
+        cache = dache.Cache('locmem://references', store_references=True)
+        value = {'list': [1, 2]}
+        cache.set('key', value)
+        self.assertIs(cache.get('key'), value)
+        cache.set('bytes', b'raw')
+        self.assertEqual(cache.get('bytes'), b'raw')
+        cache.set('unpickable', Unpickable())
+        self.assertIsInstance(cache.get('unpickable'), Unpickable)
+
+    def test_immutable_values_are_not_pickled(self):
+        cache = dache.Cache('locmem://immutables')
+        cache.set('int', 42)
+        cache.set('none', None)
+        cache.set('bytes', b'raw')
+        cache.set('list', [1, 2])
+        stored = cache._stripes[0].cache
+        self.assertEqual(stored[cache.make_key('int')], 42)
+        self.assertIsNone(stored[cache.make_key('none')])
+        self.assertNotEqual(stored[cache.make_key('bytes')], b'raw')
+        self.assertEqual(cache.get('bytes'), b'raw')
+        self.assertTrue(cache.has_key('none'))  # noqa
+        self.assertEqual(cache.get('none', 'default'), None)
+        self.assertIsNot(cache.get('list'), cache.get('list'))
+
+
+class TestLocMemCacheBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = dache.Cache('locmem://batches', shards=4)
+        self.backend = self.cache._backend
+        self.backend.clear()
+
+    def _count_writer_locks(self):
+        calls = []
+        for stripe in self.backend._stripes:
+            def writer(lock=stripe.lock, original=stripe.lock.writer):
+                calls.append(lock)
+                return original()
+            stripe.lock.writer = writer
+        self.addCleanup(self._restore_writer_locks)
+        return calls
+
+    def _restore_writer_locks(self):
+        for stripe in self.backend._stripes:
+            del stripe.lock.writer
+
+    def test_set_many_locks_once_per_stripe(self):
+        calls = self._count_writer_locks()
+        self.cache.set_many(dict(('key%d' % i, i) for i in range(50)))
+        self.assertEqual(len(calls), len(set(calls)))
+        self.assertEqual(len(self.cache.get_many(['key1', 'key2', 'x'])), 2)
+
+    def test_get_many_removes_expired(self):
+        self.cache.set_many({'a': 1, 'b': 2}, 0)
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'c': 3})
+        stored = sum(len(stripe.cache) for stripe in self.backend._stripes)
+        self.assertEqual(stored, 1)
+
+    def test_delete_many_locks_once_per_stripe(self):
+        self.cache.set_many(dict(('key%d' % i, i) for i in range(50)))
+        calls = self._count_writer_locks()
+        self.cache.delete_many(['key%d' % i for i in range(50)])
+        self.assertEqual(len(calls), len(set(calls)))
+        self.assertEqual(self.cache.get_many(['key1', 'key2']), {})
+
+
+class TestLocMemCacheIncr(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = dache.Cache('locmem://incr')
+        self.cache.clear()
+
+    def test_incr_is_atomic(self):
+        self.cache.set('counter', 0)
+
+        def work():
+            for _ in range(200):
+                self.cache.incr('counter')
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.get('counter'), 1600)
+
+    def test_incr_keeps_expiry(self):
+        self.cache.set('counter', 1, 0.2)
+        self.assertEqual(self.cache.incr('counter'), 2)
+        time.sleep(0.3)
+        self.assertIsNone(self.cache.get('counter'))
+        self.assertRaises(ValueError, self.cache.incr, 'counter')
+
+    def test_counters_are_not_pickled(self):
+        self.cache.set('counter', 1)
+        self.cache.incr('counter', 41)
+        stored = self.cache._stripes[0].cache
+        self.assertEqual(stored[self.cache.make_key('counter')], 42)
+
+
+class TestLocMemCacheStats(unittest.TestCase):
+
+    def test_evictions_and_expirations(self):
+        cache = dache.Cache('locmem://stats', max_entries=3, stats=True)
+        cache.clear()
+        cache.set('expired', 'value', 0)
+        self.assertIsNone(cache.get('expired'))
+        for key in 'abcd':
+            cache.set(key, [key])
+        cache.get('d')
+        stats = cache.stats()
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertGreater(stats['bytes_in'], stats['bytes_out'])
+        self.assertGreater(stats['bytes_out'], 0)
+
+    def test_threads(self):
+        cache = dache.Cache('locmem://stats-threads', stats=True)
+
+        def work():
+            for _ in range(100):
+                cache.get('missing')
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.stats()['misses'], 400)
+
+
+class TestShardedLocMemCache(TestLocMemCache):
+
+    CACHE_URL = 'locmem://sharded'
+
+    def setUp(self):
+        self.cache = dache.Cache(self.CACHE_URL, shards=4)
+
+    def test_shards(self):
+        self.assertEqual(len(self.cache._stripes), 4)
+        self.cache.set_many(dict(('key%d' % i, i) for i in range(100)))
+        sizes = [len(stripe.cache) for stripe in self.cache._stripes]
+        self.assertEqual(sum(sizes), 100)
+        self.assertNotIn(100, sizes)
+
+    def test_cull(self):
+        cache = dache.Cache('locmem://sharded-cull', max_entries=40,
+                            shards=4)
+        for i in range(100):
+            cache.set('cull%d' % i, 'value')
+        for stripe in cache._stripes:
+            self.assertLessEqual(len(stripe.cache), 10)
+
+    def test_zero_cull(self):
+        cache = dache.Cache('locmem://sharded-zero-cull', max_entries=40,
+                            cull_frequency=0, shards=4)
+        for i in range(100):
+            cache.set('cull%d' % i, 'value')
+        for stripe in cache._stripes:
+            self.assertLessEqual(len(stripe.cache), 10)
+
 
 class TestFileBasedCache(TestLocMemCache):
 
@@ -724,10 +1180,496 @@ class TestFileBasedCache(TestLocMemCache):
         self.assertIsNone(cache.get('hello'))
 
 
+class TestFanOutFileBasedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('file://%s' % self.dir, directory_depth=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_layout(self):
+        self.cache.set('key', 'value')
+        fname = self.cache._key_to_file('key')
+        digest = os.path.basename(fname)
+        self.assertEqual(fname, os.path.join(self.dir, digest[:2],
+                                             digest[2:4], digest))
+        self.assertTrue(os.path.exists(fname))
+        self.assertEqual(self.cache._list_cache_files(), [fname])
+
+    def test_get_set_delete(self):
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertTrue(self.cache.has_key('key'))  # noqa
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.set('expired', 'value', 0)
+        self.assertIsNone(self.cache.get('expired'))
+
+    def test_clear_removes_directories(self):
+        self.cache.set_many({'key1': 'spam', 'key2': 'eggs'})
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertIsNone(self.cache.get('key1'))
+
+    def test_cull(self):
+        cache = dache.Cache('file://%s' % self.dir, max_entries=30,
+                            directory_depth=2)
+        for i in range(1, 50):
+            cache.set('cull%d' % i, 'value', 1000)
+        self.assertEqual(len(cache._list_cache_files()), 29)
+
+
+class TestFileBasedCacheEntryCount(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('file://%s' % self.dir, max_entries=30)
+        self.listings = []
+        list_cache_files = self.cache._list_cache_files
+
+        def counting_list_cache_files():
+            self.listings.append(1)
+            return list_cache_files()
+        self.cache._backend._list_cache_files = counting_list_cache_files
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_set_does_not_list_directory(self):
+        for i in range(20):
+            self.cache.set('key%d' % i, 'value')
+            self.cache.set('key%d' % i, 'value')
+        self.assertEqual(len(self.listings), 1)
+        self.assertEqual(self.cache._entry_count.count, 20)
+        self.cache.delete('key0')
+        self.assertEqual(self.cache._entry_count.count, 19)
+
+    def test_cull_when_threshold_is_crossed(self):
+        for i in range(49):
+            self.cache.set('key%d' % i, 'value')
+        self.assertEqual(len(self.cache._list_cache_files()), 29)
+        self.assertEqual(self.cache._entry_count.count, 29)
+        self.assertLess(len(self.listings), 10)
+
+    def test_refresh(self):
+        self.cache.set('key', 'value')
+        self.cache._entry_count.counted_at -= (
+            self.cache.count_refresh_interval)
+        self.cache.set('key2', 'value')
+        self.assertEqual(len(self.listings), 2)
+
+
+class TestFileBasedCacheCullOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('file://%s' % self.dir, max_entries=9,
+                                 cull_frequency=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_expired_first(self):
+        for i in range(3):
+            self.cache.set('expired%d' % i, 'value', 0)
+        for i in range(6):
+            self.cache.set('fresh%d' % i, 'value')
+        self.cache.set('trigger', 'value')
+        self.assertEqual(len(self.cache._list_cache_files()), 7)
+        for i in range(6):
+            self.assertTrue(self.cache.has_key('fresh%d' % i))  # noqa
+
+    def test_least_recently_used(self):
+        for i in range(9):
+            self.cache.set('key%d' % i, 'value')
+        old = time.time() - 3600
+        for i in (2, 4, 6):
+            fname = self.cache._key_to_file('key%d' % i)
+            os.utime(fname, (old, old))
+        self.cache.set('trigger', 'value')
+        for i in range(9):
+            self.assertEqual(self.cache.has_key('key%d' % i),  # noqa
+                             i not in (2, 4, 6))
+
+
+class TestFileBasedCacheFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('file://%s' % self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_header(self):
+        self.cache.set('key', 'value', None)
+        with open(self.cache._key_to_file('key'), 'rb') as f:
+            header = f.read(16)
+        self.assertEqual(header[:4], b'DCH1')
+        self.assertEqual(struct.unpack('!d', header[8:]), (float('inf'),))
+
+    def test_invalid_file_is_expired(self):
+        fname = self.cache._key_to_file('key')
+        with open(fname, 'wb') as f:
+            f.write(pickle.dumps(None, -1))
+        self.assertFalse(self.cache.has_key('key'))  # noqa
+        self.assertFalse(os.path.exists(fname))
+        with open(fname, 'wb') as f:
+            f.write(b'short')
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(os.path.exists(fname))
+
+
+class TestLogFileCache(TestLocMemCache):
+
+    CACHE_URL = 'logfile://%s' % tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestLogFileCache, cls).tearDownClass()
+        shutil.rmtree(cls.CACHE_URL[len('logfile://'):])
+
+
+class TestLogFileCacheSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('logfile://%s' % self.dir, segment_size=1024,
+                                 max_entries=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get_segments(self):
+        return sorted(name for name in os.listdir(self.dir)
+                      if name.endswith('.log'))
+
+    def reopen(self):
+        del dache.backends.logfile._stores[self.dir]
+        return dache.Cache('logfile://%s' % self.dir)
+
+    def wait_for_compaction(self):
+        compactor = self.cache._store.compactor
+        if compactor is not None:
+            compactor.join()
+
+    def test_cull_small_cache(self):
+        cache = dache.Cache('logfile://%s/small' % self.dir, max_entries=2,
+                            cull_frequency=3)
+        for i in range(10):
+            cache.set('key%d' % i, i)
+        self.assertEqual(len(cache._store.index), 2)
+        self.assertEqual(cache.get('key9'), 9)
+
+    def test_rollover(self):
+        for i in range(50):
+            self.cache.set('key%d' % i, 'value' * 20)
+        self.assertGreater(len(self.get_segments()), 1)
+        for i in range(50):
+            self.assertEqual(self.cache.get('key%d' % i), 'value' * 20)
+
+    def test_compaction(self):
+        for i in range(20):
+            for j in range(10):
+                self.cache.set('key%d' % j, 'value%d' % i)
+        self.cache.set('deleted', 'value')
+        self.cache.delete('deleted')
+        self.wait_for_compaction()
+        self.assertLessEqual(len(self.get_segments()), 3)
+        for j in range(10):
+            self.assertEqual(self.cache.get('key%d' % j), 'value19')
+        self.assertIsNone(self.cache.get('deleted'))
+
+        cache = self.reopen()
+        for j in range(10):
+            self.assertEqual(cache.get('key%d' % j), 'value19')
+        self.assertIsNone(cache.get('deleted'))
+
+    def test_reopen(self):
+        self.cache.set_many({'key1': 'spam', 'key2': 'eggs'})
+        self.cache.set('key1', 'ham')
+        self.cache.delete('key2')
+        self.cache.set('expired', 'value', 0)
+        self.cache.set('forever', 'value', None)
+
+        cache = self.reopen()
+        self.assertEqual(cache.get_many(['key1', 'key2', 'expired',
+                                         'forever']),
+                         {'key1': 'ham', 'forever': 'value'})
+
+    def test_truncated_tail(self):
+        self.cache.set('key', 'value')
+        segment = os.path.join(self.dir, self.get_segments()[-1])
+        with open(segment, 'ab') as f:
+            f.write(b'garbage')
+        size = os.path.getsize(segment)
+
+        cache = self.reopen()
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(os.path.getsize(segment), size - len(b'garbage'))
+        cache.set('key2', 'value2')
+        self.assertEqual(self.reopen().get('key2'), 'value2')
+
+
+class TestSharedMemoryCache(TestLocMemCache):
+
+    CACHE_URL = 'shm://test-%d' % os.getpid()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestSharedMemoryCache, cls).tearDownClass()
+        os.remove(dache.Cache(cls.CACHE_URL)._table.path)
+
+
+class TestSharedMemoryCacheSlabs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('shm://slabs', directory=self.dir,
+                                 size=256 * 1024, page_size=16 * 1024,
+                                 slots=4096, max_entries=None)
+
+    def tearDown(self):
+        del dache.backends.shm._tables[self.cache._table.path]
+        shutil.rmtree(self.dir)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_shared_between_processes(self):
+        self.cache.set('counter', 0)
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if not pid:
+                for _ in range(50):
+                    self.cache.incr('counter')
+                self.cache.set('key%d' % os.getpid(), 'from child')
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+            self.assertEqual(self.cache.get('key%d' % pid), 'from child')
+        self.assertEqual(self.cache.get('counter'), 200)
+
+    def test_evicts_least_recently_used_of_class(self):
+        value = b'x' * 1000
+        for i in range(400):
+            self.cache.set('key%d' % i, value)
+            self.cache.get('key0')
+        self.assertEqual(self.cache.get('key0'), value)
+        self.assertEqual(self.cache.get('key399'), value)
+        self.assertIsNone(self.cache.get('key1'))
+        self.assertLess(self.cache._table.count, 300)
+
+    def test_cull_small_cache(self):
+        cache = dache.Cache('shm://small', directory=self.dir,
+                            max_entries=2, cull_frequency=3)
+        self.addCleanup(dache.backends.shm._tables.pop, cache._table.path)
+        for i in range(10):
+            cache.set('key%d' % i, i)
+        self.assertEqual(cache._table.count, 2)
+        self.assertEqual(cache.get('key9'), 9)
+
+    def test_has_key_reads_no_bytes(self):
+        cache = dache.Cache('shm://slabs', directory=self.dir, stats=True)
+        cache.set('key', 'value')
+        self.assertTrue(cache.has_key('key'))  # noqa
+        self.assertEqual(cache.stats()['bytes_out'], 0)
+        cache.get('key')
+        self.assertGreater(cache.stats()['bytes_out'], 0)
+
+    def test_steals_pages_from_other_classes(self):
+        for i in range(2000):
+            self.cache.set('small%d' % i, b'x' * 100)
+        for i in range(50):
+            self.cache.set('large%d' % i, b'x' * 5000)
+        self.assertEqual(self.cache.get('large49'), b'x' * 5000)
+        self.assertEqual(self.cache.get('small1999'), b'x' * 100)
+
+    def test_too_large(self):
+        self.cache.set('key', b'small')
+        self.cache.set('key', b'x' * 20000)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache._table.count, 0)
+
+
+class TestSQLiteCache(TestLocMemCache):
+
+    CACHE_URL = 'sqlite://%s/cache.db' % tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestSQLiteCache, cls).tearDownClass()
+        shutil.rmtree(os.path.dirname(cls.CACHE_URL[len('sqlite://'):]))
+
+
+class TestSQLiteCacheBehavior(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('sqlite://%s/cache.db' % self.dir,
+                                 max_entries=9, cull_frequency=3)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def test_wal_mode(self):
+        conn = self.cache._connect()
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0],
+                         'wal')
+
+    def test_cull_expired_then_expiring_soonest(self):
+        for i in range(3):
+            self.cache.set('expired%d' % i, 'value', 0)
+        for i in range(6):
+            self.cache.set('key%d' % i, 'value', 100 + i)
+        self.cache.set('trigger', 'value')
+        for i in range(6):
+            self.assertTrue(self.cache.has_key('key%d' % i))  # noqa
+        for i in range(3):
+            self.cache.set('trigger%d' % i, 'value')
+        for i in range(6):
+            self.assertEqual(self.cache.has_key('key%d' % i), i >= 3)  # noqa
+
+    def test_cull_small_cache(self):
+        cache = dache.Cache('sqlite://%s/small.db' % self.dir, max_entries=2,
+                            cull_frequency=3)
+        for i in range(10):
+            cache.set('key%d' % i, i)
+        conn = cache._connect()
+        self.assertEqual(conn.execute(cache._count_sql).fetchone()[0], 2)
+        self.assertEqual(cache.get('key9'), 9)
+        cache.close()
+
+    def test_large_batches(self):
+        cache = dache.Cache('sqlite://%s/large.db' % self.dir,
+                            max_entries=None)
+        data = dict(('key%d' % i, i) for i in range(2000))
+        cache.set_many(data)
+        self.assertEqual(cache.get_many(list(data) + ['missing']), data)
+        cache.delete_many(data)
+        self.assertEqual(cache.get_many(data), {})
+        cache.close()
+
+    def test_threads_have_own_connections(self):
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(self.cache._connect()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], self.cache._connect())
+        self.assertIs(self.cache._connect(), self.cache._connect())
+
+    def test_interrupted_transaction_is_rolled_back(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with self.cache._transaction() as conn:
+                conn.execute(self.cache._clear_sql)
+                raise KeyboardInterrupt
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+
+
+class TestTieredCache(TestLocMemCache):
+    CACHE_URL = 'tiered://tests?backend=%s' % quote(
+        'file://%s' % tempfile.mkdtemp(), safe='')
+
+    @classmethod
+    def tearDownClass(cls):
+        backend = dache.Cache(cls.CACHE_URL)._far
+        shutil.rmtree(backend._dir, ignore_errors=True)
+
+
+class TestTieredCacheTiers(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = dache.Cache('tiered://tiers', backend='locmem://tiers',
+                                 near_timeout=0.2, near_max_entries=10)
+        self.near = self.cache._near
+        self.far = self.cache._far
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_backend_required(self):
+        with self.assertRaises(ValueError):
+            dache.Cache('tiered://')
+
+    def test_near_hit(self):
+        self.cache.set('key', 'value')
+        self.far.set('key', 'changed')
+        self.assertEqual(self.cache.get('key'), 'value')
+        time.sleep(0.3)
+        self.assertEqual(self.cache.get('key'), 'changed')
+
+    def test_read_through(self):
+        self.far.set('key', 'value')
+        self.far.set_many({'a': 1, 'b': 2})
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2})
+        self.assertEqual(self.near.get_many(['key', 'a', 'b']),
+                         {'key': 'value', 'a': 1, 'b': 2})
+
+    def test_write_through(self):
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(self.near.get('a'), 1)
+        self.assertEqual(self.far.get('b'), 2)
+        self.cache.delete('a')
+        self.assertIsNone(self.near.get('a'))
+        self.assertIsNone(self.far.get('a'))
+        self.assertEqual(self.cache.incr('b'), 3)
+        self.assertEqual(self.near.get('b'), 3)
+
+    def test_add_refreshes_near(self):
+        self.cache.set('key', 'value')
+        self.far.set('key', 'changed')
+        self.assertFalse(self.cache.add('key', 'added'))
+        self.assertEqual(self.cache.get('key'), 'changed')
+
+    def test_near_timeout_capped(self):
+        self.cache.set('key', 'value', timeout=0.1)
+        self.far.delete('key')
+        time.sleep(0.15)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_near_bounded(self):
+        for i in range(50):
+            self.cache.set('key%d' % i, i)
+        self.assertLessEqual(
+            sum(len(stripe.cache) for stripe in self.near._stripes), 10)
+        self.assertEqual(len(self.cache.get_many(['key%d' % i
+                                                  for i in range(50)])), 50)
+
+
 class TestLevelDBCache(TestFileBasedCache):
     CACHE_URL = 'leveldb://%s' % tempfile.mkdtemp()
 
 
+class TestLevelDBCacheFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = dache.Cache('leveldb://%s' % self.dir)
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_header(self):
+        self.cache.set('key', 'value', None)
+        data = bytes(self.cache._db.Get(
+            self.cache._make_and_validate_key('key', None)))
+        self.assertEqual(data[:4], b'DCH1')
+        self.assertEqual(struct.unpack('!d', data[8:16]), (float('inf'),))
+
+    def test_invalid_value_is_expired(self):
+        key = self.cache._make_and_validate_key('key', None)
+        self.cache._db.Put(key, b'short')
+        self.assertIsNone(self.cache.get('key'))
+        self.assertRaises(KeyError, self.cache._db.Get, key)
+
+
 class DontTestCullMixin(object):
     """Some backends support culling natively, so no need to implement nor test
     cullling."""
@@ -744,6 +1686,179 @@ class TestRedisCache(DontTestCullMixin, TestLocMemCache):
     CACHE_URL = 'redis://%s/0' % get_cache_server()
 
 
+class TestRedisCacheCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = dache.Cache(TestRedisCache.CACHE_URL)
+        self.commands = []
+        execute_command = self.cache.redis.execute_command
+
+        def recording_execute_command(*args, **options):
+            self.commands.append(args[0])
+            return execute_command(*args, **options)
+        self.cache.redis.execute_command = recording_execute_command
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_batches_take_one_command(self):
+        self.cache.set_many({'key1': 'spam', 'key2': 'eggs'})
+        self.assertEqual(self.commands, [])
+        self.assertEqual(self.cache.get_many(['key1', 'key2', 'missing']),
+                         {'key1': 'spam', 'key2': 'eggs'})
+        self.assertEqual(self.commands, ['MGET'])
+        self.cache.delete_many(['key1', 'key2'])
+        self.assertEqual(self.commands, ['MGET', 'DEL'])
+        self.assertEqual(self.cache.get_many(['key1', 'key2']), {})
+
+    def test_has_key(self):
+        self.cache.set('key', 'value')
+        self.assertTrue(self.cache.has_key('key'))  # noqa
+        self.assertFalse(self.cache.has_key('missing'))  # noqa
+        self.assertEqual(self.commands, ['SET', 'EXISTS', 'EXISTS'])
+
+    def test_set_expiry(self):
+        self.cache.set('key', 'value', 1.5)
+        self.assertEqual(self.commands, ['SET'])
+        self.assertTrue(1000 < self.cache.redis.pttl(':1:key') <= 1500)
+        self.cache.set('key', 'value', 10)
+        self.assertTrue(9 <= self.cache.redis.ttl(':1:key') <= 10)
+        self.cache.set('key', 'value', None)
+        self.assertEqual(self.cache.redis.ttl(':1:key'), -1)
+
+    def test_add_is_one_command(self):
+        self.assertTrue(self.cache.add('key', 'value'))
+        self.assertFalse(self.cache.add('key', 'other'))
+        self.assertEqual(self.commands, ['SET', 'SET'])
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_incr_is_atomic(self):
+        self.cache.set('counter', 10, 100)
+        self.assertEqual(self.cache.redis.get(':1:counter'), b'10')
+
+        def incr():
+            for _ in range(50):
+                self.cache.incr('counter')
+        threads = [threading.Thread(target=incr) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.get('counter'), 210)
+        self.assertEqual(self.cache.decr('counter', 10), 200)
+        self.assertGreater(self.cache.redis.ttl(':1:counter'), 0)
+
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
+        self.assertFalse(self.cache.has_key('missing'))  # noqa
+
+    def test_incr_non_integer(self):
+        self.cache.set('float', 1.5)
+        self.assertEqual(self.cache.incr('float'), 2.5)
+        self.assertEqual(self.cache.get('float'), 2.5)
+
+    def test_incr_non_integer_keeps_expiry(self):
+        self.cache.set('float', 1.5, 0.3)
+        self.assertEqual(self.cache.incr('float', 0.5), 2.0)
+        self.assertGreater(self.cache.redis.pttl(':1:float'), 0)
+        time.sleep(0.4)
+        self.assertIsNone(self.cache.get('float'))
+        with self.assertRaises(ValueError):
+            self.cache.incr('float')
+
+    def test_clear_prefix(self):
+        tenant1 = dache.Cache(TestRedisCache.CACHE_URL, key_prefix='tenant1',
+                              clear_mode='prefix', clear_batch_size=10)
+        tenant2 = dache.Cache(TestRedisCache.CACHE_URL, key_prefix='tenant*')
+        data = dict(('key%d' % i, i) for i in range(25))
+        tenant1.set_many(data)
+        tenant2.set_many(data)
+        tenant1.clear()
+        self.assertEqual(tenant1.get_many(data), {})
+        self.assertEqual(tenant2.get_many(data), data)
+
+    def test_invalid_clear_mode(self):
+        with self.assertRaises(ValueError):
+            dache.Cache(TestRedisCache.CACHE_URL, clear_mode='all')
+
+
+class TestShardedRedisCache(TestRedisCache):
+    # Two names of the same server still exercise the routing
+    CACHE_URL = 'redis://%s:6379,localhost:6379/0' % get_cache_server()
+
+
+class TestRedisFanOut(unittest.TestCase):
+
+    def test_pool_is_closed_at_exit(self):
+        script = ('from dache.backends.redis import _fan_out\n'
+                  'assert _fan_out(abs, [-1, -2]) == [1, 2]\n')
+        process = subprocess.Popen(
+            [sys.executable, '-W', 'always', '-c', script],
+            stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(stderr, b'')
+
+
+class TestRedisCacheConnectionPool(unittest.TestCase):
+
+    def test_shared_pool(self):
+        cache1 = dache.Cache('redis://localhost:6379/0')
+        cache2 = dache.Cache('redis://localhost:6379/0', key_prefix='other')
+        cache3 = dache.Cache('redis://localhost:6379/1')
+        self.assertIs(cache1.redis.connection_pool,
+                      cache2.redis.connection_pool)
+        self.assertIsNot(cache1.redis.connection_pool,
+                         cache3.redis.connection_pool)
+
+    def test_options(self):
+        cache = dache.Cache('redis://localhost/0?socket_timeout=1.5&db=2'
+                            '&max_connections=10&socket_keepalive=true',
+                            socket_keepalive_options={1: 2})
+        pool = cache.redis.connection_pool
+        self.assertEqual(pool.max_connections, 10)
+        self.assertEqual(pool.connection_kwargs['db'], 2)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 1.5)
+        self.assertIs(pool.connection_kwargs['socket_keepalive'], True)
+        self.assertEqual(pool.connection_kwargs['socket_keepalive_options'],
+                         {1: 2})
+
+        cache = dache.Cache('redis://localhost/0', socket_timeout=1.5,
+                            max_connections=10)
+        self.assertEqual(cache.redis.connection_pool.max_connections, 10)
+
+    def test_unix_socket(self):
+        cache = dache.Cache('redis://?unix_socket_path=/tmp/redis.sock&db=3')
+        pool = cache.redis.connection_pool
+        self.assertEqual(pool.connection_kwargs['path'], '/tmp/redis.sock')
+        self.assertEqual(pool.connection_kwargs['db'], 3)
+        self.assertNotIn('host', pool.connection_kwargs)
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(ValueError):
+            dache.Cache('redis://localhost/0?sockettimeout=1')
+
+    def test_sharding(self):
+        cache = dache.Cache('redis://:secret@h1:6379,h2,[::1]:6380/2')
+        pools = [client.connection_pool
+                 for client in cache._clients.values()]
+        self.assertEqual(
+            sorted((pool.connection_kwargs['host'],
+                    pool.connection_kwargs['port']) for pool in pools),
+            [('::1', 6380), ('h1', 6379), ('h2', 6379)])
+        for pool in pools:
+            self.assertEqual(pool.connection_kwargs['db'], 2)
+            self.assertEqual(pool.connection_kwargs['password'], 'secret')
+
+        keys = ['key%d' % i for i in range(300)]
+        groups = cache._group_by_client(keys)
+        self.assertEqual(len(groups), 3)
+        for client, group in groups:
+            self.assertTrue(50 < len(group) < 150)
+            for key in group:
+                self.assertIs(cache._get_client(key), client)
+
+
 class TestMemcachedCache(DontTestCullMixin, TestLocMemCache):
 
     CACHE_URL = 'memcached://%s' % get_cache_server()
@@ -766,6 +1881,17 @@ class TestMemcachedCache(DontTestCullMixin, TestLocMemCache):
         with self.assertRaises(Exception):
             self.cache.set(long_key, 'value')
 
+    def test_stats_bytes(self):
+        cache = dache.Cache(self.CACHE_URL, stats=True)
+        cache.set('key', 'value')
+        cache.set_many({'list': [1, 2], 'number': 42})
+        bytes_in = cache.stats()['bytes_in']
+        self.assertGreater(bytes_in, 0)
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.stats()['bytes_out'], 5)
+        cache.get_many(['list', 'number'])
+        self.assertEqual(cache.stats()['bytes_out'], bytes_in)
+
 
 if six.PY2:  # XXX: PyLibMC hasn't supported Python 3, so don't test it for now
     class TestPyLibMCCache(TestMemcachedCache):
@@ -782,3 +1908,237 @@ if six.PY2:  # XXX: PyLibMC hasn't supported Python 3, so don't test it for now
             except:
                 self.cache.clear()
             self.cache.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'AsyncCache requires Python 3.5+')
+class TestAsyncLocMemCache(unittest.TestCase):
+
+    CACHE_URL = 'locmem://async'
+
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.cache = dache.AsyncCache(self.CACHE_URL)
+
+    def tearDown(self):
+        import asyncio
+        self.wait(self.cache.clear())
+        self.wait(self.cache.close())
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_simple(self):
+        self.wait(self.cache.set('key', 'value'))
+        self.assertEqual(self.wait(self.cache.get('key')), 'value')
+        self.assertEqual(self.wait(self.cache.get('missing', 'default')),
+                         'default')
+
+    def test_add(self):
+        self.assertTrue(self.wait(self.cache.add('addkey', 'value')))
+        self.assertFalse(self.wait(self.cache.add('addkey', 'newvalue')))
+        self.assertEqual(self.wait(self.cache.get('addkey')), 'value')
+
+    def test_many(self):
+        self.wait(self.cache.set_many({'a': 'a', 'b': [1, 2], 'c': 3}))
+        self.assertEqual(self.wait(self.cache.get_many(['a', 'b', 'd'])),
+                         {'a': 'a', 'b': [1, 2]})
+        self.wait(self.cache.delete_many(['a', 'b']))
+        self.assertEqual(self.wait(self.cache.get_many(['a', 'b', 'c'])),
+                         {'c': 3})
+
+    def test_delete(self):
+        self.wait(self.cache.set('key', 'value'))
+        self.assertTrue(self.wait(self.cache.has_key('key')))
+        self.wait(self.cache.delete('key'))
+        self.assertFalse(self.wait(self.cache.has_key('key')))
+
+    def test_incr_decr(self):
+        self.wait(self.cache.set('answer', 41))
+        self.assertEqual(self.wait(self.cache.incr('answer')), 42)
+        self.assertEqual(self.wait(self.cache.decr('answer', 10)), 32)
+        self.assertEqual(self.wait(self.cache.get('answer')), 32)
+        with self.assertRaises(ValueError):
+            self.wait(self.cache.incr('does_not_exist'))
+
+    def test_incr_version(self):
+        self.wait(self.cache.set('answer', 42, version=2))
+        self.assertEqual(
+            self.wait(self.cache.incr_version('answer', version=2)), 3)
+        self.assertIsNone(self.wait(self.cache.get('answer', version=2)))
+        self.assertEqual(self.wait(self.cache.get('answer', version=3)), 42)
+        with self.assertRaises(ValueError):
+            self.wait(self.cache.incr_version('does_not_exist'))
+
+    def test_expiration(self):
+        self.wait(self.cache.set('expire', 'value', 0.5))
+        time.sleep(0.6)
+        self.assertIsNone(self.wait(self.cache.get('expire')))
+
+    def test_gather(self):
+        import asyncio
+        keys = ['key%d' % i for i in range(20)]
+        self.wait(asyncio.gather(*[self.cache.set(key, key) for key in keys]))
+        self.assertEqual(self.wait(self.cache.get_many(keys)),
+                         dict((key, key) for key in keys))
+
+    def test_get_or_set(self):
+        import asyncio
+        calls = []
+
+        def compute():
+            calls.append(None)
+            time.sleep(0.05)
+            return 'value'
+        results = self.wait(asyncio.gather(*[
+            self.cache.get_or_set('flight', compute) for _ in range(8)]))
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            self.wait(self.cache.get_or_set('locked', 'value', lock=True)),
+            'value')
+
+    def test_get_or_set_coroutine(self):
+        import asyncio
+        from tests.coroutines import returning
+        calls = []
+        compute = returning('value', calls, 0.05)
+        results = self.wait(asyncio.gather(*[
+            self.cache.get_or_set('flight', compute) for _ in range(8)]))
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.wait(self.cache.get('flight')), 'value')
+        self.assertEqual(
+            self.wait(self.cache.get_or_set('locked', compute, lock=True)),
+            'value')
+        self.assertEqual(self.wait(self.cache.get('locked')), 'value')
+
+    def test_get_or_set_hung_leader(self):
+        import asyncio
+        from tests.coroutines import returning, waiting
+        release = asyncio.Event()
+        leader = asyncio.ensure_future(
+            self.cache.get_or_set('flight', waiting(release, 'leader')))
+        self.wait(asyncio.sleep(0.05))
+        try:
+            self.assertEqual(
+                self.wait(self.cache.get_or_set('flight',
+                                                returning('follower'),
+                                                lock_timeout=0.1)),
+                'follower')
+        finally:
+            release.set()
+        self.assertEqual(self.wait(leader), 'leader')
+
+    def test_synchronous_methods(self):
+        self.assertIn('key', self.cache.make_key('key'))
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.cache.validate_key('key with spaces')
+        self.assertTrue(w)
+        with self.assertRaises(TypeError):
+            'key' in self.cache
+
+    def test_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(1)
+        cache = dache.AsyncCache(self.CACHE_URL, executor=executor)
+        thread_names = []
+        original_get = cache._backend._cache.get
+
+        def get(*args, **kwargs):
+            thread_names.append(threading.current_thread().name)
+            return original_get(*args, **kwargs)
+        cache._backend._cache.get = get
+        self.wait(cache.get('key'))
+        executor.shutdown()
+        self.assertEqual(len(thread_names), 1)
+        self.assertNotEqual(thread_names[0],
+                            threading.current_thread().name)
+
+    def test_stats(self):
+        cache = dache.AsyncCache(self.CACHE_URL, stats=True)
+        self.wait(cache.set('key', 'value'))
+        self.wait(cache.get('key'))
+        self.wait(cache.get('missing'))
+        stats = cache.stats()
+        self.assertEqual((stats['sets'], stats['hits'], stats['misses']),
+                         (1, 1, 1))
+
+    def test_stats_of_concurrent_calls(self):
+        import asyncio
+        cache = dache.AsyncCache(self.CACHE_URL, stats=True)
+        self.wait(cache.set('counter', 1))
+        self.wait(asyncio.gather(*[cache.get('counter') for _ in range(4)] +
+                                 [cache.get('missing')]))
+        self.assertEqual(self.wait(cache.decr('counter')), 0)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (4, 1))
+        self.assertEqual(stats['latency']['decr']['count'], 1)
+        self.assertNotIn('incr', stats['latency'])
+
+
+class TestAsyncFileBasedCache(TestAsyncLocMemCache):
+    CACHE_URL = 'file://%s' % tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.CACHE_URL[len('file://'):], ignore_errors=True)
+
+
+class TestAsyncSQLiteCache(TestAsyncLocMemCache):
+    CACHE_URL = 'sqlite://%s/cache.db' % tempfile.mkdtemp()
+
+
+class TestAsyncRedisCache(TestAsyncLocMemCache):
+    CACHE_URL = TestRedisCache.CACHE_URL
+
+    def test_executor(self):
+        # The backend is accessed natively
+        from dache.backends.async_base import AsyncBaseCache
+        self.assertIsInstance(self.cache._backend, AsyncBaseCache)
+
+    def test_shared_with_sync_cache(self):
+        cache = dache.Cache(self.CACHE_URL)
+        cache.set('sync', [1, 2])
+        cache.set('counter', 1)
+        self.wait(self.cache.set('async', {'a': 1}))
+        self.assertEqual(self.wait(self.cache.get('sync')), [1, 2])
+        self.assertEqual(self.wait(self.cache.incr('counter')), 2)
+        self.assertEqual(cache.get('async'), {'a': 1})
+        self.assertEqual(cache.get('counter'), 2)
+
+    def test_clear_prefix(self):
+        cache = dache.AsyncCache(self.CACHE_URL, key_prefix='async-prefix',
+                                 clear_mode='prefix', clear_batch_size=10)
+        self.wait(self.cache.set('key', 'value'))
+        self.wait(cache.set_many(dict(('key%d' % i, i) for i in range(25))))
+        self.wait(cache.clear())
+        self.assertEqual(self.wait(cache.get_many(['key%d' % i
+                                                  for i in range(25)])), {})
+        self.assertEqual(self.wait(self.cache.get('key')), 'value')
+
+    def test_incr_non_integer_keeps_expiry(self):
+        self.wait(self.cache.set('float', 1.5, 0.3))
+        self.assertEqual(self.wait(self.cache.incr('float', 0.5)), 2.0)
+        time.sleep(0.4)
+        self.assertIsNone(self.wait(self.cache.get('float')))
+
+
+class TestAsyncShardedRedisCache(TestAsyncRedisCache):
+    CACHE_URL = TestShardedRedisCache.CACHE_URL
+
+
+class TestAsyncMemcachedCache(TestAsyncRedisCache):
+    CACHE_URL = TestMemcachedCache.CACHE_URL
+
+    def test_clear_prefix(self):
+        # Memcached only flushes all keys
+        pass
+
+    def test_incr_non_integer_keeps_expiry(self):
+        # Memcached only increments integers
+        pass
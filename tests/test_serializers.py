@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+import unittest
+
+import dache
+
+from dache.serializers import (JSONSerializer, MarshalSerializer,
+                               PickleSerializer, RawSerializer,
+                               get_serializer)
+
+
+class UpperSerializer(object):
+
+    def dumps(self, value):
+        return value.upper()
+
+    def loads(self, data):
+        return data
+
+
+class TestSerializers(unittest.TestCase):
+
+    def test_round_trip(self):
+        value = {'list': [1, 2.5, None], 'text': 'Iñtërnâtiônàlizætiøn'}
+        for serializer in (JSONSerializer(), MarshalSerializer(),
+                           PickleSerializer()):
+            data = serializer.dumps(value)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(serializer.loads(data), value)
+
+    def test_raw(self):
+        serializer = RawSerializer()
+        self.assertEqual(serializer.loads(serializer.dumps(b'abc')), b'abc')
+        self.assertRaises(TypeError, serializer.dumps, 1)
+
+    def test_get_serializer(self):
+        self.assertIsInstance(get_serializer('json'), JSONSerializer)
+        self.assertIsInstance(
+            get_serializer('dache.serializers.RawSerializer'), RawSerializer)
+        self.assertIsInstance(get_serializer(MarshalSerializer),
+                              MarshalSerializer)
+        serializer = PickleSerializer(protocol=2)
+        self.assertIs(get_serializer(serializer), serializer)
+        self.assertIsNone(get_serializer(None))
+
+    def test_register_serializer(self):
+        dache.register_serializer('upper', UpperSerializer)
+        cache = dache.Cache('locmem://serializers', serializer='upper')
+        cache.set('key', b'value')
+        self.assertEqual(cache.get('key'), b'VALUE')
+
+    def test_no_serializer(self):
+        cache = dache.Cache('locmem://serializers-none', serializer=None)
+        value = [1, 2]
+        cache.set('key', value)
+        self.assertIs(cache.get('key'), value)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for url in ('file://%s' % directory,
+                    'sqlite://%s/cache.db' % directory):
+            self.assertRaises(ValueError, dache.Cache, url, serializer=None)
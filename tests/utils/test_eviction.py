@@ -0,0 +1,64 @@
+import unittest
+
+from dache.utils.eviction import (FIFOPolicy, LFUPolicy, LRUPolicy,
+                                  get_eviction_policy)
+
+
+class TestEvictionPolicies(unittest.TestCase):
+
+    def _fill(self, policy, keys):
+        for key in keys:
+            policy.add(key)
+        return policy
+
+    def test_fifo(self):
+        policy = self._fill(FIFOPolicy(), ['a', 'b', 'c'])
+        policy.access('a')
+        policy.add('a')
+        self.assertEqual(policy.pop(), 'a')
+        self.assertEqual(policy.pop(), 'b')
+        self.assertEqual(len(policy), 1)
+
+    def test_lru(self):
+        policy = self._fill(LRUPolicy(), ['a', 'b', 'c'])
+        policy.access('a')
+        self.assertEqual(policy.pop(), 'b')
+        policy.add('c')
+        self.assertEqual(policy.pop(), 'a')
+        self.assertEqual(policy.pop(), 'c')
+        self.assertRaises(KeyError, policy.pop)
+
+    def test_lfu(self):
+        policy = self._fill(LFUPolicy(), ['a', 'b', 'c'])
+        policy.access('a')
+        policy.access('a')
+        policy.access('b')
+        self.assertEqual(policy.pop(), 'c')
+        policy.add('d')
+        self.assertEqual(policy.pop(), 'd')
+        self.assertEqual(policy.pop(), 'b')
+        self.assertEqual(policy.pop(), 'a')
+        self.assertRaises(KeyError, policy.pop)
+
+    def test_lfu_discard_least_used(self):
+        policy = self._fill(LFUPolicy(), ['a', 'b'])
+        policy.access('b')
+        policy.discard('a')
+        self.assertEqual(policy.pop(), 'b')
+
+    def test_discard_and_clear(self):
+        for policy_class in (FIFOPolicy, LFUPolicy, LRUPolicy):
+            policy = self._fill(policy_class(), ['a', 'b'])
+            policy.discard('a')
+            policy.discard('does_not_exist')
+            policy.access('does_not_exist')
+            self.assertEqual(len(policy), 1)
+            policy.clear()
+            self.assertEqual(len(policy), 0)
+
+    def test_get_eviction_policy(self):
+        self.assertIs(get_eviction_policy('LRU'), LRUPolicy)
+        self.assertIs(get_eviction_policy('dache.utils.eviction.LFUPolicy'),
+                      LFUPolicy)
+        self.assertIs(get_eviction_policy(FIFOPolicy), FIFOPolicy)
+        self.assertRaises(ImportError, get_eviction_policy, 'random')
@@ -0,0 +1,28 @@
+import unittest
+
+from collections import Counter
+
+from dache.utils.hashring import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+
+    keys = ['key%d' % i for i in range(3000)]
+
+    def test_distribution(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = Counter(ring.get_node(key) for key in self.keys)
+        self.assertEqual(set(counts), set(['a', 'b', 'c']))
+        for count in counts.values():
+            self.assertTrue(700 < count < 1300)
+
+    def test_removing_node_only_moves_its_keys(self):
+        ring = HashRing(['a', 'b', 'c'])
+        smaller = HashRing(['a', 'b'])
+        for key in self.keys:
+            if ring.get_node(key) != 'c':
+                self.assertEqual(smaller.get_node(key), ring.get_node(key))
+
+    def test_single_node(self):
+        ring = HashRing(['a'])
+        self.assertEqual(ring.get_node('key'), 'a')
@@ -0,0 +1,26 @@
+import heapq
+import random
+import unittest
+
+from dache.utils.heap import heapremove
+
+
+class TestHeapRemove(unittest.TestCase):
+
+    def test_keeps_heap_invariant(self):
+        rand = random.Random(42)
+        for size in (1, 2, 3, 10, 100):
+            for _ in range(20):
+                heap = [rand.randrange(50) for _ in range(size)]
+                heapq.heapify(heap)
+                items = sorted(heap)
+                item = heap[rand.randrange(size)]
+                heapremove(heap, heap.index(item))
+                items.remove(item)
+                self.assertEqual([heapq.heappop(heap) for _ in items],
+                                 items)
+
+    def test_last(self):
+        heap = [1, 2, 3]
+        heapremove(heap, 2)
+        self.assertEqual(heap, [1, 2])
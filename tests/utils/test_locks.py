@@ -0,0 +1,29 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dache.utils import locks
+
+
+@unittest.skipUnless(locks.LOCK_EX, 'File locking is not supported')
+class TestLocks(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lock(self):
+        with open(self.path, 'ab') as f:
+            self.assertTrue(locks.lock(f, locks.LOCK_EX))
+            self.assertTrue(locks.unlock(f))
+
+    def test_non_blocking(self):
+        with open(self.path, 'ab') as f, open(self.path, 'ab') as other:
+            self.assertTrue(locks.lock(f, locks.LOCK_EX | locks.LOCK_NB))
+            self.assertFalse(locks.lock(other, locks.LOCK_EX | locks.LOCK_NB))
+            locks.unlock(f)
+            self.assertTrue(locks.lock(other, locks.LOCK_EX | locks.LOCK_NB))